@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# ==============================================================================
+# Binary archive of one or many tunes. All tunes share a pitch array and a
+# duration array, so an archive is loaded by mapping it and slicing views out
+# of it. A loaded tune reads its notes straight from the mapped buffer.
+#
+#   header     magic "TUNA", version u16, name count u16, tune count u32,
+#              total note count u32
+#   names      pitch names, each a u8 length and utf-8 bytes, padded to 8
+#   offsets    (tune count + 1) u64, the first note of each tune
+#   pitches    u8 per note, an index into names, padded to 4
+#   durations  u32 per note
+#
+# All integers are little-endian.
+# ==============================================================================
+
+import mmap
+import struct
+import sys
+from array import array
+from typing import Iterable, Iterator
+
+from interp import CHROMATIC, REST, Note, Tune
+
+MAGIC = b"TUNA"
+VERSION = 1
+HEADER = struct.Struct("<4sHHII")
+DEFAULT_NAMES = (*CHROMATIC, REST)
+
+
+class ArchiveError(Exception):
+    """Malformed Tune Archive"""
+    pass
+
+
+def _pad(size: int, align: int) -> int:
+    return -size % align
+
+
+def _littleEndian(values: array) -> array:
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+class PackedNotes:
+    """A read-only list of notes backed by a pitch view and a duration view.
+    Slicing gives another view of the same buffer, anything that builds a
+    new tune (joining, repeating) gives a plain list of notes."""
+
+    def __init__(self, pitches: memoryview, durations: memoryview,
+                 names: tuple[str, ...]):
+        self.pitches = pitches
+        self.durations = durations
+        self.names = names
+
+    def __len__(self) -> int:
+        return len(self.pitches)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return PackedNotes(self.pitches[i], self.durations[i], self.names)
+        return Note(self.names[self.pitches[i]], self.durations[i])
+
+    def __iter__(self) -> Iterator[Note]:
+        names = self.names
+        for pitch, duration in zip(self.pitches, self.durations):
+            yield Note(names[pitch], duration)
+
+    def __add__(self, other) -> list[Note]:
+        return list(self) + list(other)
+
+    def __radd__(self, other) -> list[Note]:
+        return list(other) + list(self)
+
+    def __mul__(self, count: int) -> list[Note]:
+        return list(self) * count
+
+    def __eq__(self, other) -> bool:
+        try:
+            return len(self) == len(other) and all(
+                a == b for a, b in zip(self, other)
+            )
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+
+def encodeArchive(tunes: Iterable[Tune]) -> bytes:
+    """Packs tunes into the archive format"""
+    names = list(DEFAULT_NAMES)
+    index = {name: i for i, name in enumerate(names)}
+    offsets = array("Q", [0])
+    pitches = bytearray()
+    durations = array("I")
+
+    for tune in tunes:
+        for note in tune.notes:
+            if (i := index.get(note.pitch)) is None:
+                if len(names) > 0xFF:
+                    raise ArchiveError("too many distinct pitch names")
+                i = index[note.pitch] = len(names)
+                names.append(note.pitch)
+            pitches.append(i)
+            try:
+                durations.append(note.duration)
+            except OverflowError:
+                raise ArchiveError(f"duration out of range: {note.duration}")
+        offsets.append(len(pitches))
+
+    data = bytearray(HEADER.pack(
+        MAGIC, VERSION, len(names), len(offsets) - 1, len(pitches)
+    ))
+    for name in names:
+        encoded = name.encode()
+        data.append(len(encoded))
+        data += encoded
+    data += bytes(_pad(len(data), 8))
+    data += _littleEndian(offsets).tobytes()
+    data += pitches
+    data += bytes(_pad(len(data), 4))
+    data += _littleEndian(durations).tobytes()
+    return bytes(data)
+
+
+def writeArchive(tunes: Iterable[Tune], name: str) -> None:
+    with open(name, "wb") as file:
+        file.write(encodeArchive(tunes))
+
+
+class Archive:
+    """Random access to the tunes of an archive held in any buffer. Finding
+    a tune costs two reads from the offsets table, whatever the archive size.
+    The tables are checked when the archive is opened, so a malformed one
+    raises ArchiveError here rather than when its tunes are read."""
+
+    def __init__(self, buffer):
+        data = memoryview(buffer)
+        if len(data) < HEADER.size:
+            raise ArchiveError("truncated header")
+        magic, version, nnames, ntunes, nnotes = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ArchiveError("not a tune archive")
+        if version != VERSION:
+            raise ArchiveError(f"unsupported archive version {version}")
+
+        names = []
+        i = HEADER.size
+        for _ in range(nnames):
+            if i >= len(data) or i + 1 + data[i] > len(data):
+                raise ArchiveError("truncated names")
+            length = data[i]
+            try:
+                names.append(str(data[i + 1:i + 1 + length], "utf-8"))
+            except UnicodeDecodeError:
+                raise ArchiveError("pitch name is not utf-8") from None
+            i += 1 + length
+        i += _pad(i, 8)
+
+        offsets_end = i + 8 * (ntunes + 1)
+        pitches_end = offsets_end + nnotes
+        durations_start = pitches_end + _pad(pitches_end, 4)
+        if len(data) < durations_start + 4 * nnotes:
+            raise ArchiveError("truncated archive")
+
+        self.names = tuple(names)
+        self.offsets = data[i:offsets_end].cast("Q")
+        self.pitches = data[offsets_end:pitches_end]
+        self.durations = data[durations_start:durations_start + 4 * nnotes].cast("I")
+        if sys.byteorder != "little":
+            # the views would read swapped integers, so pay for a copy instead
+            self.offsets = memoryview(_littleEndian(array("Q", self.offsets)))
+            self.durations = memoryview(_littleEndian(array("I", self.durations)))
+
+        offsets = self.offsets
+        if offsets[0] != 0 or offsets[-1] != nnotes or any(
+            a > b for a, b in zip(offsets, offsets[1:])
+        ):
+            raise ArchiveError("tune offsets out of order")
+        if max(self.pitches, default=0) >= max(nnames, 1):
+            raise ArchiveError("pitch index out of range")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> Tune:
+        if not -len(self) <= i < len(self):
+            raise IndexError("tune index out of range")
+        i %= len(self)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return Tune(PackedNotes(
+            self.pitches[start:end], self.durations[start:end], self.names
+        ))
+
+    def __iter__(self) -> Iterator[Tune]:
+        return (self[i] for i in range(len(self)))
+
+
+def openArchive(name: str) -> Archive:
+    """Maps an archive file. The mapping stays open for as long as the
+    archive or any tune taken from it is alive."""
+    with open(name, "rb") as file:
+        try:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ArchiveError("empty archive")
+        return Archive(mapped)
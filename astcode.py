@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+# ==============================================================================
+# Compact binary encoding of interp ASTs, for shipping precompiled scripts to
+# workers that never import lark. Nodes are written children first, so the
+# loader is a loop over a stack of finished nodes with no recursion at all.
+#
+#   header  magic "TAST", version u16, name count u32
+#   names   every identifier, pitch, path and unit, each once: a varint
+#           length and utf-8 bytes
+#   code    one op per node, children before their parent: a tag byte,
+#           then its operands as varints (name indices, zigzag integers,
+#           and the child count of an n-ary node)
+#
+# The code must leave exactly one node, the program. Header integers are
+# little-endian.
+#
+#   python astcode.py examples/one.example -o one.tast
+#
+# compiles a script (this needs parse_run, and so lark).
+# ==============================================================================
+
+import struct
+import sys
+
+from interp import (
+    Expr, Lit, Add, Sub, Mul, Div, Neg, And, Or, Not, Eq,
+    Neq, Lt, Gt, Leq, Geq, If, Let, Name, Note, Join,
+    Slice, Letfun, App, Assign, Seq, Show, Read,
+    Write, Run, Repeat, Reverse, Par, Load, Preview,
+    JoinN, SeqN, TuneLit,
+)
+
+MAGIC = b"TAST"
+VERSION = 2
+HEADER = struct.Struct("<4sHI")
+
+
+class AstFormatError(Exception):
+    """Malformed Compiled Script"""
+    pass
+
+
+# the operands of each node, in constructor order: "e" a child node, "n" a
+# name, "i" an integer, "E" any number of child nodes, "T" any number of notes
+NODES: list[tuple[type, str]] = [
+    (Lit, "i"),  # an int; booleans have ops of their own
+    (Name, "n"),
+    (Note, "ni"),
+    (Add, "ee"), (Sub, "ee"), (Mul, "ee"), (Div, "ee"), (Neg, "e"),
+    (And, "ee"), (Or, "ee"), (Not, "e"),
+    (Eq, "ee"), (Neq, "ee"), (Lt, "ee"), (Gt, "ee"), (Leq, "ee"), (Geq, "ee"),
+    (If, "eee"), (Let, "nee"), (Letfun, "nnee"), (App, "ee"),
+    (Assign, "ne"), (Seq, "ee"), (Show, "e"), (Read, ""),
+    (Join, "ee"), (Par, "ee"), (Slice, "eee"),
+    (Write, "en"), (Run, "n"), (Load, "n"), (Repeat, "ee"), (Reverse, "e"),
+    (Preview, "ine"),
+    (JoinN, "E"), (SeqN, "E"), (TuneLit, "T"),
+]
+TRUE, FALSE = len(NODES), len(NODES) + 1
+TAGS = {node: tag for tag, (node, _) in enumerate(NODES)}
+
+
+def _varint(out: bytearray, n: int) -> None:
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _zigzag(n: int) -> int:
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+
+def encodeAST(e: Expr) -> bytes:
+    """The compiled form of an AST"""
+    names: dict[str, int] = {}
+    code = bytearray()
+    todo: list[tuple[Expr, bool]] = [(e, False)]
+    while todo:
+        node, children_done = todo.pop()
+        if isinstance(node, Lit) and type(node.value) is bool:
+            code.append(TRUE if node.value else FALSE)
+            continue
+        if (tag := TAGS.get(type(node))) is None or (
+            isinstance(node, Lit) and type(node.value) is not int
+        ):
+            raise AstFormatError(f"cannot compile {type(node).__name__}: {node}")
+        spec = NODES[tag][1]
+        values = [getattr(node, f) for f in node.__dataclass_fields__]
+        if not children_done:
+            todo.append((node, True))
+            children = []
+            for kind, value in zip(spec, values):
+                if kind == "e":
+                    children.append(value)
+                elif kind == "E":
+                    children.extend(value)
+            todo.extend((child, False) for child in reversed(children))
+            continue
+        code.append(tag)
+        for kind, value in zip(spec, values):
+            match kind:
+                case "n":
+                    _varint(code, names.setdefault(value, len(names)))
+                case "i":
+                    _varint(code, _zigzag(value))
+                case "E":
+                    _varint(code, len(value))
+                case "T":
+                    _varint(code, len(value))
+                    for note in value:
+                        _varint(code, names.setdefault(note.pitch, len(names)))
+                        _varint(code, _zigzag(note.duration))
+
+    out = bytearray(HEADER.pack(MAGIC, VERSION, len(names)))
+    for name in names:
+        data = name.encode()
+        _varint(out, len(data))
+        out += data
+    return bytes(out + code)
+
+
+def decodeAST(data: bytes) -> Expr:
+    """Rebuilds an AST from its compiled form"""
+    try:
+        magic, version, name_count = HEADER.unpack_from(data)
+    except struct.error:
+        raise AstFormatError("not a compiled script")
+    if magic != MAGIC:
+        raise AstFormatError("not a compiled script")
+    if version != VERSION:
+        raise AstFormatError(f"unsupported version {version}")
+
+    pos = HEADER.size
+    end = len(data)
+
+    def varint() -> int:
+        nonlocal pos
+        n = shift = 0
+        while True:
+            if pos >= end:
+                raise AstFormatError("truncated compiled script")
+            b = data[pos]
+            pos += 1
+            n |= (b & 0x7F) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def integer() -> int:
+        n = varint()
+        return -(n + 1 >> 1) if n & 1 else n >> 1
+
+    names = []
+    stack: list[Expr] = []
+    try:
+        for _ in range(name_count):
+            length = varint()
+            names.append(data[pos:pos + length].decode())
+            pos += length
+        if pos > end:
+            raise AstFormatError("truncated compiled script")
+
+        while pos < end:
+            tag = data[pos]
+            pos += 1
+            if tag >= TRUE:
+                if tag > FALSE:
+                    raise AstFormatError(f"unknown op {tag}")
+                stack.append(Lit(tag == TRUE))
+                continue
+            node, spec = NODES[tag]
+            match spec:
+                case "ee":
+                    right = stack.pop()
+                    stack[-1] = node(stack[-1], right)
+                case "e":
+                    stack[-1] = node(stack[-1])
+                case "n":
+                    stack.append(node(names[varint()]))
+                case "i":
+                    stack.append(node(integer()))
+                case "E":
+                    count = varint()
+                    if not 0 < count <= len(stack):
+                        raise AstFormatError("malformed compiled script")
+                    children = stack[len(stack) - count:]
+                    del stack[len(stack) - count:]
+                    stack.append(node(children))
+                case "T":
+                    stack.append(node([Note(names[varint()], integer()) for _ in range(varint())]))
+                case _:
+                    # the rest, in constructor order
+                    count = spec.count("e")
+                    if count > len(stack):
+                        raise AstFormatError("malformed compiled script")
+                    children = iter(stack[len(stack) - count:])
+                    del stack[len(stack) - count:]
+                    args = []
+                    for kind in spec:
+                        match kind:
+                            case "e":
+                                args.append(next(children))
+                            case "n":
+                                args.append(names[varint()])
+                            case "i":
+                                args.append(integer())
+                    stack.append(node(*args))
+    except (IndexError, UnicodeDecodeError):
+        raise AstFormatError("malformed compiled script")
+    if len(stack) != 1:
+        raise AstFormatError("malformed compiled script")
+    return stack[0]
+
+
+def writeCompiled(e: Expr, path: str) -> None:
+    with open(path, "wb") as file:
+        file.write(encodeAST(e))
+
+
+def readCompiled(path: str) -> Expr:
+    with open(path, "rb") as file:
+        return decodeAST(file.read())
+
+
+def main(argv: list[str]) -> int:
+    import argparse
+    from pathlib import Path
+
+    parser = argparse.ArgumentParser(description="compile scripts to the binary AST format")
+    parser.add_argument("scripts", nargs="+", help="scripts to compile")
+    parser.add_argument("-o", "--output", help="output file, for a single script "
+                        "(default: the script's name with .tast)")
+    args = parser.parse_args(argv)
+    if args.output is not None and len(args.scripts) > 1:
+        parser.error("-o needs a single script")
+
+    from contextlib import redirect_stdout
+    with redirect_stdout(None):
+        from parse_run import parseAST, ParseError, AmbiguousParse
+
+    status = 0
+    for script in args.scripts:
+        output = args.output or str(Path(script).with_suffix(".tast"))
+        try:
+            writeCompiled(parseAST(Path(script).read_text(), flat=True), output)
+        except (ParseError, AmbiguousParse, AstFormatError, OSError) as e:
+            print(f"{script}: {e}", file=sys.stderr)
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
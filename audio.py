@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# ==============================================================================
+# Offline audio rendering, for machines that have no midi player. Notes are
+# synthesised with NumPy a whole note at a time: each (pitch, length) wave is
+# built once as an array and added into the output as a slice. Long tunes are
+# cut into chunks of time rendered by a process pool.
+#
+#   python audio.py tune.mid tune.wav
+#
+# Like smf.py this module only deals in midi pitch numbers and beats. NumPy
+# is optional for the rest of the project and only needed here.
+# ==============================================================================
+
+import sys
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Iterable
+
+import smf
+
+try:
+    import numpy as np
+except ImportError:  # rendering raises AudioError instead
+    np = None
+
+SAMPLE_RATE = 44100
+SAMPLES_PER_BEAT = SAMPLE_RATE * 60 / smf.TEMPO
+AMPLITUDE = 0.3  # peak level of a single voice, 1.0 being full scale
+HARMONICS = (1.0, 0.4, 0.15)  # relative levels of the first partials
+ATTACK = 0.005  # seconds
+RELEASE = 0.02  # seconds
+CHUNK_SECONDS = 30  # of audio per task when rendering in parallel
+
+
+class AudioError(Exception):
+    """Audio Rendering Failure"""
+    pass
+
+
+def frequency(pitch: int) -> float:
+    """Equal temperament, A4 (midi 69) at 440 Hz"""
+    return 440.0 * 2 ** ((pitch - 69) / 12)
+
+
+@lru_cache(maxsize=512)
+def noteWave(pitch: int, length: int) -> "np.ndarray":
+    """One note of length samples, with its envelope applied"""
+    t = np.arange(length, dtype=np.float32) / np.float32(SAMPLE_RATE)
+    phase = np.float32(2 * np.pi * frequency(pitch)) * t
+    wave = np.zeros(length, dtype=np.float32)
+    for k, level in enumerate(HARMONICS, 1):
+        wave += np.float32(level / sum(HARMONICS)) * np.sin(np.float32(k) * phase)
+    i = np.arange(length, dtype=np.float32)
+    envelope = np.minimum(
+        1, np.minimum(i / np.float32(ATTACK * SAMPLE_RATE),
+                      (length - i) / np.float32(RELEASE * SAMPLE_RATE))
+    )
+    wave *= envelope
+    wave.flags.writeable = False
+    return wave
+
+
+def noteSamples(notes: Iterable[tuple[int, int, int]]) -> "np.ndarray":
+    """(start, pitch, duration) in beats to rows of (start, end, pitch) in
+    samples, without the notes that make no sound"""
+    rows = np.array(
+        [(start, start + duration, pitch) for start, pitch, duration in notes if duration > 0],
+        dtype=np.int64
+    ).reshape(-1, 3)
+    rows[:, :2] = np.rint(rows[:, :2] * SAMPLES_PER_BEAT)
+    return rows
+
+
+def polyphony(rows: "np.ndarray") -> int:
+    """The most notes sounding at once"""
+    if not len(rows):
+        return 0
+    times = np.concatenate([rows[:, 1], rows[:, 0]])
+    steps = np.concatenate([-np.ones(len(rows), np.int64), np.ones(len(rows), np.int64)])
+    order = np.lexsort((steps, times))  # ends before starts at equal times
+    return int(np.cumsum(steps[order]).max())
+
+
+def renderChunk(rows: "np.ndarray", start: int, end: int, gain: float) -> bytes:
+    """16-bit samples from start to end of the notes in rows"""
+    out = np.zeros(end - start, dtype=np.float32)
+    for s, e, pitch in rows.tolist():
+        lo, hi = max(s, start), min(e, end)
+        if lo < hi:
+            out[lo - start:hi - start] += noteWave(pitch, e - s)[lo - s:hi - s]
+    out *= np.float32(gain)
+    np.clip(out, -1, 1, out=out)
+    return (out * 32767).astype("<i2").tobytes()
+
+
+def renderAudio(notes: Iterable[tuple[int, int, int]], workers: int | None = 1,
+                chunk_seconds: float = CHUNK_SECONDS) -> bytes:
+    """Renders (start, pitch, duration) notes in beats to mono 16-bit
+    samples. More than one worker splits the audio into chunks of time."""
+    if np is None:
+        raise AudioError("audio rendering needs numpy")
+    rows = noteSamples(notes)
+    length = int(rows[:, 1].max()) if len(rows) else 0
+    gain = AMPLITUDE / max(1, polyphony(rows))
+    chunk = int(chunk_seconds * SAMPLE_RATE)
+    if workers == 1 or length <= chunk:
+        return renderChunk(rows, 0, length, gain)
+
+    bounds = [(i, min(i + chunk, length)) for i in range(0, length, chunk)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=smf.POOL_CONTEXT) as pool:
+        parts = pool.map(
+            renderChunk,
+            [rows[(rows[:, 0] < e) & (rows[:, 1] > s)] for s, e in bounds],
+            *zip(*bounds), [gain] * len(bounds)
+        )
+        return b"".join(parts)
+
+
+def writeWav(notes: Iterable[tuple[int, int, int]], name: str,
+             workers: int | None = 1) -> None:
+    samples = renderAudio(notes, workers)
+    with wave.open(name, "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(SAMPLE_RATE)
+        file.writeframes(samples)
+
+
+def main(argv: list[str]) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="render a midi file to a wav file")
+    parser.add_argument("midi", help="midi file to render")
+    parser.add_argument("wav", help="wav file to write")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes")
+    args = parser.parse_args(argv)
+    try:
+        writeWav(smf.readNotes(args.midi), args.wav, args.jobs)
+    except (AudioError, smf.MidiFormatError, OSError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# ==============================================================================
+# Batch midi rendering across a process pool. Tunes travel to the workers in
+# the archive format (see archive.py) rather than as pickled notes, a chunk of
+# jobs at a time, and the workers encode and write the files themselves.
+#
+#   python batch.py -o out/ -j 8 tunes.tuna examples/one.example ...
+#
+# Every tune of a .tuna archive is written to out/<name>-<index>.mid, any
+# other file is run as a script and its value written to out/<name>.mid.
+# Scripts compiled by astcode.py (.tast) are run without loading the parser.
+# ==============================================================================
+
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable
+
+import archive
+import interp
+import smf
+from interp import Tune, Timeline
+
+CHUNK_SIZE = 64  # jobs per task sent to a worker
+EMPTY_TIMELINE = -1  # shape of a timeline with no voices, which packs nothing
+
+
+@dataclass
+class BatchResult:
+    """Outcome of rendering one tune"""
+    path: str
+    error: str | None = None
+    def __str__(self) -> str:
+        if self.error is None:
+            return f"ok {self.path}"
+        return f"error {self.path}: {self.error}"
+
+
+def packChunk(jobs: list[tuple[Tune | Timeline, str]]) -> tuple[bytes, list[int]]:
+    """Packs the tunes of a chunk into one archive. A timeline is stored as
+    its voices, so the shape records how many entries each job takes, with
+    0 for a plain tune and EMPTY_TIMELINE for a timeline of no voices."""
+    tunes = []
+    shape = []
+    for v, _ in jobs:
+        match v:
+            case Tune():
+                tunes.append(v)
+                shape.append(0)
+            case Timeline(parts):
+                tunes += (Tune([note for _, note in part]) for part in parts)
+                shape.append(len(parts) or EMPTY_TIMELINE)
+            case _:
+                raise interp.EvalError(f"expected tune, got {v}")
+    return archive.encodeArchive(tunes), shape
+
+
+def renderChunk(payload: bytes, shape: list[int], paths: list[str]) -> list[str | None]:
+    """Worker side: writes every job of a packed chunk, returning an error
+    message or None for each one"""
+    tunes = archive.Archive(payload)
+    pitches = [interp.MIDI_PITCH.get(name) for name in tunes.names]
+    errors = []
+    i = 0
+    for parts, path in zip(shape, paths):
+        entries = 1 if parts == 0 else max(parts, 0)
+        try:
+            if parts == 0:
+                notes = tunes[i].notes
+                smf.writeNotes(
+                    zip(map(pitches.__getitem__, notes.pitches), notes.durations),
+                    path
+                )
+            else:
+                voices = [interp.timelineParts(tunes[j])[0] for j in range(i, i + entries)]
+                interp.writeTimelineMidi(Timeline(voices), path)
+            errors.append(None)
+        except Exception as e:
+            errors.append(f"{type(e).__name__}: {e}")
+        i += entries
+    return errors
+
+
+def renderBatch(jobs: Iterable[tuple[Tune | Timeline, str]],
+                workers: int | None = None,
+                chunk_size: int = CHUNK_SIZE) -> list[BatchResult]:
+    """Renders (tune, path) pairs across a process pool. Results come back
+    in the order of the jobs, with a per-job error instead of an exception."""
+    results: list[BatchResult] = []
+    futures = []
+
+    def submit(pool: ProcessPoolExecutor, chunk: list[tuple[Tune | Timeline, str]]):
+        try:
+            payload, shape = packChunk(chunk)
+        except Exception as e:
+            if len(chunk) > 1:
+                # find the job that cannot be packed without failing the rest
+                for job in chunk:
+                    submit(pool, [job])
+            else:
+                results.append(BatchResult(chunk[0][1], f"{type(e).__name__}: {e}"))
+            return
+        paths = [path for _, path in chunk]
+        futures.append((len(results), paths, pool.submit(renderChunk, payload, shape, paths)))
+        results.extend(BatchResult(path) for path in paths)
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=smf.POOL_CONTEXT) as pool:
+        chunk = []
+        for job in jobs:
+            chunk.append(job)
+            if len(chunk) >= chunk_size:
+                submit(pool, chunk)
+                chunk = []
+        if chunk:
+            submit(pool, chunk)
+
+        for start, paths, future in futures:
+            try:
+                errors = future.result()
+            except Exception as e:
+                errors = [f"{type(e).__name__}: {e}"] * len(paths)
+            for i, error in enumerate(errors, start):
+                results[i].error = error
+    return results
+
+
+def runScript(path: str) -> Tune | Timeline:
+    if path.endswith(".tast"):
+        import astcode
+        return interp.eval(astcode.readCompiled(path))
+    from pathlib import Path
+    from parse_run import parseCached
+    return interp.eval(parseCached(Path(path).read_text()))
+
+
+def main(argv: list[str]) -> int:
+    import argparse
+    import contextlib
+
+    parser = argparse.ArgumentParser(description="render tunes to midi files")
+    parser.add_argument("files", nargs="+", help="tune archives, scripts or compiled scripts")
+    parser.add_argument("-o", "--output", default=".", help="output directory")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output, exist_ok=True)
+    jobs = []
+    failed = []
+    for file in args.files:
+        stem = os.path.splitext(os.path.basename(file))[0]
+        try:
+            if file.endswith(".tuna"):
+                for i, tune in enumerate(archive.openArchive(file)):
+                    jobs.append((tune, os.path.join(args.output, f"{stem}-{i}.mid")))
+            else:
+                with contextlib.redirect_stdout(sys.stderr):
+                    jobs.append((runScript(file), os.path.join(args.output, f"{stem}.mid")))
+        except Exception as e:
+            failed.append(BatchResult(file, f"{type(e).__name__}: {e}"))
+
+    results = failed + renderBatch(jobs, args.jobs)
+    for result in results:
+        print(result)
+    return 1 if any(result.error for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
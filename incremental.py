@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+# ==============================================================================
+# Incremental reparsing, for editors that reparse on every keystroke. A
+# script is kept as its top-level statements (the spans between ";"), and the
+# body of a statement that is a whole "let ... in BODY end" is kept the same
+# way. After an edit only the statements it touches are lexed and parsed
+# again, up to the first ";" past the edit that was already a boundary;
+# every other statement keeps its AST.
+#
+#   script = parseScript(text)
+#   script = reparse(script, start, end, "new text")
+#   script.ast, script.changed
+#
+# Statements are parsed by pratt.py. The result is always the AST a full
+# parse of the new text gives, or the same ParseError: where the statements
+# cannot be told apart (a keyword used as a name), the whole text is parsed.
+#
+# readStatements splits a script the same way as it reads it, for running
+# scripts too large to hold in memory a statement at a time.
+# ==============================================================================
+
+from bisect import bisect_right
+from dataclasses import dataclass, field, replace
+from typing import Iterator, TextIO
+
+import pratt
+from pratt import ParseError, Parser, IF, KEYWORDS, RESERVED, TOKEN, PATH
+from interp import Expr, Let, Letfun, Seq, seqAll
+
+CHUNK_SIZE = 1 << 20  # characters read at a time by readStatements
+
+# tokens that open and close a level in which ";" does not end a statement
+OPEN = frozenset(("(", "[", "let", "letfun", "if"))
+CLOSE = frozenset((")", "]", "end", "else"))
+
+
+class Unbalanced(Exception):
+    """Nesting that does not close where it should"""
+    pass
+
+
+@dataclass(frozen=True)
+class Statement:
+    """A span of source between separators, as its length. A statement
+    that is a whole let ... end also has the block of its body."""
+    length: int
+    ast: Expr
+    body_start: int = 0  # from the start of the statement
+    body: "Block | None" = None
+
+
+@dataclass(frozen=True)
+class Block:
+    """Statements separated by ";", each starting at an offset from the
+    start of the block"""
+    starts: list[int]
+    statements: list[Statement]
+    length: int
+    flat: bool
+    ast: Expr = field(init=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "ast", sequence([s.ast for s in self.statements], self.flat))
+
+
+@dataclass(frozen=True)
+class Script:
+    """A parsed script, and the top-level statements the last edit changed"""
+    text: str
+    block: Block
+    changed: list[Expr]
+
+    @property
+    def ast(self) -> Expr:
+        return self.block.ast
+
+
+def sequence(exprs: list[Expr], flat: bool) -> Expr:
+    """The statements as one expression, as the parser builds it"""
+    if len(exprs) == 1:
+        return exprs[0]
+    if flat:
+        return seqAll(exprs)
+    e = exprs[-1]
+    for expr in reversed(exprs[:-1]):
+        e = Seq(expr, e)
+    return e
+
+
+class Nesting:
+    """Lexes a script for its nesting, from pos on. A path is part of the
+    token before it, as only the parser knows where one is."""
+
+    def __init__(self, pos: int = 0):
+        self.pos = pos  # where the next token is lexed from
+        self.depth = 0  # after the last token
+        self.writes: list[int] = []  # depths of the writes yet to reach their ":"
+
+    def tokens(self, text: str, end: int, partial: bool = False) -> Iterator[tuple[str, int, int]]:
+        """(kind, start, stop) of the tokens up to end. With partial, text
+        goes on past end, so a token that reaches it is left to be lexed
+        again with the rest."""
+        while (match := TOKEN.match(text, self.pos, end)).lastgroup != "eof":
+            kind = match.lastgroup
+            start, stop = match.span(kind)
+            if kind == "word":
+                if match[kind] in KEYWORDS:
+                    kind = match[kind]
+                elif reserved := RESERVED.match(match[kind]):
+                    kind = reserved[0]
+                    stop = start + len(kind)
+            elif kind == "op":
+                kind = match[kind]
+            write = bool(self.writes) and self.writes[-1] == self.depth
+            if kind == ":=" and write:
+                kind, stop = ":", start + 1  # the path starts with the "="
+            path = kind in ("run", "load") or (kind == ":" and write)
+            if path and (match := PATH.match(text, stop, end)):
+                stop = match.end()
+            if partial and stop == end:
+                return
+            if path:
+                if kind == ":":
+                    self.writes.pop()
+            elif kind == "write":
+                self.writes.append(self.depth)
+            elif kind in OPEN:
+                self.depth += 1
+            elif kind in CLOSE:
+                self.depth -= 1
+            self.pos = stop
+            yield kind, start, stop
+
+
+def tokens(text: str, pos: int, end: int) -> Iterator[tuple[str, int, int, int]]:
+    """(kind, start, stop, depth) of the tokens of text[pos:end], depth
+    being the nesting after the token"""
+    nesting = Nesting(pos)
+    for kind, start, stop in nesting.tokens(text, end):
+        if nesting.depth < 0:
+            raise Unbalanced()
+        yield kind, start, stop, nesting.depth
+    if nesting.depth:
+        raise Unbalanced()
+
+
+def separators(text: str, pos: int, end: int) -> Iterator[int]:
+    """Where the top-level ";" are in text[pos:end]"""
+    for kind, start, _, depth in tokens(text, pos, end):
+        if kind == ";" and depth == 0:
+            yield start
+
+
+def letBody(text: str) -> tuple[int, int] | None:
+    """Where the body is, when a statement is a whole let ... in BODY end"""
+    body_start = None
+    last = None
+    for kind, start, stop, depth in tokens(text, 0, len(text)):
+        if last is None and kind not in ("let", "letfun"):
+            return None
+        if kind == "in" and depth == 1 and body_start is None:
+            body_start = stop
+        if last is not None and last[3] == 0:
+            return None  # something after the end
+        last = (kind, start, stop, depth)
+    if body_start is None or last[0] != "end":
+        return None
+    return body_start, last[1]
+
+
+def openEnded(text: str) -> bool:
+    """Whether text ends in a comment or a path, which would run on into
+    whatever follows it"""
+    kind, stop = None, 0
+    for kind, _, stop, _ in tokens(text, 0, len(text)):
+        pass
+    if stop == len(text):
+        return kind in ("run", "load", ":")
+    return "#" in text[max(stop, text.rfind("\n") + 1):]
+
+
+def withBody(e: Let | Letfun, body: Expr) -> Expr:
+    return replace(e, bodyexpr=body) if isinstance(e, Let) else replace(e, inexpr=body)
+
+
+def parseStatement(text: str, flat: bool) -> Statement:
+    if (span := letBody(text)) is not None:
+        body_start, body_end = span
+        try:
+            body = parseBlock(text[body_start:body_end], flat)
+            header = Parser(text[:body_start] + " 0 end", flat).parse(IF)
+            if not isinstance(header, (Let, Letfun)):
+                raise Unbalanced()
+            return Statement(len(text), withBody(header, body.ast), body_start, body)
+        except (ParseError, Unbalanced):
+            pass  # parsed whole
+    return Statement(len(text), Parser(text, flat).parse(IF))
+
+
+def parseBlock(text: str, flat: bool) -> Block:
+    """Raises Unbalanced or ParseError where the statements cannot be
+    parsed one at a time"""
+    bounds = [0, *(p + 1 for p in separators(text, 0, len(text)))]
+    ends = [p - 1 for p in bounds[1:]] + [len(text)]
+    statements = [parseStatement(text[s:e], flat) for s, e in zip(bounds, ends)]
+    return Block(bounds, statements, len(text), flat)
+
+
+def editBlock(block: Block, text: str, a: int, b: int, n: int) -> tuple[Block, range]:
+    """The block after its old text[a:b] was replaced by n characters, now
+    text, and the indices of the statements that are new"""
+    delta = n - (b - a)
+    starts, statements = block.starts, block.statements
+    first = bisect_right(starts, a) - 1
+    last = bisect_right(starts, b) - 1
+
+    # an edit inside the body of a let ... end is made in the body
+    s = statements[first]
+    body_start = starts[first] + s.body_start
+    if first == last and s.body is not None and body_start < a and b < body_start + s.body.length:
+        try:
+            body_text = text[body_start:body_start + s.body.length + delta]
+            body, changed = editBlock(s.body, body_text, a - body_start, b - body_start, n)
+            # only a new last statement can run on into the "end"
+            if changed.stop == len(body.starts) and openEnded(body_text[body.starts[-1]:]):
+                raise Unbalanced()
+            statement = Statement(s.length + delta, withBody(s.ast, body.ast), s.body_start, body)
+            return Block(
+                starts[:first + 1] + [p + delta for p in starts[first + 1:]],
+                statements[:first] + [statement] + statements[first + 1:],
+                block.length + delta, block.flat
+            ), range(first, first + 1)
+        except (ParseError, Unbalanced):
+            pass  # the let itself has changed
+
+    # lex from the first statement touched to the first old boundary past
+    # the edit, which is where the old statements can be taken up again
+    bounds = [starts[first]]
+    resume = len(starts)
+    stop = len(text)
+    for p in separators(text, starts[first], len(text)):
+        if p >= a + n:
+            old = bisect_right(starts, p - delta + 1) - 1
+            if starts[old] == p - delta + 1 and old > last:
+                resume, stop = old, p
+                break
+        bounds.append(p + 1)
+    ends = [p - 1 for p in bounds[1:]] + [stop]
+    new = [parseStatement(text[s:e], block.flat) for s, e in zip(bounds, ends)]
+    return Block(
+        starts[:first] + bounds + [p + delta for p in starts[resume:]],
+        statements[:first] + new + statements[resume:],
+        block.length + delta, block.flat
+    ), range(first, first + len(new))
+
+
+def wholeScript(text: str, flat: bool) -> Script:
+    """A script parsed as a single statement, when it cannot be split"""
+    e = pratt.parse(text, flat)
+    return Script(text, Block([0], [Statement(len(text), e)], len(text), flat), [e])
+
+
+def parseScript(text: str, flat: bool = False) -> Script:
+    try:
+        block = parseBlock(text, flat)
+    except (ParseError, Unbalanced):
+        return wholeScript(text, flat)
+    return Script(text, block, [s.ast for s in block.statements])
+
+
+def reparse(script: Script, start: int, end: int, new: str) -> Script:
+    """The script with text[start:end] replaced by new. Raises ParseError,
+    leaving the old script as it was, if the new text does not parse."""
+    if not 0 <= start <= end <= len(script.text):
+        raise ValueError(f"edit {start}:{end} is outside the script")
+    text = script.text[:start] + new + script.text[end:]
+    try:
+        block, changed = editBlock(script.block, text, start, end, len(new))
+    except (ParseError, Unbalanced):
+        return wholeScript(text, script.block.flat)
+    return Script(text, block, [block.statements[i].ast for i in changed])
+
+
+def readStatements(file: TextIO, flat: bool = False, chunk_size: int = CHUNK_SIZE) -> Iterator[Expr]:
+    """The top-level statements of a script, each parsed once the file has
+    been read up to the ";" after it. Only the statement being read is kept
+    in memory. A statement that does not parse raises ParseError when it is
+    reached, after the statements before it."""
+    buffer = ""
+    start = 0  # of the statement being read
+    nesting = Nesting()
+    line, column, mark = 1, 1, 0  # where buffer[mark] is in the file
+
+    def seek():
+        nonlocal line, column, mark
+        if lines := buffer.count("\n", mark, start):
+            line += lines
+            column = start - buffer.rfind("\n", mark, start)
+        else:
+            column += start - mark
+        mark = start
+
+    def statement(end: int, last: bool) -> Expr | None:
+        """The statement up to end, or None if it may go on past it"""
+        seek()
+        parser = Parser(buffer[start:end], flat, line, column)
+        try:
+            return parser.parse()
+        except ParseError:
+            # a ";" at depth 0 but in the statement, where a keyword is a name
+            if last or parser.kind != "eof":
+                raise
+            return None
+
+    while True:
+        data = file.read(chunk_size)
+        seek()
+        buffer = buffer[start:] + data
+        nesting.pos -= start
+        start = mark = 0
+        for kind, at, _ in nesting.tokens(buffer, len(buffer), partial=bool(data)):
+            nesting.depth = max(nesting.depth, 0)
+            if kind == ";" and nesting.depth == 0:
+                if (e := statement(at, False)) is not None:
+                    yield e
+                    start = at + 1
+        if not data:
+            yield statement(len(buffer), True)
+            return
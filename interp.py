@@ -5,13 +5,18 @@
 # suite defined in eval_domain.py. The README has more information.
 # ==============================================================================
 
-# NOTE: midiutil is included as suggested in the project information
-from midiutil import MIDIFile  # version 1.2.1
-
+import smf  # to write the midi
+import rendercache  # to avoid writing the same midi twice
+import writebehind  # to write the midi without waiting for it
+import playback  # to show tunes without waiting for them to play
+import player  # to play midi without a shell per file
 import os  # to play the midi
-import tempfile  # also to play the midi
-from dataclasses import dataclass
-from typing import Any
+from dataclasses import dataclass, fields, is_dataclass, replace
+from array import array
+from heapq import merge
+from itertools import islice, repeat
+from operator import attrgetter, itemgetter
+from typing import Any, Iterable, Iterator
 
 # ==============================================================================
 # TYPES
@@ -21,7 +26,8 @@ type Literal = int | bool | Note
 type Expr = (
     Lit | Add | Sub | Mul | Div | Neg | And | Or | Not | Eq
     | Neq | Lt | Gt | Leq | Geq | If | Let | Name | Note | Join
-    | Slice | Letfun | App | Assign | Seq | Show | Write
+    | Slice | Letfun | App | Assign | Seq | Show | Write | Par | Load
+    | Preview | JoinN | SeqN | TuneLit
 )
 
 type Loc[V] = list[V] # always a singleton list
@@ -45,6 +51,10 @@ def transposePitch(pitch: str, half_steps: int) -> str:
         return REST
 
 
+# midi note numbers for each pitch, starting from middle C
+MIDI_PITCH = {pitch: i + 60 for i, pitch in enumerate(CHROMATIC)}
+
+
 # DOMAIN SPECIFIC EXTENSION
 @dataclass
 class Note:
@@ -59,6 +69,15 @@ class Note:
         return f"({self.pitch}, {self.duration})"
 
 
+# DOMAIN SPECIFIC EXTENSION
+@dataclass
+class TuneLit:
+    """{Note, ...} Tune Literal"""
+    notes: list[Note]
+    def __str__(self) -> str:
+        return f"[{', '.join(map(str, self.notes))}]"
+
+
 # DOMAIN SPECIFIC EXTENSION
 @dataclass
 class Tune:
@@ -68,6 +87,18 @@ class Tune:
         return f"[{','.join(f'({note.pitch}, {note.duration})' for note in self.notes)}]"
 
 
+# DOMAIN SPECIFIC EXTENSION
+@dataclass
+class Timeline:
+    """{ ((Int, Note), ...), ... } Timeline"""
+    parts: list[list[tuple[int, Note]]]  # (start, note) per voice, by start
+    def __str__(self) -> str:
+        return " & ".join(
+            f"[{','.join(f'{start}:{note}' for start, note in part)}]"
+            for part in self.parts
+        )
+
+
 # DOMAIN SPECIFIC EXTENSION
 @dataclass
 class Join:
@@ -78,6 +109,25 @@ class Join:
         return f"({self.left} | {self.right})"
 
 
+# DOMAIN SPECIFIC EXTENSION
+@dataclass
+class JoinN:
+    """{Expr, ...} Join"""
+    parts: list[Expr]
+    def __str__(self) -> str:
+        return f"({' | '.join(map(str, self.parts))})"
+
+
+# DOMAIN SPECIFIC EXTENSION
+@dataclass
+class Par:
+    """{Expr, Expr} Parallel Composition"""
+    left: Expr
+    right: Expr
+    def __str__(self) -> str:
+        return f"({self.left} & {self.right})"
+
+
 # DOMAIN SPECIFIC EXTENSION
 @dataclass
 class Slice:
@@ -268,7 +318,7 @@ class App():
         return f"({self.fun} ({self.arg}))"
 
 
-type Value = Literal | Closure | Tune
+type Value = Literal | Closure | Tune | Timeline
 @dataclass
 class Closure:
     """Closure"""
@@ -297,6 +347,14 @@ class Seq:
         return f"({self.expr1}; {self.expr2})"
 
 
+@dataclass
+class SeqN:
+    """{Expr, ...} Sequence Expression"""
+    exprs: list[Expr]
+    def __str__(self) -> str:
+        return f"({'; '.join(map(str, self.exprs))})"
+
+
 @dataclass
 class Show:
     """Show Expression Value"""
@@ -329,6 +387,14 @@ class Run:
         return f"(run {self.name})"
 
 
+@dataclass
+class Load:
+    """Load Midi"""
+    name: str
+    def __str__(self) -> str:
+        return f"(load {self.name})"
+
+
 @dataclass
 class Repeat:
     """Repeat Tune"""
@@ -346,6 +412,16 @@ class Reverse:
         return f"(reverse {self.tune})"
 
 
+@dataclass
+class Preview:
+    """Tune Prefix"""
+    limit: int
+    unit: str  # "beats" or "notes"
+    tune: Expr
+    def __str__(self) -> str:
+        return f"(preview {self.limit} {self.unit} {self.tune})"
+
+
 class EvalError(Exception):
     """Invalid Expressions"""
     pass
@@ -388,11 +464,108 @@ def setLoc[V](loc: Loc[V], value: V) -> None:
     loc[0] = value
 
 
-def eval(e: Expr) -> (Literal|Tune):
-    return evalInEnv(emptyEnv, e)
+# DOMAIN SPECIFIC EXTENSION
+def joinAll(parts: list[Expr]) -> Expr:
+    """A single node joining parts, with joins among them spliced in. Parts
+    that are all notes become a tune literal."""
+    flat = []
+    for part in parts:
+        flat.extend(part.parts if isinstance(part, JoinN) else [part])
+    if all(isinstance(part, Note | TuneLit) for part in flat):
+        return TuneLit([
+            note for part in flat
+            for note in (part.notes if isinstance(part, TuneLit) else [part])
+        ])
+    return JoinN(flat)
+
+
+def seqAll(exprs: list[Expr]) -> Expr:
+    """A single node sequencing exprs, with sequences among them spliced in"""
+    flat = []
+    for expr in exprs:
+        flat.extend(expr.exprs if isinstance(expr, SeqN) else [expr])
+    return SeqN(flat)
+
+
+def flatten(e: Expr) -> Expr:
+    """Turns chains of binary Join and Seq into single JoinN and SeqN nodes
+    (see joinAll and seqAll). The AST is walked with a stack of its own, so
+    the chains can be any length."""
+    done: list[Expr] = []  # flattened subexpressions, in order
+    todo: list[tuple[Expr, list[Expr] | None]] = [(e, None)]
+    while todo:
+        node, children = todo.pop()
+        if children is None:
+            todo.append((node, children := subexprs(node)))
+            todo.extend((child, None) for child in reversed(children))
+            continue
+        args = done[len(done) - len(children):]
+        del done[len(done) - len(children):]
+        match node:
+            case Join():
+                done.append(joinAll(args))
+            case Seq():
+                done.append(seqAll(args))
+            case _ if args:
+                names = [f.name for f in fields(node) if is_dataclass(getattr(node, f.name))]
+                done.append(replace(node, **dict(zip(names, args))))
+            case _:
+                done.append(node)
+    return done[0]
+
+
+def subexprs(e: Expr) -> list[Expr]:
+    """The children of a node, or every link of a Join or Seq chain"""
+    match e:
+        case Join() | Seq():
+            chain = type(e)
+            parts = []
+            while isinstance(e, chain):
+                parts.append(e.left if chain is Join else e.expr1)
+                e = e.right if chain is Join else e.expr2
+            parts.append(e)
+            return parts
+        case _:
+            return [value for f in fields(e) if is_dataclass(value := getattr(e, f.name))]
+
+
+def timelineParts(v: Tune | Timeline) -> list[list[tuple[int, Note]]]:
+    """Returns the voices of a timeline, a tune being a single voice"""
+    match v:
+        case Timeline(parts):
+            return parts
+        case Tune(notes):
+            part = []
+            start = 0
+            for note in notes:
+                part.append((start, note))
+                start += note.duration
+            return [part]
 
 
-def evalInEnv(env: Env[Literal], e: Expr) -> (Literal|Tune):
+def eval(e: Expr) -> (Literal|Tune|Timeline):
+    return evalStatements([e])
+
+
+def evalStatements(statements: Iterable[Expr]) -> (Literal|Tune|Timeline):
+    """Evaluates top-level statements one after the other, giving the value
+    of the last. The writes they queued are finished before this returns,
+    or raises: a failure to write is printed if something else failed."""
+    v = None
+    try:
+        for e in statements:
+            v = evalInEnv(emptyEnv, e)
+    except BaseException:
+        try:
+            flushWrites()
+        except RuntimeError as failed:
+            print(failed)
+        raise
+    flushWrites()
+    return v
+
+
+def evalInEnv(env: Env[Literal], e: Expr) -> (Literal|Tune|Timeline):
     def isInt(*args) -> bool:
         return all(type(x) is int for x in args)
 
@@ -407,6 +580,10 @@ def evalInEnv(env: Env[Literal], e: Expr) -> (Literal|Tune):
         case Note(pitch, duration):
             return Tune([Note(pitch, duration)])
 
+        # DOMAIN SPECIFIC EXTENSION
+        case TuneLit(notes):
+            return Tune(notes.copy())
+
         # Arithmetic Operators
         # --------------------
 
@@ -628,6 +805,31 @@ def evalInEnv(env: Env[Literal], e: Expr) -> (Literal|Tune):
                 case _:
                     raise EvalError("non-joinable type")
 
+        case JoinN(parts):
+            # DOMAIN SPECIFIC EXTENSION
+            # join any number of tunes into a list allocated once
+            values = [evalInEnv(env, part) for part in parts]
+            if not all(isinstance(v, Tune) for v in values):
+                raise EvalError("non-joinable type")
+            notes = [None] * sum(len(v.notes) for v in values)
+            i = 0
+            for v in values:
+                notes[i:i + len(v.notes)] = v.notes
+                i += len(v.notes)
+            return Tune(notes)
+
+        # Parallel Composition (represented by '&')
+        # -----------------------------------------
+
+        case Par(l, r):
+            # DOMAIN SPECIFIC EXTENSION
+            # layer tunes and timelines as separate voices
+            match (evalInEnv(env, l), evalInEnv(env, r)):
+                case (Tune() | Timeline() as l, Tune() | Timeline() as r):
+                    return Timeline(timelineParts(l) + timelineParts(r))
+                case _:
+                    raise EvalError("non-layerable type")
+
         # Slice (represented by [:])
         # -------------------------
 
@@ -679,24 +881,29 @@ def evalInEnv(env: Env[Literal], e: Expr) -> (Literal|Tune):
             evalInEnv(env, e1)
             return evalInEnv(env, e2)
 
+        case SeqN(exprs):
+            for expr in exprs[:-1]:
+                evalInEnv(env, expr)
+            return evalInEnv(env, exprs[-1])
+
         # Show Expression Value
         # ---------------------
 
-        case Show(e):
-            v = evalInEnv(env, e)
-            match v:
-                case Tune(notes):
-                    print(notes)
-                    try:
-                        with tempfile.NamedTemporaryFile(suffix=".mid") as file:
-                            writeMidi(notes, file.name)
-                            runMidi(file.name)
-                    except Exception as e:
-                        print(f"failed to play tune: {e}")
-                case _:
-                    print(v)
+        case Show(e) if previewLimit:
+            # a tune that streamInEnv can walk is only evaluated as far as
+            # the preview reaches; show gives the preview, not the whole tune
+            if isinstance(e, Note | Join | JoinN | Repeat | Reverse | Slice | TuneLit):
+                return showValue(previewInEnv(env, e, *previewLimit))
+            return showValue(previewValue(evalInEnv(env, e), *previewLimit))
+
+        case Show(Join() | JoinN() | Repeat() | Slice() as e) if streamingShow:
+            v = streamShow(env, e)
+            print(v.notes)
             return v
 
+        case Show(e):
+            return showValue(evalInEnv(env, e))
+
         # Read Integer
         # ------------
 
@@ -712,9 +919,12 @@ def evalInEnv(env: Env[Literal], e: Expr) -> (Literal|Tune):
 
         case Write(e, name):
             match(evalInEnv(env, e)):
-                case Tune(notes):
+                case Tune() | Timeline() as v:
+                    if writeBehind is not None:
+                        writeBehind.submit(snapshot(v), name)
+                        return True
                     try:
-                        writeMidi(notes, name)
+                        rewriteMidi(v, name)
                         return True
                     except Exception as e:
                         raise RuntimeError(f"Failed to write Midi: {e}")
@@ -722,12 +932,20 @@ def evalInEnv(env: Env[Literal], e: Expr) -> (Literal|Tune):
                     raise RuntimeError("Expected Tune")
 
         case Run(name):
+            flushWrites(name)
             try:
                 runMidi(name)
                 return True
             except Exception as e:
                 raise RuntimeError(f"Failed to run Midi: {e}")
 
+        case Load(name):
+            flushWrites(name)
+            try:
+                return readMidi(name)
+            except Exception as e:
+                raise RuntimeError(f"Failed to load Midi: {e}")
+
         # Repeat and Reverse
         # ------------------
 
@@ -745,6 +963,9 @@ def evalInEnv(env: Env[Literal], e: Expr) -> (Literal|Tune):
                 case _:
                     raise EvalError("expected tune")
 
+        case Preview(limit, unit, tune):
+            return previewInEnv(env, tune, limit, unit)
+
         # Invalid Expression
         # ------------------
 
@@ -753,49 +974,477 @@ def evalInEnv(env: Env[Literal], e: Expr) -> (Literal|Tune):
 
     return # type: ignore
 
-def writeMidi(notes: list[Note], name: str):
-    track = 0
-    channel = 0
-    time = 0  # In beats
-    tempo = 250  # In BPM
-    volume = 100  # 0-127, as per the MIDI standard
+def streamInEnv(env: Env[Literal], e: Expr, complete: bool = True,
+                backwards: bool = False) -> Iterator[Note]:
+    """The notes of a tune expression, produced as they are needed. Joins,
+    Repeat and Slice are walked lazily, so the first notes come out before
+    the rest of the tune is evaluated. Anything else is evaluated whole.
+    Every part is still evaluated, in the same order as evalInEnv.
+
+    When complete is False, parts whose notes are never asked for are not
+    evaluated at all, and Reverse is walked lazily too by producing its
+    tune backwards (the right side of a join is then evaluated first)."""
+    lazy = Note | Join | JoinN | Repeat | Slice
+    if not complete:
+        lazy |= Reverse
+
+    def tuneNotes(e: Expr, error: str, backwards: bool = backwards) -> Iterator[Note]:
+        if isinstance(e, lazy):
+            return streamInEnv(env, e, complete, backwards)
+        match evalInEnv(env, e):
+            case Tune(notes):
+                return iter(notes[::-1] if backwards else notes)
+            case _:
+                raise EvalError(error)
 
-    MyMIDI = MIDIFile(1)
-    MyMIDI.addTempo(track, time, tempo)
+    match e:
+        case Note(pitch, duration):
+            yield Note(pitch, duration)
 
-    for note in notes:
+        case Join(l, r):
+            first, second = (r, l) if backwards else (l, r)
+            yield from tuneNotes(first, "non-joinable type")
+            yield from tuneNotes(second, "non-joinable type")
+
+        case JoinN(parts):
+            for part in reversed(parts) if backwards else parts:
+                yield from tuneNotes(part, "non-joinable type")
+
+        case Reverse(tune):
+            yield from tuneNotes(tune, "expected tune", not backwards)
+
+        case Repeat(count, tune):
+            count = evalInEnv(env, count)
+            notes = tuneNotes(tune, "expected integer and tune")
+            if type(count) is not int:
+                raise EvalError("expected integer and tune")
+            if count <= 0:
+                for _ in notes if complete else ():
+                    pass
+                return
+            first = []
+            for note in notes:
+                first.append(note)
+                yield note
+            for _ in range(count - 1):
+                yield from first
+
+        case Slice(tune, Lit(start), Lit(end)) if (
+            type(start) is int and type(end) is int and start >= 0 and end >= 0
+        ):
+            notes = tuneNotes(tune, "non-sliceable type", False)
+            if backwards:
+                yield from reversed(list(islice(notes, start, end)))
+            else:
+                yield from islice(notes, start, end)
+            for _ in notes if complete else ():
+                pass
+
+        case _:
+            match evalInEnv(env, e):
+                case Tune(notes):
+                    yield from notes[::-1] if backwards else notes
+                case _:
+                    raise EvalError("expected tune")
+
+
+def previewInEnv(env: Env[Literal], e: Expr, limit: int, unit: str) -> Tune:
+    """The first limit notes or beats of a tune. Only as much of the tune
+    as the prefix needs is evaluated, and the last note is cut short to
+    end on the limit."""
+    return Tune(previewNotes(streamInEnv(env, e, complete=False), limit, unit))
+
+
+def previewNotes(notes: Iterator[Note], limit: int, unit: str) -> list[Note]:
+    if unit == "notes":
+        return list(islice(notes, max(limit, 0)))
+    prefix = []
+    beats = 0
+    while beats < limit and (note := next(notes, None)) is not None:
+        if note.duration > limit - beats:
+            note = Note(note.pitch, limit - beats)
+        prefix.append(note)
+        beats += note.duration
+    return prefix
+
+
+def previewValue(v: Literal | Tune | Timeline, limit: int, unit: str) -> Literal | Tune | Timeline:
+    """The first limit notes or beats of a value already evaluated. A
+    timeline keeps the notes of every voice that start in the prefix, in
+    the order they start."""
+    match v:
+        case Tune(notes):
+            return Tune(previewNotes(iter(notes), limit, unit))
+        case Timeline(parts):
+            if unit == "notes":
+                voices = (zip(repeat(voice), part) for voice, part in enumerate(parts))
+                kept = islice(merge(*voices, key=lambda v: v[1][0]), max(limit, 0))
+                prefix = [[] for _ in parts]
+                for voice, entry in kept:
+                    prefix[voice].append(entry)
+            else:
+                prefix = [
+                    [(start, Note(note.pitch, min(note.duration, limit - start)))
+                     for start, note in part if start < limit]
+                    for part in parts
+                ]
+            return Timeline([part for part in prefix if part])
+        case _:
+            return v
+
+
+def midiNotes(notes: Iterable[Note]) -> Iterator[tuple[int | None, int]]:
+    """(midi pitch, duration) pairs for the encoder, with None for rests.
+    Lists are walked twice to avoid building a tuple per note, anything
+    else is consumed exactly once."""
+    if isinstance(notes, list):
+        pitches = map(MIDI_PITCH.get, map(attrgetter("pitch"), notes))
+        durations = map(attrgetter("duration"), notes)
+        return zip(pitches, durations)
+    return ((MIDI_PITCH.get(note.pitch), note.duration) for note in notes)
+
+
+PARALLEL_NOTES = 1 << 21  # lists this long are encoded across processes
+
+
+def packNotes(notes: list[Note]) -> tuple[bytes, array]:
+    """Packed midi pitches and durations for the parallel encoder"""
+    pitches = map(attrgetter("pitch"), notes)
+    return (
+        bytes(map(MIDI_PITCH.get, pitches, repeat(smf.REST_CODE))),
+        array("q", map(attrgetter("duration"), notes)),
+    )
+
+
+def writeMidi(notes: Iterable[Note], name: str, workers: int | None = None):
+    """Streams notes from a list or any iterator into a midi file, so memory
+    use stays flat however long the tune is. Very long lists are encoded in
+    pieces across worker processes instead when there is more than one."""
+    if (
+        isinstance(notes, list) and len(notes) >= PARALLEL_NOTES
+        and (workers or os.cpu_count() or 1) > 1
+    ):
         try:
-            pitch = CHROMATIC.index(note.pitch) + 60
-            duration = note.duration
-            MyMIDI.addNote(track, channel, pitch, time, duration, volume)
-        except Exception:
+            pitches, durations = packNotes(notes)
+        except OverflowError:
             pass
+        else:
+            body = smf.encodeParallel(pitches, durations, workers)
+            return smf.writeChunks([body], name)
+    smf.writeNotes(midiNotes(notes), name)
+
+
+def timelineEvents(timeline: Timeline) -> Iterator[smf.Event]:
+    """The note events of every voice of a timeline, merged while streaming
+    so they are never sorted as a whole"""
+    parts = (
+        (
+            (start, MIDI_PITCH[note.pitch], note.duration)
+            for start, note in part
+            if note.pitch in MIDI_PITCH
+        )
+        for part in timeline.parts
+    )
+    return smf.mergeParts(parts)
+
+
+def writeTimelineMidi(timeline: Timeline, name: str):
+    """Writes every voice of a timeline into one track"""
+    smf.writeEvents(timelineEvents(timeline), name)
+
+
+def audioNotes(v: Tune | Timeline) -> Iterator[tuple[int, int, int]]:
+    """(start, midi pitch, duration) in beats of every note of a tune or
+    timeline that sounds, as audio.py takes them"""
+    for part in timelineParts(v):
+        for start, note in part:
+            if (pitch := MIDI_PITCH.get(note.pitch)) is not None:
+                yield start, pitch, note.duration
+
+
+def writeWav(v: Tune | Timeline, name: str, workers: int | None = 1):
+    """Renders a tune or timeline straight to a wav file, with the exact
+    beats of its notes rather than the ticks of a midi file"""
+    import audio  # numpy is only loaded when audio is rendered
+    audio.writeWav(audioNotes(v), name, workers)
+
+
+# set INTERP_RENDER_CACHE to a directory to keep rendered files across runs
+renderCache = rendercache.RenderCache(os.environ.get("INTERP_RENDER_CACHE"))
+
+
+def renderKey(v: Tune | Timeline) -> str:
+    """Content hash of everything that decides the bytes of a midi file"""
+    params = (type(v).__name__, smf.TEMPO, smf.VOLUME)
+    match v:
+        case Tune(notes):
+            return rendercache.contentKey(
+                params,
+                " ".join(map(attrgetter("pitch"), notes)),
+                map(attrgetter("duration"), notes),
+            )
+        case Timeline(parts):
+            fields = []
+            for part in parts:
+                notes = list(map(itemgetter(1), part))
+                fields += [
+                    map(itemgetter(0), part),
+                    " ".join(map(attrgetter("pitch"), notes)),
+                    map(attrgetter("duration"), notes),
+                ]
+            return rendercache.contentKey(params, *fields)
+
+
+def renderMidi(v: Tune | Timeline, name: str):
+    """Writes a tune or timeline to a midi file, serving repeats from the
+    render cache. Very long tunes are streamed straight to the file."""
+    match v:
+        case Tune(notes):
+            if len(notes) > rendercache.MAX_NOTES:
+                return writeMidi(notes, name)
+            encode = lambda: bytes(smf.encodeMidi(midiNotes(notes)))
+        case Timeline(parts):
+            if sum(map(len, parts)) > rendercache.MAX_NOTES:
+                return writeTimelineMidi(v, name)
+            encode = lambda: bytes(smf.encodeEvents(timelineEvents(v)))
+    renderCache.writeFile(renderKey(v), encode, name)
+
+
+def encodeShow(v: Tune | Timeline) -> bytes:
+    """Encodes a tune or timeline in memory for playback, serving repeats
+    from the render cache"""
+    match v:
+        case Tune(notes):
+            encode = lambda: bytes(smf.encodeMidi(midiNotes(notes)))
+            if len(notes) > rendercache.MAX_NOTES:
+                return encode()
+        case Timeline(parts):
+            encode = lambda: bytes(smf.encodeEvents(timelineEvents(v)))
+            if sum(map(len, parts)) > rendercache.MAX_NOTES:
+                return encode()
+    return renderCache.render(renderKey(v), encode)
+
+
+midiRewriter = smf.TrackRewriter()
+
+
+def rewriteMidi(v: Tune | Timeline, name: str):
+    """Writes a tune to a midi file that may hold an earlier version of it.
+    When this process wrote the file last and nothing has touched it since,
+    only the track from the first changed note on is rewritten."""
+    match v:
+        case Tune(notes):
+            try:
+                pitches, durations = packNotes(notes)
+            except OverflowError:
+                midiRewriter.forget(name)
+                return renderMidi(v, name)
+            if not midiRewriter.rewrite(name, pitches, durations):
+                renderMidi(v, name)
+                midiRewriter.remember(name, pitches, durations)
+        case _:
+            midiRewriter.forget(name)
+            renderMidi(v, name)
 
-        time = time + note.duration
 
-    with open(name, "wb") as output_file:
-        MyMIDI.writeFile(output_file)
+# set INTERP_WRITE_BEHIND=1 to write midi files from a background thread
+writeBehind: writebehind.WriteBehind | None = None
 
 
-def runMidi(name: str):
-    if os.name != 'posix':
-        raise RuntimeError("non-POSIX system")
+def setWriteBehind(enabled: bool):
+    """Turns the background writer on or off. Turning it off waits for the
+    writes already queued."""
+    global writeBehind
+    if enabled and writeBehind is None:
+        writeBehind = writebehind.WriteBehind(rewriteMidi)
+    elif not enabled and writeBehind is not None:
+        try:
+            flushWrites()
+        finally:
+            writeBehind = None
+
+
+def flushWrites(name: str | None = None):
+    """Barrier for the background writer: returns once every queued write,
+    or every write to name, is done. Failed writes raise here."""
+    if writeBehind is None:
+        return
+    errors = writeBehind.flush(name)
+    if errors:
+        raise RuntimeError("; ".join(
+            f"Failed to write Midi {path}: {e}" for path, e in errors
+        ))
+
+
+def snapshot(v: Tune | Timeline) -> Tune | Timeline:
+    """A copy of a tune that later assignments cannot reach"""
+    match v:
+        case Tune(notes):
+            return Tune(list(notes))
+        case Timeline(parts):
+            return Timeline([list(part) for part in parts])
+
+
+setWriteBehind(bool(os.environ.get("INTERP_WRITE_BEHIND")))
+
+
+def readMidi(name: str) -> Tune | Timeline:
+    """Reads a midi file back into a tune. Pitches fold onto CHROMATIC and
+    gaps between notes become rests. Overlapping notes are spread over as
+    few voices as possible and give a timeline instead."""
+    voices: list[list[tuple[int, Note]]] = []
+    ends: list[int] = []
+    for start, pitch, duration in smf.readNotes(name):
+        for i, end in enumerate(ends):
+            if end <= start:
+                break
+        else:
+            i = len(voices)
+            voices.append([])
+            ends.append(0)
+        if start > ends[i]:
+            voices[i].append((ends[i], Note(REST, start - ends[i])))
+        voices[i].append((start, Note(CHROMATIC[pitch % 12], duration)))
+        ends[i] = start + duration
+
+    if len(voices) > 1:
+        return Timeline(voices)
+    return Tune([note for _, note in voices[0]] if voices else [])
+
+
+# shown tunes play in the background unless INTERP_SHOW_BLOCKING is set
+showQueue = playback.PlaybackQueue(lambda v: encodeShow(v),
+                                   lambda data: playMidi(data))
+blockingShow = bool(os.environ.get("INTERP_SHOW_BLOCKING"))
+
+
+# set INTERP_SHOW_STREAMING=1 to start playing joins, repeats and slices
+# while they are still being evaluated
+streamingShow = bool(os.environ.get("INTERP_SHOW_STREAMING"))
+# set INTERP_SHOW_LATENCY=1 to print the time to the first note of a stream
+showLatency = bool(os.environ.get("INTERP_SHOW_LATENCY"))
+lastStream: playback.NoteStream | None = None
+
+
+# every show is cut to (limit, unit), and gives the cut tune as its value
+previewLimit: tuple[int, str] | None = None
+
+
+def setPreview(limit: int | None, unit: str = "beats"):
+    """Caps show at the first limit beats or notes, or lifts the cap"""
+    global previewLimit
+    if unit not in ("beats", "notes"):
+        raise ValueError(f"unknown preview unit {unit}")
+    previewLimit = None if limit is None else (limit, unit)
+
+
+def setStreamingShow(streaming: bool):
+    global streamingShow
+    streamingShow = streaming
+
+
+def streamShow(env: Env[Literal], e: Expr) -> Tune:
+    """Shows a tune while it is evaluated: the player is handed a stream
+    that it starts on once the first notes are in"""
+    global lastStream
+    p = player.defaultPlayer()
+    if p is None or not p.streaming:
+        v = Tune(list(streamInEnv(env, e)))
+        showMidi(v, "tune")
+        return v
+
+    stream = lastStream = playback.NoteStream()
+    def play():
+        p.playEvents(smf.sequenceEvents(midiNotes(stream)))
+        if showLatency and stream.time_to_first_note is not None:
+            print(f"time to first note: {stream.time_to_first_note * 1000:.1f} ms")
+    showQueue.submitJob(play, "tune")
+    try:
+        for note in streamInEnv(env, e):
+            stream.put(note)
+    finally:
+        stream.close()
+    if blockingShow:
+        showQueue.drain()
+    return Tune(stream.notes)
+
+
+def waitForShows():
+    """Waits until every shown tune has played"""
+    showQueue.drain()
+
+
+def setBlockingShow(blocking: bool):
+    """Makes show wait for its tune to finish playing"""
+    global blockingShow
+    if blocking:
+        showQueue.drain()
+    blockingShow = blocking
+
+
+def showValue(v: Literal | Tune | Timeline) -> Literal | Tune | Timeline:
+    """Prints the value of a show, and plays it if it is a tune"""
+    match v:
+        case Tune(notes):
+            print(notes)
+            showMidi(v, "tune")
+        case Timeline():
+            print(v)
+            showMidi(v, "timeline")
+        case _:
+            print(v)
+    return v
+
+
+def showMidi(v: Tune | Timeline, label: str):
+    if not blockingShow:
+        showQueue.submit(snapshot(v), label)
+        return
+    try:
+        playMidi(encodeShow(v))
+    except Exception as e:
+        print(f"failed to play {label}: {e}")
+
 
-    if os.system("which vlc > /dev/null 2>&1") != 0:
-        raise RuntimeError("VLC player not found")
+def playMidi(data: bytes):
+    """Plays a midi file held in memory"""
+    if (p := player.defaultPlayer()) is None:
+        raise RuntimeError("no midi player found")
+
+    try:
+        p.playData(data)
+    except player.PlayerError as e:
+        raise RuntimeError(f"player error: {e}")
 
-    if os.system(f"[ -f {name} ] > /dev/null 2>&1") != 0:
+
+def runMidi(name: str):
+    if (p := player.defaultPlayer()) is None:
+        raise RuntimeError("no midi player found")
+
+    if not os.path.isfile(name):
         raise RuntimeError(f"no midi file {name}")
 
-    if os.system(f"vlc {name} > /dev/null 2>&1"):
-        raise RuntimeError(f"VLC error")
+    try:
+        p.play(name)
+    except player.PlayerError as e:
+        raise RuntimeError(f"player error: {e}")
 
 
 def run(e: Expr, pretty = True, write: bool = False):
-    if pretty:
-        print(f"running {e}")
+    runStatements([e], pretty, write)
+
+
+def runStatements(statements: Iterable[Expr], pretty = True, write: bool = False):
+    """run for a script given a top-level statement at a time, as read by
+    incremental.readStatements. Each is evaluated, and let go of, before
+    the next is taken."""
+    def announced(statements: Iterable[Expr]) -> Iterator[Expr]:
+        for e in statements:
+            print(f"running {e}")
+            yield e
+
     try:
-        match eval(e):
+        match evalStatements(announced(statements) if pretty else statements):
             case Tune(notes):
                 print(f"result: {Tune(notes)}")
 
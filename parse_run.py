@@ -5,23 +5,90 @@
 # suite defined in eval_domain.py. The README has more information.
 # ==============================================================================
 
-from lark import Lark, Token, ParseTree, Transformer
-from lark.exceptions import VisitError
+import hashlib
+import io
+import os
+import pickle
+import sys
+from lark import Lark, Token, Tree, ParseTree, Transformer, __version__ as lark_version
 from pathlib import Path
 
+from rendercache import RenderCache, contentKey, replaceFile
+import astcode
+import pratt
+from pratt import ParseError, UNBINDABLE
+
 from interp import (
     Literal, Note, Expr,
     Lit, Add, Sub, Mul, Div, Neg, And, Or, Not, Eq,
     Neq, Lt, Gt, Leq, Geq, If, Let, Name, Note, Join,
     Slice, Letfun, App, Assign, Seq, Show, Read,
-    Write, Run, Repeat, Reverse,
+    Write, Run, Repeat, Reverse, Par, Load, Preview,
+    TuneLit, flatten,
     run
 )
 
 
-#parser = Lark(Path('expr.lark').read_text(), parser='earley', ambiguity='explicit')
-#for checking against ambiguity:
-parser = Lark(Path('expr.lark').read_text(), parser='lalr', strict='True', debug='True')
+GRAMMAR = Path(__file__).with_name('expr.lark')
+# the parse tables built from the grammar are saved here and reused while
+# the grammar, lark and python stay the same
+PARSER_TABLES = os.environ.get('INTERP_PARSER_TABLES') or str(GRAMMAR.with_suffix('.lark.tables'))
+# set INTERP_PARSER_DEV=1 to build the parser from scratch with lark's strict
+# conflict checks and debug logging, as when changing the grammar
+PARSER_DEV = bool(os.environ.get('INTERP_PARSER_DEV'))
+# set INTERP_PARSER=pratt to have parseAST use the hand-written parser in
+# pratt.py instead of lark
+PARSER_FRONTEND = os.environ.get('INTERP_PARSER', 'lark')
+# scripts run by dofile and batch.py are parsed once and their ASTs kept here,
+# shared by every process; set INTERP_PARSE_CACHE to move it, or to nothing to
+# keep them in memory only
+PARSE_CACHE = os.environ.get(
+    'INTERP_PARSE_CACHE',
+    os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'interp', 'ast')
+) or None
+PARSE_CACHE_LIMIT = 256 << 20  # bytes of ASTs kept on disk
+
+
+def grammarKey(grammar: str) -> bytes:
+    """Identifies the tables of a grammar for this lark and python"""
+    key = hashlib.sha256(grammar.encode())
+    key.update(f"{lark_version} {sys.version_info[:2]}".encode())
+    return key.hexdigest().encode()
+
+
+def buildParser(dev: bool = PARSER_DEV, tables: str | None = PARSER_TABLES,
+                transformer: Transformer | None = None) -> Lark:
+    """Loads the parser from its saved tables, or builds it and saves them.
+    Tables that do not match the grammar are rebuilt. With a transformer
+    the parser calls it as each rule is reduced and returns its result
+    instead of a parse tree."""
+    grammar = GRAMMAR.read_text()
+    if dev:
+        #parser = Lark(grammar, parser='earley', ambiguity='explicit')
+        #for checking against ambiguity:
+        return Lark(grammar, parser='lalr', strict=True, debug=True, transformer=transformer)
+
+    key = grammarKey(grammar)
+    if tables is not None:
+        try:
+            with open(tables, 'rb') as file:
+                if file.readline().rstrip(b'\n') == key:
+                    # what Lark.load does, but it takes no transformer
+                    return Lark.__new__(Lark)._load(pickle.load(file), transformer=transformer)
+        except Exception:
+            pass  # missing or unreadable tables are rebuilt
+
+    built = Lark(grammar, parser='lalr', transformer=transformer)
+    if tables is not None:
+        data = io.BytesIO()
+        data.write(key + b'\n')
+        built.save(data, {'transformer'})
+        try:
+            replaceFile(tables, data.getvalue())
+        except OSError:
+            pass  # a read-only install builds the parser every time
+    return built
+
 
 #to test ambiguities
 #from lark import Lark, Tree, Transformer
@@ -32,10 +99,6 @@ parser = Lark(Path('expr.lark').read_text(), parser='lalr', strict='True', debug
     #print(x.pretty())
 
 
-class ParseError(Exception):
-    pass
-
-
 class AmbiguousParse(Exception):
     pass
 
@@ -77,6 +140,10 @@ class ToExpr(Transformer[Token, Expr]):
     def join(self, args: tuple[Expr, Expr]) -> Expr:
         return Join(*args)
 
+    # DOMAIN SPECIFIC EXTENSION
+    def par(self, args: tuple[Expr, Expr]) -> Expr:
+        return Par(*args)
+
     def add(self, args: tuple[Expr, Expr]) -> Expr:
         return Add(*args)
 
@@ -122,11 +189,21 @@ class ToExpr(Transformer[Token, Expr]):
     def note(self, args: tuple[Token, Token]) -> Expr:
         return Note(args[0].value, int(args[1].value))
 
+    # DOMAIN SPECIFIC EXTENSION
+    def tune_lit(self, args: list[Token]) -> Expr:
+        return TuneLit([Note(name.value, int(n.value)) for name, n in zip(args[::2], args[1::2])])
+
+    @staticmethod
+    def binder(name: Token) -> str:
+        if name.value in UNBINDABLE:
+            raise ParseError(f"{name.value!r} is a reserved word at line {name.line}, column {name.column}")
+        return name.value
+
     def let(self, args: tuple[Token, Expr, Expr]) -> Expr:
-        return Let(args[0].value, args[1], args[2])
+        return Let(self.binder(args[0]), args[1], args[2])
 
     def letfun(self, args: tuple[Token, Token, Expr, Expr]) -> Expr:
-        return Letfun(args[0].value, args[1].value, args[2], args[3])
+        return Letfun(self.binder(args[0]), self.binder(args[1]), args[2], args[3])
 
     def app(self, args: tuple[Expr, Expr]) -> Expr:
         return App(*args)
@@ -135,7 +212,6 @@ class ToExpr(Transformer[Token, Expr]):
         return Assign(args[0].value, args[1])
 
     def seq(self, args: tuple[Expr, Expr]) -> Expr:
-        print(len(args))
         return Seq(*args)
 
     def show(self, args: tuple[Expr]) -> Expr:
@@ -149,6 +225,14 @@ class ToExpr(Transformer[Token, Expr]):
     def run(self, args: tuple[Expr]) -> Expr:
         return Run(args[0].value)
 
+    # DOMAIN SPECIFIC EXTENSION
+    def load(self, args: tuple[Token]) -> Expr:
+        return Load(args[0].value)
+
+    # DOMAIN SPECIFIC EXTENSION
+    def preview(self, args: tuple[Token, Token, Expr]) -> Expr:
+        return Preview(int(args[0].value), args[1].value, args[2])
+
     # DOMAIN SPECIFIC EXTENSION
     def repeat(self, args: tuple[Expr, Expr]) -> Expr:
         return Repeat(*args)
@@ -162,6 +246,10 @@ class ToExpr(Transformer[Token, Expr]):
         raise AmbiguousParse()
 
 
+parser = buildParser()
+astParser = buildParser(transformer=ToExpr())
+
+
 def parse(s:str) -> ParseTree:
     try:
         return parser.parse(s)
@@ -170,14 +258,71 @@ def parse(s:str) -> ParseTree:
 
 
 def genAST(t:ParseTree) -> Expr:
-    """Applies the transformer to convert a parse tree into an AST"""
-    try:
-        return ToExpr().transform(t)
-    except VisitError as e:
-        if isinstance(e.orig_exc, AmbiguousParse):
-            raise AmbiguousParse()
+    """Applies the transformer to convert a parse tree into an AST. The
+    tree is walked with a stack of its own rather than by recursion, as the
+    right-recursive rules (seq_exp, join_exp, par_exp) make long chains
+    into very deep trees."""
+    transformer = ToExpr()
+    done: list[Expr | Token] = []  # transformed subtrees, in order
+    todo: list[tuple[ParseTree | Token, bool]] = [(t, False)]
+    while todo:
+        node, children_done = todo.pop()
+        if not isinstance(node, Tree):
+            done.append(node)
+        elif children_done:
+            args = done[len(done) - len(node.children):]
+            del done[len(done) - len(node.children):]
+            done.append(getattr(transformer, node.data)(args))
         else:
-            raise e
+            todo.append((node, True))
+            todo.extend((child, False) for child in reversed(node.children))
+    return done[0]
+
+
+def parseAST(s: str, flat: bool = False) -> Expr:
+    """Parses straight to an AST. The transformer runs as each rule is
+    reduced, so no parse tree is built. With flat, chains of joins and
+    sequences are single n-ary nodes (see interp.flatten)."""
+    if PARSER_FRONTEND == 'pratt':
+        return pratt.parse(s, flat)
+    try:
+        e = astParser.parse(s)
+    except AmbiguousParse:
+        raise
+    except Exception as e:
+        raise ParseError(e)
+    return flatten(e) if flat else e
+
+
+# cached ASTs are only good for this grammar, lark, python and front end, and
+# for the code of the parsers and AST nodes that built them
+astKey = hashlib.sha256(grammarKey(GRAMMAR.read_text()))
+astKey.update(PARSER_FRONTEND.encode())
+for module in ('interp.py', 'parse_run.py', 'pratt.py', 'astcode.py'):
+    astKey.update(Path(__file__).with_name(module).read_bytes())
+parseCache = RenderCache(PARSE_CACHE, disk_limit=PARSE_CACHE_LIMIT, suffix='.ast')
+
+
+def parseCached(s: str, flat: bool = True) -> Expr:
+    """parseAST through parseCache, for scripts that are run again and again.
+    ASTs are kept in the compiled format of astcode.py, which only decodes to
+    AST nodes, so the shared directory holds nothing that runs as code. A
+    script that fails to parse is not cached."""
+    key = contentKey((astKey.hexdigest(), flat), s)
+    parsed = None
+
+    def encode() -> bytes:
+        nonlocal parsed
+        parsed = parseAST(s, flat)
+        return astcode.encodeAST(parsed)
+
+    try:
+        data = parseCache.render(key, encode)
+        return parsed if parsed is not None else astcode.decodeAST(data)
+    except (OSError, astcode.AstFormatError):
+        # an unwritable cache directory, or an entry that cannot be read
+        parseCache.discard(key)
+        return parsed if parsed is not None else parseAST(s, flat)
 
 
 def parse_and_run(s: str):
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# ==============================================================================
+# Playback queue for show. Shown tunes are queued and played one after the
+# other by a background thread, while a second thread encodes the next few
+# tunes in memory so they are ready when the current one ends. Evaluation
+# only waits for playback when it drains the queue.
+#
+# A streamed tune is queued as a job that plays a NoteStream, which the
+# evaluator fills while the player is already sending the first notes.
+# ==============================================================================
+
+import atexit
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterator
+
+LOOKAHEAD = 2  # tunes encoded ahead of the one playing
+BUFFER_NOTES = 32  # notes evaluated before a stream starts playing
+
+
+class PlaybackQueue:
+    """Plays tunes in the order they were queued"""
+
+    def __init__(self, render: Callable[[Any], bytes],
+                 play: Callable[[bytes], None],
+                 report: Callable[[str], None] = print,
+                 lookahead: int = LOOKAHEAD):
+        self.render = render
+        self.play = play
+        self.report = report
+        self.pending: queue.Queue[tuple[Any, str, bool]] = queue.Queue()
+        self.ready: queue.Queue[tuple[Any, str, Exception | None]] = queue.Queue(lookahead)
+        self.outstanding = 0
+        self.done = threading.Condition()
+        self.threads: list[threading.Thread] = []
+
+    def _start(self) -> None:
+        for target, name in ((self._render, "render"), (self._play, "playback")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        atexit.register(self.drain)
+
+    def _render(self) -> None:
+        while True:
+            value, label, job = self.pending.get()
+            try:
+                data = value if job else self.render(value)
+            except Exception as e:
+                self.ready.put((None, label, e))
+            else:
+                self.ready.put((data, label, None))
+
+    def _play(self) -> None:
+        while True:
+            data, label, error = self.ready.get()
+            try:
+                if error is None:
+                    data() if callable(data) else self.play(data)
+            except Exception as e:
+                error = e
+            if error is not None:
+                self.report(f"failed to play {label}: {error}")
+            with self.done:
+                self.outstanding -= 1
+                self.done.notify_all()
+
+    def submit(self, value: Any, label: str = "tune") -> None:
+        """Queues a tune and returns at once. The value must not change
+        afterwards, so callers pass a snapshot."""
+        self._submit(value, label, False)
+
+    def submitJob(self, job: Callable[[], None], label: str = "tune") -> None:
+        """Queues a call that does its own playing, in turn with the tunes"""
+        self._submit(job, label, True)
+
+    def _submit(self, value: Any, label: str, job: bool) -> None:
+        with self.done:
+            if not self.threads:
+                self._start()
+            self.outstanding += 1
+        self.pending.put((value, label, job))
+
+    def drain(self) -> None:
+        """Waits until every queued tune has been played"""
+        with self.done:
+            self.done.wait_for(lambda: not self.outstanding)
+
+
+class NoteStream:
+    """Notes passed from the evaluator to a player while the evaluator is
+    still producing them. Reading starts once buffer notes are in or the
+    tune is complete, and notes records the whole tune."""
+
+    def __init__(self, buffer: int = BUFFER_NOTES):
+        self.buffer = buffer
+        self.notes: list[Any] = []
+        self.closed = False
+        self.changed = threading.Condition()
+        self.started = time.perf_counter()
+        self.first_note: float | None = None
+
+    def put(self, note: Any) -> None:
+        with self.changed:
+            self.notes.append(note)
+            if len(self.notes) >= self.buffer:
+                self.changed.notify_all()
+
+    def close(self) -> None:
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+    def __iter__(self) -> Iterator[Any]:
+        with self.changed:
+            self.changed.wait_for(lambda: self.closed or len(self.notes) >= self.buffer)
+        i = 0
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.closed or i < len(self.notes))
+                if i >= len(self.notes):
+                    return
+                ready = self.notes[i:]
+            if self.first_note is None:
+                self.first_note = time.perf_counter()
+            yield from ready
+            i += len(ready)
+
+    @property
+    def time_to_first_note(self) -> float | None:
+        """Seconds from the stream being opened to its first note leaving"""
+        if self.first_note is None:
+            return None
+        return self.first_note - self.started
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+# ==============================================================================
+# Midi players. The player is detected once per process: VLC is kept running
+# in the background with its rc interface and told what to play over a pipe,
+# other players are started once per file without a shell. INTERP_PLAYER
+# overrides the detection with "vlc", "fake", "none" or a command line.
+#
+#   python player.py --fake-rc
+#
+# runs a stand-in for "vlc -I rc" that speaks the same commands and "plays"
+# a file by sleeping for a moment, so the pipe protocol can be tested and
+# benchmarked on machines without VLC.
+#
+# Midi encoded in memory never touches the disk: a player that reads stdin
+# is handed the bytes, any other player gets the path of an anonymous memory
+# file (memfd). Only where there is no memfd is a file written, on tmpfs.
+#
+# Streaming players take note events instead of a file and send them in real
+# time as they arrive, so a tune can start playing while it is evaluated.
+# "rawmidi:/dev/snd/midiC0D0" picks one that writes to a raw MIDI device.
+#
+# Headless machines can use "wav:<directory>" to have every tune rendered to
+# a numbered wav file there (see audio.py) instead of being played.
+# ==============================================================================
+
+import contextlib
+import os
+import queue
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from itertools import chain
+from typing import Callable, Iterable, Iterator
+
+import smf
+
+START_TIMEOUT = 10.0  # seconds for a player to start a file
+POLL_INTERVAL = 0.05  # seconds between playback status checks
+FAKE_DURATION = 0.05  # seconds the fake players spend on a file
+TMPFS = "/dev/shm"  # for midi files when there is no memfd
+
+
+class PlayerError(Exception):
+    """Midi Player Failure"""
+    pass
+
+
+class Player:
+    """Plays one midi file at a time"""
+
+    streaming = False  # whether playEvents is supported
+
+    def play(self, path: str) -> None:
+        """Plays a file, returning once it has finished"""
+        raise NotImplementedError
+
+    def playData(self, data: bytes) -> None:
+        """Plays a midi file held in memory"""
+        with memoryFile(data) as path:
+            self.play(path)
+
+    def playEvents(self, events: Iterable[smf.Event]) -> None:
+        """Plays note events in real time as they arrive"""
+        raise PlayerError("player cannot stream")
+
+    def close(self) -> None:
+        pass
+
+
+def eventMessage(kind: int, pitch: int) -> bytes:
+    return bytes((smf.NOTE_ON if kind else smf.NOTE_OFF, pitch, smf.VOLUME))
+
+
+def fileEvents(path: str) -> list[smf.Event]:
+    notes = smf.readNotes(path)
+    return sorted(chain.from_iterable(smf.partEvents([note]) for note in notes))
+
+
+def playRealtime(events: Iterable[smf.Event], send: Callable[[bytes], None],
+                 tempo: int = smf.TEMPO,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep) -> None:
+    """Sends each event when it is due, the clock starting at the first
+    one. An event that arrives late is sent at once."""
+    seconds_per_beat = 60 / tempo
+    origin = None
+    for time_, kind, pitch in events:
+        if origin is None:
+            origin = clock() - time_ * seconds_per_beat
+        if (wait := origin + time_ * seconds_per_beat - clock()) > 0:
+            sleep(wait)
+        send(eventMessage(kind, pitch))
+
+
+@contextlib.contextmanager
+def memoryFile(data: bytes) -> Iterator[str]:
+    """A path other processes of this user can open to read data, valid
+    until the context exits"""
+    if hasattr(os, "memfd_create") and os.path.isdir(f"/proc/{os.getpid()}/fd"):
+        fd = os.memfd_create("tune.mid")
+        try:
+            with open(fd, "wb", closefd=False) as file:
+                file.write(data)
+            yield f"/proc/{os.getpid()}/fd/{fd}"
+        finally:
+            os.close(fd)
+        return
+    directory = TMPFS if os.path.isdir(TMPFS) else None
+    with tempfile.NamedTemporaryFile(suffix=".mid", dir=directory) as file:
+        file.write(data)
+        file.flush()
+        yield file.name
+
+
+class FakePlayer(Player):
+    """Records what it is asked to play instead of playing it"""
+
+    streaming = True
+
+    def __init__(self, duration: float = 0.0):
+        self.duration = duration
+        self.played: list[bytes] = []
+        self.streamed: list[list[smf.Event]] = []
+
+    def play(self, path: str) -> None:
+        with open(path, "rb") as file:
+            self.playData(file.read())
+
+    def playData(self, data: bytes) -> None:
+        self.played.append(data)
+        time.sleep(self.duration)
+
+    def playEvents(self, events: Iterable[smf.Event]) -> None:
+        self.streamed.append(received := [])
+        for event in events:
+            received.append(event)
+        time.sleep(self.duration)
+
+
+class RawMidiPlayer(Player):
+    """Sends note messages to a raw MIDI device (or any file) in real time"""
+
+    streaming = True
+
+    def __init__(self, device: str):
+        self.device = device
+
+    def play(self, path: str) -> None:
+        self.playEvents(fileEvents(path))
+
+    def playEvents(self, events: Iterable[smf.Event]) -> None:
+        try:
+            with open(self.device, "wb", buffering=0) as device:
+                try:
+                    playRealtime(events, device.write)
+                finally:
+                    device.write(bytes((0xB0, 123, 0)))  # all notes off
+        except OSError as e:
+            raise PlayerError(f"cannot write to {self.device}: {e}")
+
+
+class CommandPlayer(Player):
+    """Runs a command per file, with the path as its last argument. A
+    command that reads a file from stdin when given stdin_arg as the path
+    is fed midi held in memory that way."""
+
+    def __init__(self, argv: list[str], stdin_arg: str | None = None):
+        self.argv = argv
+        self.stdin_arg = stdin_arg
+
+    def play(self, path: str) -> None:
+        self._run(path, None)
+
+    def playData(self, data: bytes) -> None:
+        if self.stdin_arg is None:
+            return super().playData(data)
+        self._run(self.stdin_arg, data)
+
+    def _run(self, path: str, data: bytes | None) -> None:
+        try:
+            result = subprocess.run(
+                [*self.argv, path],
+                input=data, stdin=None if data is not None else subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+        except OSError as e:
+            raise PlayerError(f"cannot start {self.argv[0]}: {e}")
+        if result.returncode != 0:
+            raise PlayerError(f"{self.argv[0]} exited with status {result.returncode}")
+
+
+class RcPlayer(Player):
+    """Drives a long-lived VLC through its rc interface. A file is added to
+    the playlist, then is_playing is polled until it starts and ends. The
+    process is started on first use and again if it dies."""
+
+    STATUS = re.compile(rb"^[>\s]*([01])\s*$")
+
+    def __init__(self, argv: list[str]):
+        self.argv = argv
+        self.process: subprocess.Popen | None = None
+        self.lines: queue.Queue[bytes] = queue.Queue()
+        self.lock = threading.Lock()
+
+    def _start(self) -> subprocess.Popen:
+        if self.process is not None and self.process.poll() is None:
+            return self.process
+        try:
+            process = subprocess.Popen(
+                self.argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            )
+        except OSError as e:
+            raise PlayerError(f"cannot start {self.argv[0]}: {e}")
+        self.lines = queue.Queue()
+        threading.Thread(
+            target=self._read, args=(process.stdout, self.lines),
+            name="player-output", daemon=True
+        ).start()
+        self.process = process
+        return process
+
+    @staticmethod
+    def _read(stdout, lines: queue.Queue[bytes]) -> None:
+        for line in stdout:
+            lines.put(line)
+        lines.put(b"")  # end of output
+
+    def _send(self, command: str) -> None:
+        try:
+            self.process.stdin.write(command.encode() + b"\n")
+            self.process.stdin.flush()
+        except (OSError, ValueError) as e:
+            raise PlayerError(f"{self.argv[0]} is not responding: {e}")
+
+    def _playing(self) -> bool:
+        self._send("is_playing")
+        deadline = time.monotonic() + START_TIMEOUT
+        while (timeout := deadline - time.monotonic()) > 0:
+            try:
+                line = self.lines.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if not line:
+                raise PlayerError(f"{self.argv[0]} exited")
+            if match := self.STATUS.match(line):
+                return match[1] == b"1"
+        raise PlayerError(f"{self.argv[0]} is not responding")
+
+    def play(self, path: str) -> None:
+        if "\n" in path:
+            raise PlayerError(f"cannot play {path!r}")
+        with self.lock:
+            self._start()
+            self._send("clear")
+            self._send(f"add {os.path.abspath(path)}")
+            deadline = time.monotonic() + START_TIMEOUT
+            while not self._playing():
+                if time.monotonic() > deadline:
+                    raise PlayerError(f"{self.argv[0]} did not start {path}")
+                time.sleep(POLL_INTERVAL)
+            while self._playing():
+                time.sleep(POLL_INTERVAL)
+
+    def close(self) -> None:
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                try:
+                    self._send("quit")
+                    self.process.stdin.close()
+                    self.process.wait(timeout=1)
+                except (PlayerError, OSError, subprocess.TimeoutExpired):
+                    self.process.kill()
+                    self.process.wait()
+            self.process = None
+
+
+class WavPlayer(Player):
+    """Renders each file to the next numbered wav file of a directory"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.count = 0
+
+    def play(self, path: str) -> None:
+        import audio  # numpy is only loaded by the players that need it
+        self.count += 1
+        name = os.path.join(self.directory, f"show-{self.count}.wav")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            audio.writeWav(smf.readNotes(path), name)
+        except (audio.AudioError, smf.MidiFormatError, OSError) as e:
+            raise PlayerError(f"cannot render {name}: {e}")
+
+
+def findPlayer(choice: str | None = None) -> Player | None:
+    """Picks a player from a choice like INTERP_PLAYER, or from what is
+    installed when there is no choice. A blank choice is no choice."""
+    if choice is not None and not choice.strip():
+        choice = None
+    match choice:
+        case "none":
+            return None
+        case "fake":
+            return FakePlayer(FAKE_DURATION)
+        case str() if choice.startswith("rawmidi:"):
+            return RawMidiPlayer(choice.removeprefix("rawmidi:"))
+        case str() if choice.startswith("wav:"):
+            return WavPlayer(choice.removeprefix("wav:"))
+        case "vlc" | None:
+            if vlc := shutil.which("vlc"):
+                return RcPlayer([vlc, "-I", "rc", "--rc-fake-tty", "--no-video"])
+            if choice is None and (timidity := shutil.which("timidity")):
+                return CommandPlayer([timidity, "-q"], stdin_arg="-")
+            return None
+        case command:
+            return CommandPlayer(shlex.split(command))
+
+
+_player: Player | None = None
+_detected = False
+
+
+def defaultPlayer() -> Player | None:
+    """The player for this process, detected on first use"""
+    if not _detected:
+        setPlayer(findPlayer(os.environ.get("INTERP_PLAYER")))
+    return _player
+
+
+def setPlayer(player: Player | None) -> None:
+    """Replaces the player for this process, closing the old one"""
+    global _player, _detected
+    if _player is not None and _player is not player:
+        _player.close()
+    _player, _detected = player, True
+
+
+def fakeRc() -> None:
+    """Answers the rc commands used by RcPlayer on stdin and stdout"""
+    ends = 0.0
+    for line in sys.stdin:
+        command, _, argument = line.strip().partition(" ")
+        match command:
+            case "add":
+                ends = time.monotonic() + FAKE_DURATION if os.path.isfile(argument) else 0.0
+            case "clear":
+                ends = 0.0
+            case "is_playing":
+                print(f"> {int(time.monotonic() < ends)}", flush=True)
+            case "quit":
+                break
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--fake-rc"]:
+        fakeRc()
+    else:
+        sys.exit("usage: player.py --fake-rc")
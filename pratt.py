@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+# ==============================================================================
+# Hand-written front end for the grammar in expr.lark. Binary operators are
+# parsed by precedence climbing, with the levels and associativity of the
+# README's precedence table, and the result is the same interp AST that
+# parse_run builds through Lark. Chains of the right-associative ";", "&" and
+# "|" are collected in a loop, so their length does not use up the stack.
+#
+# Tokens are lexed on demand, as in Lark's contextual lexer: a path is only
+# lexed where one is expected, after run, load and the ":" of write, and a
+# "#" there starts the path rather than a comment. This module does not
+# import Lark.
+# ==============================================================================
+
+import re
+
+from interp import (
+    Expr, Lit, Add, Sub, Mul, Div, Neg, And, Or, Not, Eq,
+    Neq, Lt, Gt, Leq, Geq, If, Let, Name, Note, Join,
+    Slice, Letfun, App, Assign, Seq, Show, Read,
+    Write, Run, Repeat, Reverse, Par, Load, Preview,
+    TuneLit, joinAll, seqAll,
+)
+
+
+class ParseError(Exception):
+    pass
+
+
+# levels, lowest first: an operand of an operator at one level is a node
+# from a higher level (or the same one, on the side it associates to)
+SEQ, IF, OR, AND, NOT, COMP, TUNE, PAR, JOIN, ADD, MUL, NEG, ATOM = range(13)
+
+LEFT, RIGHT, NONE = range(3)
+
+INFIX = {
+    ";": (SEQ, RIGHT, Seq),
+    "||": (OR, LEFT, Or),
+    "&&": (AND, LEFT, And),
+    "==": (COMP, NONE, Eq),
+    "!=": (COMP, NONE, Neq),
+    "<": (COMP, NONE, Lt),
+    ">": (COMP, NONE, Gt),
+    "<=": (COMP, NONE, Leq),
+    ">=": (COMP, NONE, Geq),
+    "&": (PAR, RIGHT, Par),  # DOMAIN SPECIFIC EXTENSION
+    "|": (JOIN, RIGHT, Join),  # DOMAIN SPECIFIC EXTENSION
+    "+": (ADD, LEFT, Add),
+    "-": (ADD, LEFT, Sub),
+    "*": (MUL, LEFT, Mul),
+    "/": (MUL, LEFT, Div),
+}
+
+KEYWORDS = frozenset((
+    "if", "then", "else", "let", "letfun", "in", "end", "show", "preview",
+    "write", "run", "load", "repeat", "reverse",
+))
+# a word starting with one of these is lexed as the keyword and the rest
+# (see NAME in expr.lark)
+RESERVED = re.compile(r"show|write|run|repeat|reverse")
+# like lark's contextual lexer, keywords that cannot come next are names
+NAMES = frozenset(("word", "then", "else", "in", "end"))
+BINDERS = NAMES | {"if", "let", "letfun", "preview", "load"}
+# keywords that lex as names where let and letfun bind one, but not where the
+# bound name would be used
+UNBINDABLE = frozenset(("load", "preview"))
+PREVIEW_UNITS = ("beats", "notes")  # DOMAIN SPECIFIC EXTENSION
+
+TOKEN = re.compile(r"""
+    (?:[ \t\f\r\n]+|\#[^\n]*)*  # whitespace and comments
+    (?:
+        (?P<int>[0-9]+)
+      | (?P<word>[_a-zA-Z][_a-zA-Z0-9]*)
+      | (?P<op>:=|\|\||&&|==|!=|<=|>=|[;!<>|&+\-*/\[\]():,=])
+      | (?P<eof>\Z)
+      | (?P<error>.)
+    )
+""", re.VERBOSE | re.DOTALL)
+# a path can start with "#": lark reads it as the path, not a comment
+PATH = re.compile(r"[ \t\f\r\n]*([^\0; \t\f\r\n][^\0; ]*)")
+
+type Token = tuple[str, str, int, int]  # kind, text, start, stop
+
+
+class Parser:
+    """Parses one source string. The current token is kind and text, from
+    start to stop in the source. With flat, chains of joins and sequences
+    are single n-ary nodes, as from interp.flatten. Errors give positions
+    from the line and column the source starts at in its file."""
+
+    def __init__(self, source: str, flat: bool = False, line: int = 1, column: int = 1):
+        self.source = source
+        self.flat = flat
+        self.line = line
+        self.column = column
+        self.ahead: list[Token] = []
+        self.end = 0  # of the last token lexed
+        self.advance()
+
+    # Lexing
+    # ------
+
+    def lex(self) -> Token:
+        match = TOKEN.match(self.source, self.end)
+        kind = match.lastgroup
+        start, stop = match.span(kind)
+        text = match[kind]
+        if kind == "word":
+            if text in KEYWORDS:
+                kind = text
+            elif reserved := RESERVED.match(text):
+                kind = text = reserved[0]
+                stop = start + len(text)
+        elif kind == "op":
+            kind = text
+        self.end = stop
+        return (kind, text, start, stop)
+
+    def advance(self) -> None:
+        token = self.ahead.pop(0) if self.ahead else self.lex()
+        self.kind, self.text, self.start, self.stop = token
+
+    def peek(self, n: int = 1) -> str:
+        """The kind of the token n after the current one"""
+        while len(self.ahead) < n:
+            self.ahead.append(self.lex())
+        return self.ahead[n - 1][0]
+
+    def path(self) -> str:
+        """Skips the current token and reads a path after it, in place of
+        the tokens lexed there"""
+        self.ahead.clear()
+        self.end = self.stop
+        if match := PATH.match(self.source, self.end):
+            self.end = match.end()
+        self.advance()
+        if match is None:
+            self.fail("a path")
+        return match[1]
+
+    # Errors
+    # ------
+
+    def position(self) -> str:
+        """Where the current token is in the file"""
+        lines = self.source.count("\n", 0, self.start)
+        column = self.start - self.source.rfind("\n", 0, self.start)
+        if not lines:
+            column += self.column - 1
+        return f"line {self.line + lines}, column {column}"
+
+    def fail(self, expected: str):
+        found = "end of input" if self.kind == "eof" else repr(self.text)
+        raise ParseError(f"expected {expected}, found {found} at {self.position()}")
+
+    def expect(self, kind: str) -> None:
+        if self.kind != kind:
+            self.fail(repr(kind))
+        self.advance()
+
+    def name(self, kinds: frozenset[str] = BINDERS) -> str:
+        if self.kind not in kinds:
+            self.fail("a name")
+        text = self.text
+        self.advance()
+        return text
+
+    def binder(self) -> str:
+        """A name that let or letfun binds"""
+        if self.text in UNBINDABLE:
+            raise ParseError(f"{self.text!r} is a reserved word at {self.position()}")
+        return self.name()
+
+    # Parsing
+    # -------
+
+    def parse(self, minimum: int = SEQ) -> Expr:
+        """The whole source, as an expression of level minimum or above"""
+        e, _ = self.expr(minimum)
+        if self.kind != "eof":
+            self.fail("an operator or end of input")
+        return e
+
+    def expr(self, minimum: int) -> tuple[Expr, int]:
+        """An expression of level minimum or above, and its level"""
+        left, level = self.prefix(minimum)
+        while (op := INFIX.get(self.kind)) is not None:
+            op_level, assoc, node = op
+            if op_level < minimum or level < op_level + (assoc != LEFT):
+                break
+            if assoc == RIGHT:
+                # a whole chain at once, so it can be any length
+                operands = [left]
+                while INFIX.get(self.kind) is op:
+                    self.advance()
+                    operands.append(self.expr(op_level + 1)[0])
+                if self.flat and node in (Join, Seq):
+                    left = (joinAll if node is Join else seqAll)(operands)
+                    level = op_level
+                    continue
+                left = operands.pop()
+                while operands:
+                    left = node(operands.pop(), left)
+            else:
+                self.advance()
+                left = node(left, self.expr(op_level + 1)[0])
+            level = op_level
+        return left, level
+
+    def prefix(self, minimum: int) -> tuple[Expr, int]:
+        """An expression up to its first infix operator"""
+        match self.kind:
+            case "if" if minimum <= IF:
+                self.advance()
+                cond, _ = self.expr(SEQ)
+                self.expect("then")
+                then, _ = self.expr(SEQ)
+                self.expect("else")
+                return If(cond, then, self.expr(IF)[0]), IF
+            case "show" if minimum <= IF:
+                self.advance()
+                return Show(self.expr(IF)[0]), IF
+            # DOMAIN SPECIFIC EXTENSION
+            case "preview" if minimum <= IF:
+                self.advance()
+                if self.kind != "int":
+                    self.fail("a number")
+                limit = int(self.text)
+                self.advance()
+                if self.text not in PREVIEW_UNITS:
+                    self.fail(" or ".join(PREVIEW_UNITS))
+                unit = self.text
+                self.advance()
+                return Preview(limit, unit, self.expr(IF)[0]), IF
+            case kind if kind in NAMES and minimum <= IF and self.peek() == ":=":
+                name = self.text
+                self.advance()
+                self.advance()
+                return Assign(name, self.expr(IF)[0]), IF
+            case "!" if minimum <= NOT:
+                self.advance()
+                return Not(self.expr(NOT)[0]), NOT
+            # DOMAIN SPECIFIC EXTENSION
+            case "write" if minimum <= TUNE:
+                self.advance()
+                tune, _ = self.expr(PAR)
+                if self.kind == ":=":
+                    # lark lexes ":" here, and the path starts with the "="
+                    self.stop = self.start + 1
+                elif self.kind != ":":
+                    self.fail("':'")
+                return Write(tune, self.path()), TUNE
+            # DOMAIN SPECIFIC EXTENSION
+            case "run" if minimum <= TUNE:
+                return Run(self.path()), TUNE
+            # DOMAIN SPECIFIC EXTENSION
+            case "load" if minimum <= TUNE:
+                return Load(self.path()), TUNE
+            # DOMAIN SPECIFIC EXTENSION
+            case "repeat" if minimum <= TUNE:
+                self.advance()
+                count, _ = self.expr(JOIN)
+                self.expect(":")
+                return Repeat(count, self.expr(JOIN)[0]), TUNE
+            # DOMAIN SPECIFIC EXTENSION
+            case "reverse" if minimum <= TUNE:
+                self.advance()
+                return Reverse(self.expr(JOIN)[0]), TUNE
+            case "-" if minimum <= NEG:
+                self.advance()
+                return Neg(self.expr(NEG)[0]), NEG
+        return self.postfix(self.atom(minimum)), ATOM
+
+    def postfix(self, e: Expr) -> Expr:
+        """Applications of an atom, then slices of the result"""
+        while self.kind == "(":
+            self.advance()
+            arg, _ = self.expr(SEQ)
+            self.expect(")")
+            e = App(e, arg)
+        # DOMAIN SPECIFIC EXTENSION
+        while self.kind == "[":
+            self.advance()
+            start, _ = self.expr(SEQ)
+            self.expect(":")
+            end, _ = self.expr(SEQ)
+            self.expect("]")
+            e = Slice(e, start, end)
+        return e
+
+    def atom(self, minimum: int) -> Expr:
+        kind, text = self.kind, self.text
+        if kind == "int":
+            self.advance()
+            return Lit(int(text))
+        if kind in NAMES or (kind in ("if", "preview") and minimum > IF) or (
+            kind == "load" and minimum > TUNE
+        ):
+            self.advance()
+            match text:
+                case "true":
+                    return Lit(True)
+                case "false":
+                    return Lit(False)
+                case "read":
+                    return Read()
+            return Name(text)
+        if kind == "(":
+            self.advance()
+            # DOMAIN SPECIFIC EXTENSION
+            if self.kind in NAMES and self.peek() == "," and self.peek(2) == "int":
+                return self.note(NAMES)
+            e, _ = self.expr(SEQ)
+            self.expect(")")
+            return e
+        # DOMAIN SPECIFIC EXTENSION
+        if kind == "[":
+            self.advance()
+            notes = []
+            while self.kind != "]":
+                if notes:
+                    self.expect(",")
+                self.expect("(")
+                notes.append(self.note())
+            self.advance()
+            return TuneLit(notes)
+        if kind == "let":
+            self.advance()
+            name = self.binder()
+            self.expect("=")
+            defexpr, _ = self.expr(SEQ)
+            self.expect("in")
+            bodyexpr, _ = self.expr(SEQ)
+            self.expect("end")
+            return Let(name, defexpr, bodyexpr)
+        if kind == "letfun":
+            self.advance()
+            name = self.binder()
+            self.expect("(")
+            param = self.binder()
+            self.expect(")")
+            self.expect("=")
+            bodyexpr, _ = self.expr(SEQ)
+            self.expect("in")
+            inexpr, _ = self.expr(SEQ)
+            self.expect("end")
+            return Letfun(name, param, bodyexpr, inexpr)
+        self.fail("an expression")
+
+    # DOMAIN SPECIFIC EXTENSION
+    def note(self, names: frozenset[str] = BINDERS) -> Note:
+        """The rest of a note after its "(" """
+        pitch = self.name(names)
+        self.expect(",")
+        if self.kind != "int":
+            self.fail("a number")
+        duration = int(self.text)
+        self.advance()
+        self.expect(")")
+        return Note(pitch, duration)
+
+
+def parse(source: str, flat: bool = False) -> Expr:
+    """Parses a program straight to an AST"""
+    return Parser(source, flat).parse()
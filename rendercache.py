@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+# ==============================================================================
+# Content addressed cache of rendered midi files. Entries are keyed by a hash
+# of the notes and the render parameters. Recently used files are kept in
+# memory, and when a directory is given every file is also kept on disk, from
+# where repeats are copied instead of being encoded again.
+#
+# Files on disk are only ever replaced whole, by rename, so any number of
+# processes can share a directory: a reader sees a complete file or none.
+# parse_run keeps parsed scripts in a cache of the same kind.
+# ==============================================================================
+
+import hashlib
+import os
+import stat
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Callable, Iterable
+
+MEMORY_LIMIT = 64 << 20  # bytes of encoded files kept in memory
+DISK_LIMIT = 1 << 30  # bytes of encoded files kept on disk
+MAX_NOTES = 1 << 20  # longer tunes are streamed past the cache
+
+# the umask can only be read by setting it, so this is done once, on import
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+
+
+def contentKey(params: tuple, *fields: str | Iterable[int]) -> str:
+    """Hashes the render parameters and the fields of a note sequence. A
+    field is either a string or an iterable of integers, packed in C."""
+    key = hashlib.blake2b(repr(params).encode(), digest_size=16)
+    for field in fields:
+        if isinstance(field, str):
+            data = field.encode()
+        else:
+            field = list(field)
+            try:
+                data = array("q", field).tobytes()
+            except OverflowError:
+                data = repr(field).encode()
+        key.update(len(data).to_bytes(8, "little"))
+        key.update(data)
+    return key.hexdigest()
+
+
+def replaceFile(name: str, data: bytes) -> None:
+    """Atomically replaces name with data, keeping the mode of the file it
+    replaces or giving a new one the usual 0o666 less the umask. A symlink
+    is followed. A file with other hard links, or anything that is not a
+    regular file (a FIFO or a device), is written in place, as
+    open(name, "wb") would, so that every link or reader sees the data."""
+    name = os.path.realpath(name)
+    try:
+        old = os.stat(name)
+        mode = stat.S_IMODE(old.st_mode)
+        if old.st_nlink > 1 or not stat.S_ISREG(old.st_mode):
+            with open(name, "wb") as file:
+                file.write(data)
+            return
+    except FileNotFoundError:
+        mode = 0o666 & ~UMASK
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(name), prefix=".render-")
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(tmp, name)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class RenderCache:
+    """Two tier cache of encoded files, stored on disk with suffix. Safe to
+    share between threads: the memory tier and the counters are locked,
+    while encoding and file I/O run outside the lock."""
+
+    def __init__(self, directory: str | None = None,
+                 memory_limit: int = MEMORY_LIMIT, disk_limit: int = DISK_LIMIT,
+                 suffix: str = ".mid"):
+        self.directory = directory
+        self.suffix = suffix
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory: OrderedDict[str, bytes] = OrderedDict()
+        self.memory_size = 0
+        self.disk_size: int | None = None  # measured on first use
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def stats(self) -> dict[str, float]:
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (lookups - self.misses) / lookups if lookups else 0.0,
+            }
+
+    def clear(self) -> None:
+        """Empties the memory tier and resets the counters"""
+        with self.lock:
+            self.memory.clear()
+            self.memory_size = 0
+            self.memory_hits = self.disk_hits = self.misses = 0
+
+    def _recall(self, key: str) -> bytes | None:
+        """The file for key from the memory tier, counting the lookup as a
+        hit if it is there"""
+        with self.lock:
+            if (data := self.memory.get(key)) is not None:
+                self.memory_hits += 1
+                self.memory.move_to_end(key)
+            return data
+
+    def _remember(self, key: str, data: bytes, disk_hit: bool = False) -> None:
+        """Keeps a file found on disk or just encoded, counting the lookup"""
+        with self.lock:
+            if disk_hit:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+            if len(data) > self.memory_limit // 4:
+                return
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return
+            self.memory[key] = data
+            self.memory_size += len(data)
+            while self.memory_size > self.memory_limit:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_size -= len(evicted)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + self.suffix)
+
+    def _entries(self) -> list[os.DirEntry]:
+        entries = []
+        for shard in os.scandir(self.directory):
+            if shard.is_dir():
+                entries += (e for e in os.scandir(shard) if e.name.endswith(self.suffix))
+        return entries
+
+    def _store(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        replaceFile(path, data)
+        with self.lock:
+            if self.disk_size is None:
+                self.disk_size = sum(e.stat().st_size for e in self._entries())
+            else:
+                self.disk_size += len(data)
+            full = self.disk_size > self.disk_limit
+        if full:
+            self._evict()
+
+    def _evict(self) -> None:
+        """Deletes the least recently used files until the store is back
+        under 90% of its limit. Hits touch their file, so mtime is recency."""
+        entries = sorted(self._entries(), key=lambda e: e.stat().st_mtime)
+        size = sum(e.stat().st_size for e in entries)
+        for entry in entries:
+            if size <= self.disk_limit * 9 // 10:
+                break
+            try:
+                os.unlink(entry.path)
+                size -= entry.stat().st_size
+            except FileNotFoundError:
+                pass
+        with self.lock:
+            self.disk_size = size
+
+    def discard(self, key: str) -> None:
+        """Forgets an entry, such as one that turned out to be unreadable"""
+        with self.lock:
+            if (data := self.memory.pop(key, None)) is not None:
+                self.memory_size -= len(data)
+        if self.directory is not None:
+            try:
+                os.unlink(self._path(key))
+            except OSError:
+                pass
+
+    def render(self, key: str, encode: Callable[[], bytes]) -> bytes:
+        """The file for key as bytes, encoding it only on a miss"""
+        if (data := self._recall(key)) is not None:
+            return data
+
+        if self.directory is not None:
+            path = self._path(key)
+            try:
+                os.utime(path)
+                with open(path, "rb") as file:
+                    data = file.read()
+                self._remember(key, data, disk_hit=True)
+                return data
+            except FileNotFoundError:
+                pass
+
+        data = encode()
+        self._remember(key, data)
+        if self.directory is not None:
+            self._store(key, data)
+        return data
+
+    def writeFile(self, key: str, encode: Callable[[], bytes], name: str) -> None:
+        """Writes the file for key to name, encoding it only on a miss"""
+        if (data := self._recall(key)) is not None:
+            replaceFile(name, data)
+            return
+
+        if self.directory is not None:
+            path = self._path(key)
+            try:
+                os.utime(path)
+                with open(path, "rb") as file:
+                    data = file.read()
+                self._remember(key, data, disk_hit=True)
+                replaceFile(name, data)
+                return
+            except FileNotFoundError:
+                pass
+
+        data = encode()
+        self._remember(key, data)
+        if self.directory is not None:
+            self._store(key, data)
+        replaceFile(name, data)
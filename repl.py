@@ -1,25 +1,47 @@
 #!/usr/bin/env python3
 
-from parse_run import parse, genAST, AmbiguousParse, ParseError
-from interp import run, EvalError, EnvError, RuntimeError
-from pathlib import Path
+from parse_run import parseAST, parseCached, AmbiguousParse, ParseError
+from interp import run, runStatements, setPreview, waitForShows, EvalError, EnvError, RuntimeError
+from incremental import readStatements
+import os
 import readline
 
+# set INTERP_DOFILE_STREAMING=1 to run each statement of a file as it is read
+DOFILE_STREAMING = bool(os.environ.get('INTERP_DOFILE_STREAMING'))
+
 def driver():
     while True:
         try:
             s = input('> ')
             while s[-1] == '\\':
                 s = s[:-1] + '\n' + input('>> ')
-            if (ts := s.split())[0] == "dofile":
+            if (ts := s.split())[0] == "preview" and (ts[1:] == ["off"] or (
+                len(ts) in (2, 3) and ts[1].isdecimal() and ts[2:] in ([], ["beats"], ["notes"])
+            )):
+                # `preview 8 beats`, `preview 16 notes` or `preview off`;
+                # anything else is a preview expression
+                setPreview(None if ts[1] == "off" else int(ts[1]), *ts[2:])
+                continue
+            if ts == ["wait"]:
+                waitForShows()
+                continue
+            if ts[0] == "dofile":
                 try:
-                    s = Path(ts[1]).read_text()
+                    file = open(ts[1])
                 except IndexError:
                     print("dofile expected a path")
+                    continue
                 except FileNotFoundError as e:
                     print(f"file not found: {e}")
-            t = parse(s)
-            ast = genAST(t)
+                    continue
+                with file:
+                    if DOFILE_STREAMING:
+                        runStatements(readStatements(file, flat=True))
+                        print()
+                        continue
+                    ast = parseCached(file.read())
+            else:
+                ast = parseAST(s)
             run(ast) # pretty-prints and executes the AST
             print()
         except AmbiguousParse:
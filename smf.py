@@ -0,0 +1,588 @@
+#!/usr/bin/env python3
+
+# ==============================================================================
+# Standard MIDI File input and output. This module only deals in integers (MIDI pitch
+# numbers, times and durations in beats) so it does not need to import interp.
+# The layout matches what midiutil writes for MIDIFile(1): a format 1 file with
+# a tempo track followed by a single note track.
+# ==============================================================================
+
+import heapq
+from collections import OrderedDict
+from dataclasses import dataclass
+import mmap
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+from multiprocessing import get_context
+from typing import Iterable, Iterator
+
+TICKS_PER_BEAT = 960  # same resolution as midiutil
+TEMPO = 250  # In BPM
+VOLUME = 100  # 0-127, as per the MIDI standard
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+END_OF_TRACK = b"\x00\xff\x2f\x00"
+
+CHUNK_SIZE = 1 << 16  # flush the track buffer to disk every 64 KiB
+BLOCK_NOTES = 8192  # notes encoded between flushes and rewrite checkpoints
+REST_CODE = 0xFF  # stands for a rest in packed pitch arrays
+UNPACK = (*range(128), *(None,) * 128)  # packed pitch to encoder pitch
+
+# process pools start their workers from a fork server: forking this process
+# is not safe once the playback and write-behind threads are running
+POOL_CONTEXT = get_context("forkserver")
+
+type Part = Iterable[tuple[int, int, int]]  # (start, pitch, duration), sorted
+type Event = tuple[int, int, int]  # (time, 0 = off | 1 = on, pitch)
+
+
+def varLen(value: int) -> bytes:
+    """Encode a non-negative integer as a MIDI variable-length quantity"""
+    buf = bytearray((value & 0x7F,))
+    value >>= 7
+    while value:
+        buf.append(0x80 | (value & 0x7F))
+        value >>= 7
+    buf.reverse()
+    return bytes(buf)
+
+
+_varLens: dict[int, bytes] = {}
+
+
+def deltaBeats(beats: int) -> bytes:
+    """Variable-length tick count for a whole number of beats. Tunes reuse a
+    handful of durations, so the encodings are memoised."""
+    try:
+        return _varLens[beats]
+    except KeyError:
+        encoded = varLen(beats * TICKS_PER_BEAT)
+        if len(_varLens) < 4096:
+            _varLens[beats] = encoded
+        return encoded
+
+
+def fileHeader(ntracks: int) -> bytes:
+    """MThd chunk for a format 1 file"""
+    return (
+        b"MThd" + (6).to_bytes(4, "big")
+        + (1).to_bytes(2, "big")
+        + ntracks.to_bytes(2, "big")
+        + TICKS_PER_BEAT.to_bytes(2, "big")
+    )
+
+
+def tempoTrack(tempo: int = TEMPO) -> bytes:
+    """MTrk chunk holding a single set-tempo meta event at time 0"""
+    body = (
+        b"\x00\xff\x51\x03" + (60_000_000 // tempo).to_bytes(3, "big")
+        + END_OF_TRACK
+    )
+    return b"MTrk" + len(body).to_bytes(4, "big") + body
+
+
+def _messages(status: int, velocity: int) -> list[bytes]:
+    return [bytes((status, pitch, velocity)) for pitch in range(128)]
+
+
+_tables: dict[tuple[bool, int], tuple[list[bytes], list[bytes], list[bytes]]] = {}
+
+
+def messageTables(running_status: bool,
+                  volume: int) -> tuple[list[bytes], list[bytes], list[bytes]]:
+    """Prebuilt note messages by pitch: the first note-on of a track, every
+    later note-on and the note-offs. With running status only the first
+    note-on carries a status byte and note-offs are zero velocity note-ons."""
+    key = (running_status, volume)
+    if key not in _tables:
+        on = _messages(NOTE_ON, volume)
+        if running_status:
+            _tables[key] = (
+                on, [message[1:] for message in on],
+                [bytes((pitch, 0)) for pitch in range(128)],
+            )
+        else:
+            _tables[key] = (on, on, _messages(NOTE_OFF, volume))
+    return _tables[key]
+
+
+def encodeBlock(notes: Iterable[tuple[int | None, int]],
+                rest: int = 0, started: bool = False,
+                running_status: bool = True,
+                volume: int = VOLUME) -> tuple[bytearray, int, bool]:
+    """Encodes a monophonic run of (pitch, duration) pairs that continues a
+    note track, a pitch of None being a rest. rest is the silence since the
+    last event and started says whether a note has been written yet. Returns
+    the events with the state to carry into the next run. Without running
+    status the events are byte for byte what midiutil writes."""
+    first_on, next_on, off = messageTables(running_status, volume)
+    on = next_on if started else first_on
+    delta = deltaBeats
+    body = bytearray()
+    for pitch, duration in notes:
+        if pitch is None or duration <= 0:
+            rest += duration
+            continue
+        body += delta(rest)
+        body += on[pitch]
+        body += delta(duration)
+        body += off[pitch]
+        on = next_on
+        rest = 0
+    return body, rest, started or bool(body)
+
+
+def encodeChunks(notes: Iterable[tuple[int | None, int]],
+                 running_status: bool = True, volume: int = VOLUME,
+                 block: int = BLOCK_NOTES) -> Iterator[bytes]:
+    """Encodes the body of a note track a block of notes at a time"""
+    notes = iter(notes)
+    rest, started = 0, False
+    for head in notes:
+        body, rest, started = encodeBlock(
+            chain((head,), islice(notes, block - 1)),
+            rest, started, running_status, volume
+        )
+        yield body
+    yield END_OF_TRACK
+
+
+def encodeNotes(notes: Iterable[tuple[int | None, int]],
+                running_status: bool = True, volume: int = VOLUME) -> bytearray:
+    """Encodes the whole body of a note track in memory"""
+    body, _, _ = encodeBlock(notes, 0, False, running_status, volume)
+    body += END_OF_TRACK
+    return body
+
+
+def encodeFile(body: bytes, tempo: int = TEMPO) -> bytearray:
+    """A whole MIDI file around the body of its note track"""
+    data = bytearray(fileHeader(2))
+    data += tempoTrack(tempo)
+    data += b"MTrk"
+    data += len(body).to_bytes(4, "big")
+    data += body
+    return data
+
+
+def encodeMidi(notes: Iterable[tuple[int | None, int]],
+               running_status: bool = True,
+               tempo: int = TEMPO, volume: int = VOLUME) -> bytearray:
+    """Encodes a whole MIDI file for a monophonic sequence of notes"""
+    return encodeFile(encodeNotes(notes, running_status, volume), tempo)
+
+
+def partEvents(part: Part) -> Iterator[Event]:
+    """Turns one voice into its note-on/note-off events in time order.
+    Notes within a part never overlap, so the events are already sorted.
+    Zero-length notes make no sound and are dropped."""
+    for start, pitch, duration in part:
+        if duration <= 0:
+            continue
+        yield (start, 1, pitch)
+        yield (start + duration, 0, pitch)
+
+
+def sequenceEvents(notes: Iterable[tuple[int | None, int]]) -> Iterator[Event]:
+    """The events of a monophonic sequence, produced as its notes arrive.
+    Times follow the encoder: every pair, rests included, moves time on."""
+    start = 0
+    for pitch, duration in notes:
+        if pitch is not None and duration > 0:
+            yield (start, 1, pitch)
+            yield (start + duration, 0, pitch)
+        start += duration
+
+
+def mergeParts(parts: Iterable[Part]) -> Iterator[Event]:
+    """k-way merges the event streams of every part with a heap. At equal
+    times note-offs sort before note-ons so a repeated pitch is re-struck."""
+    return heapq.merge(*(partEvents(part) for part in parts))
+
+
+def eventChunks(events: Iterable[Event],
+                volume: int = VOLUME) -> Iterator[bytearray]:
+    """Encodes time-ordered events as the body of a note track, in chunks"""
+    body = bytearray()
+    prev = 0
+    for time, kind, pitch in events:
+        tick = time * TICKS_PER_BEAT
+        body += varLen(tick - prev)
+        body += bytes((NOTE_ON if kind else NOTE_OFF, pitch, volume))
+        prev = tick
+        if len(body) >= CHUNK_SIZE:
+            yield body
+            body = bytearray()
+    body += END_OF_TRACK
+    yield body
+
+
+def unpackNotes(pitches: bytes, durations: array) -> Iterator[tuple[int | None, int]]:
+    """Encoder input from packed pitches, REST_CODE being a rest"""
+    return zip(map(UNPACK.__getitem__, pitches), durations)
+
+
+def encodeSegment(pitches: bytes, durations: array,
+                  running_status: bool = True,
+                  volume: int = VOLUME) -> tuple[int, bytes, int]:
+    """Encodes one contiguous piece of a tune for encodeParallel. Pitches are
+    packed, with REST_CODE for rests. Returns the rest before the first
+    sounding note, the events from that note's status byte on and the rest
+    after the last sounding note. A piece without notes is all lead."""
+    notes = list(unpackNotes(pitches, durations))
+    lead = 0
+    for first, (pitch, duration) in enumerate(notes):
+        if pitch is not None and duration > 0:
+            break
+        lead += duration
+    else:
+        return lead, b"", 0
+
+    trail = 0
+    for last in range(len(notes) - 1, first, -1):
+        pitch, duration = notes[last]
+        if pitch is not None and duration > 0:
+            break
+        trail += duration
+
+    body = encodeNotes(notes[first:], running_status, volume)
+    # drop the zero delta in front and the end of track behind
+    return lead, bytes(body[1:-len(END_OF_TRACK)]), trail
+
+
+def encodeParallel(pitches: bytes, durations: array,
+                   workers: int | None = None, segments: int | None = None,
+                   running_status: bool = True,
+                   volume: int = VOLUME) -> bytearray:
+    """Encodes the body of a note track by splitting the tune into contiguous
+    pieces and encoding each one in a separate process. Joining the pieces only
+    needs the delta across each boundary, which is the rest at the end of
+    the previous pieces plus the rest at the start of the next, and running
+    status dropped from every piece but the first. The output is byte for
+    byte what encodeNotes gives."""
+    workers = workers or os.cpu_count() or 1
+    segments = segments or workers
+    size = -(-len(pitches) // segments) or 1
+    bounds = range(0, len(pitches), size)
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=POOL_CONTEXT) as pool:
+        pieces = pool.map(
+            encodeSegment,
+            (pitches[i:i + size] for i in bounds),
+            (durations[i:i + size] for i in bounds),
+            (running_status for _ in bounds),
+            (volume for _ in bounds),
+        )
+        body = bytearray()
+        rest = 0
+        first = True
+        for lead, events, trail in pieces:
+            if not events:
+                rest += lead
+                continue
+            body += deltaBeats(rest + lead)
+            body += events[1:] if running_status and not first else events
+            rest = trail
+            first = False
+    body += END_OF_TRACK
+    return body
+
+
+def encodeEvents(events: Iterable[Event], tempo: int = TEMPO,
+                 volume: int = VOLUME) -> bytearray:
+    """Encodes a whole MIDI file for time-ordered events"""
+    return encodeFile(b"".join(eventChunks(events, volume)), tempo)
+
+
+def writeChunks(chunks: Iterable[bytes], name: str, tempo: int = TEMPO) -> None:
+    """Writes a MIDI file whose note track arrives in chunks. Each chunk goes
+    to disk as soon as it is produced and the track length is patched in by
+    seeking back once the end is known, so memory use does not depend on the
+    length of the track."""
+    with open(name, "wb") as file:
+        file.write(fileHeader(2))
+        file.write(tempoTrack(tempo))
+        file.write(b"MTrk\x00\x00\x00\x00")
+        start = file.tell()
+        for chunk in chunks:
+            file.write(chunk)
+        length = file.tell() - start
+        file.seek(start - 4)
+        file.write(length.to_bytes(4, "big"))
+
+
+def writeNotes(notes: Iterable[tuple[int | None, int]], name: str,
+               running_status: bool = True,
+               tempo: int = TEMPO, volume: int = VOLUME) -> None:
+    """Streams a monophonic sequence of notes from any iterator to a file"""
+    writeChunks(encodeChunks(notes, running_status, volume), name, tempo)
+
+
+def writeEvents(events: Iterable[Event], name: str,
+                tempo: int = TEMPO, volume: int = VOLUME) -> None:
+    """Streams time-ordered events into a MIDI file"""
+    writeChunks(eventChunks(events, volume), name, tempo)
+
+
+class MidiFormatError(Exception):
+    """Malformed Standard MIDI File"""
+    pass
+
+
+def trackChunks(data: memoryview) -> tuple[int, list[memoryview]]:
+    """Splits a MIDI file into its ticks per beat and its track bodies.
+    The bodies are views into data, nothing is copied."""
+    if bytes(data[0:4]) != b"MThd" or len(data) < 14:
+        raise MidiFormatError("missing MThd header")
+    length = int.from_bytes(data[4:8], "big")
+    division = int.from_bytes(data[12:14], "big")
+    if division & 0x8000:
+        raise MidiFormatError("SMPTE time division is not supported")
+    if division == 0:
+        raise MidiFormatError("zero ticks per beat")
+
+    tracks = []
+    i = 8 + length
+    while i + 8 <= len(data):
+        length = int.from_bytes(data[i + 4:i + 8], "big")
+        if bytes(data[i:i + 4]) == b"MTrk":
+            tracks.append(data[i + 8:i + 8 + length])
+        i += 8 + length
+    return division, tracks
+
+
+def trackNotes(track: memoryview) -> list[tuple[int, int, int]]:
+    """Decodes the (start, end, pitch) ticks of every note in one track"""
+    notes = []
+    append = notes.append
+    pending: dict[int, list[int]] = {}  # channel << 7 | pitch -> start ticks
+    end = len(track)
+    i = 0
+    tick = 0
+    status = kind = 0
+    while i < end:
+        byte = track[i]
+        i += 1
+        if byte & 0x80:
+            delta = byte & 0x7F
+            while byte & 0x80:
+                byte = track[i]
+                i += 1
+                delta = (delta << 7) | (byte & 0x7F)
+            tick += delta
+        else:
+            tick += byte
+
+        byte = track[i]
+        if byte & 0x80:
+            status = byte
+            kind = status & 0xF0
+            i += 1
+        elif not status:
+            raise MidiFormatError(f"data byte without a status at {i}")
+
+        if kind == NOTE_ON or kind == NOTE_OFF:
+            pitch = track[i]
+            key = (status & 0x0F) << 7 | pitch
+            if kind == NOTE_ON and track[i + 1]:
+                if key in pending:
+                    pending[key].append(tick)
+                else:
+                    pending[key] = [tick]
+            elif starts := pending.get(key):
+                append((starts.pop(0), tick, pitch))
+            i += 2
+        elif kind == 0xC0 or kind == 0xD0:
+            i += 1
+        elif kind != 0xF0:
+            i += 2
+        else:
+            # meta and sysex events carry a length, and cancel running status
+            if status == 0xFF:
+                i += 1
+            length = 0
+            byte = 0x80
+            while byte & 0x80:
+                byte = track[i]
+                i += 1
+                length = (length << 7) | (byte & 0x7F)
+            i += length
+            status = 0
+    return notes
+
+
+def readNotes(name: str) -> list[tuple[int, int, int]]:
+    """Reads the notes of every track of a MIDI file as (start, pitch,
+    duration) in beats, sorted by start. The file is memory mapped and
+    parsed in place."""
+    with open(name, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            raise MidiFormatError("empty file")
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as data:
+                division, tracks = trackChunks(data)
+                ticks = []
+                try:
+                    for track in tracks:
+                        ticks += trackNotes(track)
+                except IndexError:
+                    raise MidiFormatError("truncated track") from None
+                finally:
+                    # the mapping cannot close while a view of it is left
+                    for track in tracks:
+                        track.release()
+
+    half = division // 2
+    notes = []
+    for start, end, pitch in sorted(ticks):
+        start = (start + half) // division
+        duration = (end + half) // division - start
+        if duration > 0:
+            notes.append((start, pitch, duration))
+    return notes
+
+
+def firstDifference(a, b) -> int:
+    """Index of the first item where two packed sequences of the same type
+    differ, or the length of the shorter one. Compares a page at a time."""
+    a, b = memoryview(a), memoryview(b)
+    size = a.itemsize
+    a, b = a.cast("B"), b.cast("B")
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i:i + 4096] == b[i:i + 4096]:
+        i += 4096
+    i = min(i, n)
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i // size
+
+
+@dataclass
+class WrittenTrack:
+    """What a TrackRewriter knows about a file it has seen written"""
+    pitches: bytes
+    durations: array
+    params: tuple[bool, int, int]  # running status, tempo, volume
+    checkpoints: list[tuple[int, int, bool]]  # encoder state per block
+    signature: tuple[int, int, int, int]  # inode, links, size, mtime
+
+
+def fileSignature(stat: os.stat_result) -> tuple[int, int, int, int]:
+    return (stat.st_ino, stat.st_nlink, stat.st_size, stat.st_mtime_ns)
+
+
+class TrackRewriter:
+    """Rewrites a MIDI file in place when only the end of its tune changed.
+    For every file it has seen written it keeps the packed notes and, for
+    each block of BLOCK_NOTES notes, the offset in the track where the block
+    starts with the encoder state there. A rewrite seeks to the block of the
+    first changed note, writes from there on, truncates and patches the
+    track length. If the file was changed by anything else it is rewritten
+    in full by the caller."""
+
+    def __init__(self, paths: int = 16):
+        self.paths = paths
+        self.files: OrderedDict[str, WrittenTrack] = OrderedDict()
+        self.rewrites = 0
+        self.unchanged = 0
+
+    def forget(self, name: str) -> None:
+        self.files.pop(os.path.abspath(name), None)
+
+    def remember(self, name: str, pitches: bytes, durations: array,
+                 running_status: bool = True,
+                 tempo: int = TEMPO, volume: int = VOLUME) -> None:
+        """Records a file just written in full by someone else. Its block
+        offsets are worked out on demand."""
+        name = os.path.abspath(name)
+        stat = os.stat(name)
+        self._record(name, WrittenTrack(
+            bytes(pitches), array(durations.typecode, durations),
+            (running_status, tempo, volume), [], fileSignature(stat)
+        ))
+
+    def _record(self, name: str, track: WrittenTrack) -> None:
+        self.files[name] = track
+        self.files.move_to_end(name)
+        while len(self.files) > self.paths:
+            self.files.popitem(last=False)
+
+    def _checkpoint(self, track: WrittenTrack, block: int) -> tuple[int, int, bool]:
+        checkpoints = track.checkpoints
+        if not checkpoints:
+            checkpoints.append((0, 0, False))
+        running_status, _, volume = track.params
+        while len(checkpoints) <= block:
+            k = len(checkpoints) - 1
+            offset, rest, started = checkpoints[k]
+            notes = unpackNotes(
+                track.pitches[k * BLOCK_NOTES:(k + 1) * BLOCK_NOTES],
+                track.durations[k * BLOCK_NOTES:(k + 1) * BLOCK_NOTES],
+            )
+            body, rest, started = encodeBlock(notes, rest, started, running_status, volume)
+            checkpoints.append((offset + len(body), rest, started))
+        return checkpoints[block]
+
+    def rewrite(self, name: str, pitches: bytes, durations: array,
+                running_status: bool = True,
+                tempo: int = TEMPO, volume: int = VOLUME) -> bool:
+        """Brings the file up to date with the new notes by rewriting only
+        what changed. Returns False, touching nothing, when the file cannot
+        be rewritten in place and has to be written in full."""
+        name = os.path.abspath(name)
+        track = self.files.get(name)
+        params = (running_status, tempo, volume)
+        try:
+            if track is None or track.params != params or (
+                fileSignature(os.stat(name)) != track.signature
+            ):
+                self.files.pop(name, None)
+                return False
+        except FileNotFoundError:
+            self.files.pop(name, None)
+            return False
+
+        first = min(
+            firstDifference(track.pitches, pitches),
+            firstDifference(track.durations, durations),
+        )
+        if first == len(track.pitches) == len(pitches):
+            self.unchanged += 1
+            self.files.move_to_end(name)
+            return True
+
+        block = first // BLOCK_NOTES
+        offset, rest, started = self._checkpoint(track, block)
+        checkpoints = track.checkpoints[:block]
+        start = len(fileHeader(2)) + len(tempoTrack(tempo)) + 8
+
+        with open(name, "r+b") as file:
+            file.seek(start + offset)
+            for i in range(block * BLOCK_NOTES, len(pitches), BLOCK_NOTES):
+                checkpoints.append((offset, rest, started))
+                notes = unpackNotes(
+                    pitches[i:i + BLOCK_NOTES], durations[i:i + BLOCK_NOTES]
+                )
+                body, rest, started = encodeBlock(
+                    notes, rest, started, running_status, volume
+                )
+                file.write(body)
+                offset += len(body)
+            file.write(END_OF_TRACK)
+            offset += len(END_OF_TRACK)
+            file.truncate()
+            file.seek(start - 4)
+            file.write(offset.to_bytes(4, "big"))
+            file.flush()
+            signature = fileSignature(os.fstat(file.fileno()))
+
+        self.rewrites += 1
+        self._record(name, WrittenTrack(
+            bytes(pitches), array(durations.typecode, durations),
+            params, checkpoints, signature
+        ))
+        return True
@@ -0,0 +1,1105 @@
+#!/usr/bin/env python3
+
+# tests for midi output and the polyphonic extensions
+
+import os
+import stat
+import subprocess
+import tempfile
+import tracemalloc
+import unittest
+from collections import OrderedDict
+from unittest import TestCase
+
+import smf
+import interp
+import archive
+import rendercache
+import batch
+import audio
+import wave
+import threading
+import writebehind
+import playback
+import player
+import sys
+import time
+from interp import (
+    Note, Tune, Timeline, Join, Par, Write, Lit, Load, Seq, Show,
+    Repeat, Slice, Let, Name, Reverse, Preview, JoinN, SeqN, TuneLit
+)
+
+from contextlib import redirect_stdout, redirect_stderr
+with redirect_stdout(None), redirect_stderr(None):
+    from parse_run import just_parse, parseAST
+
+
+class TempDirTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.tmp.name, name)
+
+
+class TestTimeline(TempDirTestCase):
+    def test_par_tunes(self):
+        # (A, 2) & (C, 1) | (E, 1)
+        expr = Par(Note("A", 2), Join(Note("C", 1), Note("E", 1)))
+        self.assertEqual(
+            interp.eval(expr),
+            Timeline([
+                [(0, Note("A", 2))],
+                [(0, Note("C", 1)), (1, Note("E", 1))],
+            ])
+        )
+
+    def test_par_timelines(self):
+        # (A, 1) & (B, 1) & (C, 1)
+        expr = Par(Par(Note("A", 1), Note("B", 1)), Note("C", 1))
+        self.assertEqual(len(interp.eval(expr).parts), 3)
+
+    def test_par_error(self):
+        with self.assertRaises(interp.EvalError):
+            interp.eval(Par(Note("A", 1), Lit(1)))
+
+    def test_parse_par(self):
+        self.assertEqual(
+            just_parse("(A, 1) | (B, 1) & (C, 2) & (D, 4)"),
+            Par(
+                Join(Note("A", 1), Note("B", 1)),
+                Par(Note("C", 2), Note("D", 4))
+            )
+        )
+
+    def test_merge_order(self):
+        # offs sort before ons at the same time, rests never reach the merge
+        parts = [[(0, 60, 2), (2, 60, 1)], [(1, 64, 2)]]
+        self.assertEqual(
+            list(smf.mergeParts(parts)),
+            [(0, 1, 60), (1, 1, 64), (2, 0, 60), (2, 1, 60),
+             (3, 0, 60), (3, 0, 64)]
+        )
+
+    def test_single_voice_matches_tune(self):
+        notes = [Note("A", 1), Note("R", 2), Note("B", 3), Note("A", 200)]
+        interp.writeTimelineMidi(
+            Timeline(interp.timelineParts(Tune(notes))), self.path("timeline.mid")
+        )
+        with open(self.path("timeline.mid"), "rb") as file:
+            self.assertEqual(
+                file.read(),
+                smf.encodeMidi(interp.midiNotes(notes), running_status=False)
+            )
+
+    def test_write_timeline(self):
+        name = self.path("par.mid")
+        expr = Write(Par(Note("A", 1), Note("C", 1)), name)
+        self.assertEqual(interp.eval(expr), True)
+        with open(name, "rb") as file:
+            data = file.read()
+        # the patched track length covers the rest of the file
+        self.assertEqual(int.from_bytes(data[37:41], "big"), len(data) - 41)
+        self.assertEqual(data.count(bytes((smf.NOTE_ON,))), 2)
+
+
+class TestEncoder(TempDirTestCase):
+    notes = [
+        Note("A", 1), Note("R", 2), Note("B", 3), Note("A", 1), Note("A", 1),
+        Note("C", 200), Note("R", 1), Note("G#", 4), Note("H", 1), Note("C", 2),
+    ]
+
+    def midiutil(self, notes: list[Note]) -> bytes:
+        from midiutil import MIDIFile
+        midi = MIDIFile(1)
+        midi.addTempo(0, 0, smf.TEMPO)
+        time = 0
+        for note in notes:
+            if note.pitch in interp.MIDI_PITCH:
+                midi.addNote(
+                    0, 0, interp.MIDI_PITCH[note.pitch], time, note.duration,
+                    smf.VOLUME
+                )
+            time += note.duration
+        name = self.path("midiutil.mid")
+        with open(name, "wb") as file:
+            midi.writeFile(file)
+        with open(name, "rb") as file:
+            return file.read()
+
+    def test_var_len(self):
+        self.assertEqual(smf.varLen(0), b"\x00")
+        self.assertEqual(smf.varLen(0x7F), b"\x7f")
+        self.assertEqual(smf.varLen(0x80), b"\x81\x00")
+        self.assertEqual(smf.varLen(960), b"\x87\x40")
+        self.assertEqual(smf.varLen(0x0FFFFFFF), b"\xff\xff\xff\x7f")
+
+    def test_matches_midiutil(self):
+        self.assertEqual(
+            smf.encodeMidi(interp.midiNotes(self.notes), running_status=False),
+            self.midiutil(self.notes)
+        )
+
+    def test_empty_matches_midiutil(self):
+        self.assertEqual(
+            smf.encodeMidi([], running_status=False), self.midiutil([])
+        )
+
+    def test_running_status(self):
+        body = smf.encodeNotes([(69, 1), (None, 2), (71, 1)])
+        self.assertEqual(
+            body.hex(" "),
+            "00 90 45 64 87 40 45 00 8f 00 47 64 87 40 47 00 00 ff 2f 00"
+        )
+
+    def test_write_midi(self):
+        name = self.path("tune.mid")
+        interp.writeMidi(self.notes, name)
+        with open(name, "rb") as file:
+            data = file.read()
+        self.assertEqual(data, smf.encodeMidi(interp.midiNotes(self.notes)))
+        self.assertLess(len(data), len(self.midiutil(self.notes)))
+
+
+class TestStreaming(TempDirTestCase):
+    def generate(self, count: int):
+        for i in range(count):
+            yield Note(interp.CHROMATIC[i % 12] if i % 5 else "R", 1 + i % 3)
+
+    def test_matches_encoder(self):
+        name = self.path("stream.mid")
+        interp.writeMidi(self.generate(50_000), name)
+        with open(name, "rb") as file:
+            self.assertEqual(
+                file.read(),
+                smf.encodeMidi(interp.midiNotes(list(self.generate(50_000))))
+            )
+
+    def test_flat_memory(self):
+        # the encoded tune is several times larger than the allowance
+        tracemalloc.start()
+        try:
+            interp.writeMidi(self.generate(200_000), self.path("long.mid"))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertGreater(os.path.getsize(self.path("long.mid")), 1_000_000)
+        self.assertLess(peak, 512 * 1024)
+
+
+class TestParallel(TempDirTestCase):
+    def tune(self) -> list[Note]:
+        # rests and silent notes at the ends of pieces, and an all-rest piece
+        notes = [Note("R", 3), Note("A", 0), Note("C", 2)]
+        notes += [Note(interp.CHROMATIC[i % 12], 1 + i % 4) for i in range(30)]
+        notes += [Note("R", 1)] * 12 + [Note("B", 0)]
+        notes += [Note("A" if i % 3 else "R", 1 + i % 5) for i in range(40)]
+        return notes + [Note("R", 2)]
+
+    def test_matches_serial(self):
+        notes = self.tune()
+        for running_status in (True, False):
+            for segments in (1, 2, 5, 9, len(notes)):
+                self.assertEqual(
+                    smf.encodeParallel(
+                        *interp.packNotes(notes), workers=2, segments=segments,
+                        running_status=running_status
+                    ),
+                    smf.encodeNotes(interp.midiNotes(notes), running_status),
+                    (running_status, segments)
+                )
+
+    def test_only_rests(self):
+        notes = [Note("R", 1)] * 10
+        self.assertEqual(
+            smf.encodeParallel(*interp.packNotes(notes), workers=2, segments=3),
+            smf.encodeNotes(interp.midiNotes(notes))
+        )
+
+    def test_write_midi(self):
+        notes = self.tune()
+        old = interp.PARALLEL_NOTES
+        interp.PARALLEL_NOTES = 10
+        try:
+            interp.writeMidi(notes, self.path("parallel.mid"), workers=2)
+        finally:
+            interp.PARALLEL_NOTES = old
+        interp.writeMidi(notes, self.path("serial.mid"))
+        with open(self.path("parallel.mid"), "rb") as a, \
+             open(self.path("serial.mid"), "rb") as b:
+            self.assertEqual(a.read(), b.read())
+
+
+class TestRewrite(TempDirTestCase):
+    def tune(self, count: int, shift: int = 0) -> list[Note]:
+        return [
+            Note(interp.CHROMATIC[(i + shift) % 12] if i % 7 else "R", 1 + i % 3)
+            for i in range(count)
+        ]
+
+    def setUp(self):
+        super().setUp()
+        self.rewriter = smf.TrackRewriter()
+        self.name = self.path("tune.mid")
+
+    def write(self, notes: list[Note]) -> bool:
+        packed = interp.packNotes(notes)
+        if self.rewriter.rewrite(self.name, *packed):
+            return True
+        interp.writeMidi(notes, self.name)
+        self.rewriter.remember(self.name, *packed)
+        return False
+
+    def assertWritten(self, notes: list[Note]):
+        with open(self.name, "rb") as file:
+            self.assertEqual(file.read(), smf.encodeMidi(interp.midiNotes(notes)))
+
+    def test_append(self):
+        notes = self.tune(20_000)
+        self.assertFalse(self.write(notes))
+        notes = notes + self.tune(100)
+        self.assertTrue(self.write(notes))
+        self.assertWritten(notes)
+        self.assertEqual(self.rewriter.rewrites, 1)
+
+    def test_transpose_slice_and_shorten(self):
+        notes = self.tune(30_000)
+        self.write(notes)
+        notes = notes[:17_000] + self.tune(500, 5) + notes[17_500:]
+        self.assertTrue(self.write(notes))
+        self.assertWritten(notes)
+        notes = notes[:9000]
+        self.assertTrue(self.write(notes))
+        self.assertWritten(notes)
+        notes = notes[:1] + notes
+        self.assertTrue(self.write(notes))
+        self.assertWritten(notes)
+
+    def test_unchanged(self):
+        notes = self.tune(100)
+        self.write(notes)
+        self.assertTrue(self.write(list(notes)))
+        self.assertEqual(self.rewriter.unchanged, 1)
+        self.assertWritten(notes)
+
+    def test_fallback(self):
+        notes = self.tune(100)
+        self.write(notes)
+        with open(self.name, "ab") as file:
+            file.write(b"\x00")
+        self.assertFalse(self.write(notes + self.tune(3)))
+        self.assertWritten(notes + self.tune(3))
+        # a new hard link is a change to the file, written through in full
+        os.link(self.name, self.path("link.mid"))
+        self.assertFalse(self.write(notes))
+        self.assertWritten(notes)
+        with open(self.path("link.mid"), "rb") as file:
+            self.assertEqual(file.read(), smf.encodeMidi(interp.midiNotes(notes)))
+
+    def test_write_expression(self):
+        interp.midiRewriter.forget(self.name)
+        rewrites = interp.midiRewriter.rewrites
+        tune = Join(Note("A", 1), Note("B", 2))
+        interp.eval(Write(tune, self.name))
+        interp.eval(Write(Join(tune, Note("C", 1)), self.name))
+        self.assertEqual(interp.midiRewriter.rewrites, rewrites + 1)
+        self.assertWritten([Note("A", 1), Note("B", 2), Note("C", 1)])
+
+
+class TestWriteBehind(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        interp.setWriteBehind(True)
+        self.addCleanup(interp.setWriteBehind, False)
+
+    def test_barrier_before_load(self):
+        name = self.path("tune.mid")
+        tune = Join(Note("A", 1), Note("B", 2))
+        self.assertEqual(interp.eval(Seq(Write(tune, name), Load(name))), interp.eval(tune))
+
+    def test_error_at_barrier(self):
+        name = self.path("missing/tune.mid")
+        self.assertTrue(interp.evalInEnv(interp.emptyEnv, Write(Note("A", 1), name)))
+        with self.assertRaises(interp.RuntimeError):
+            interp.flushWrites()
+        interp.flushWrites()  # errors are reported once
+
+    def test_flush_after_error(self):
+        name = self.path("tune.mid")
+        with self.assertRaises(interp.EvalError):
+            interp.eval(Seq(Write(Note("A", 1), name), interp.Add(Lit(1), Lit(True))))
+        self.assertTrue(os.path.exists(name))
+
+    def test_flush_at_exit(self):
+        name = self.path("tune.mid")
+        code = (
+            "import interp\n"
+            "interp.setWriteBehind(True)\n"
+            f"interp.evalInEnv(interp.emptyEnv, interp.Write(interp.Repeat(interp.Lit(200000), interp.Note('A', 1)), {name!r}))\n"
+        )
+        subprocess.run(
+            [sys.executable, "-c", code], check=True, capture_output=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        self.assertTrue(os.path.exists(name))
+
+    def test_flush_one_path(self):
+        release = threading.Event()
+        written = []
+        def write(value, name):
+            if name == "slow":
+                release.wait()
+            written.append((value, name))
+        queue = writebehind.WriteBehind(write)
+        queue.submit(1, "fast")
+        self.assertEqual(queue.flush("fast"), [])
+        queue.submit(2, "slow")
+        queue.submit(3, "fast")
+        release.set()
+        queue.flush()
+        self.assertEqual(written, [(1, "fast"), (2, "slow"), (3, "fast")])
+
+    def test_flush_other_spelling(self):
+        release = threading.Event()
+        queue = writebehind.WriteBehind(lambda value, name: release.wait())
+        queue.submit(1, "./slow")
+        flushed = threading.Thread(target=queue.flush, args=(os.path.abspath("slow"),))
+        flushed.start()
+        flushed.join(0.05)
+        self.assertTrue(flushed.is_alive())
+        release.set()
+        flushed.join()
+
+    def test_errors_by_path(self):
+        def write(value, name):
+            if value:
+                raise OSError("disk full")
+        queue = writebehind.WriteBehind(write)
+        queue.submit(True, "bad")
+        queue.submit(False, "good")
+        self.assertEqual(queue.flush("./good"), [])
+        self.assertEqual([name for name, _ in queue.flush("bad")], ["bad"])
+        self.assertEqual(queue.flush(), [])
+
+
+class TestPlayback(TestCase):
+    def test_order_and_lookahead(self):
+        events = []
+        playing = threading.Event()
+        release = threading.Event()
+        def render(value):
+            events.append(("render", value))
+            return bytes([value])
+        def play(data):
+            events.append(("play", data))
+            playing.set()
+            release.wait()
+        queue = playback.PlaybackQueue(render, play, report=events.append)
+        for i in range(3):
+            queue.submit(i)
+        playing.wait()
+        while len(events) < 4:
+            time.sleep(0.01)
+        # the next tunes are rendered while the first one still plays
+        self.assertEqual(
+            [e for e in events if e[0] == "render"],
+            [("render", 0), ("render", 1), ("render", 2)]
+        )
+        release.set()
+        queue.drain()
+        self.assertEqual(
+            [e for e in events if e[0] == "play"],
+            [("play", b"\x00"), ("play", b"\x01"), ("play", b"\x02")]
+        )
+
+    def test_errors_are_reported(self):
+        reports = []
+        def render(value):
+            if value == "bad":
+                raise ValueError("cannot render")
+            return b""
+        queue = playback.PlaybackQueue(render, lambda data: None, report=reports.append)
+        queue.submit("bad", "timeline")
+        queue.submit("good")
+        queue.drain()
+        self.assertEqual(reports, ["failed to play timeline: cannot render"])
+
+    def test_show_does_not_wait(self):
+        release = threading.Event()
+        class BlockedPlayer(player.FakePlayer):
+            def playData(self, data):
+                release.wait()
+                super().playData(data)
+        fake = BlockedPlayer()
+        player.setPlayer(fake)
+        self.addCleanup(player.setPlayer, None)
+        played = fake.played
+        tune = Join(Note("A", 1), Note("B", 2))
+        with redirect_stdout(None):
+            interp.evalInEnv(interp.emptyEnv, Seq(Show(tune), Show(tune)))
+        self.assertEqual(played, [])
+        release.set()
+        interp.waitForShows()
+        self.assertEqual(played, [smf.encodeMidi(interp.midiNotes(interp.eval(tune).notes))] * 2)
+
+    def test_wait_is_a_name(self):
+        self.assertEqual(interp.eval(just_parse("let wait = 2 in wait + 1 end")), 3)
+
+
+class TestPlayer(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.name = self.path("tune.mid")
+        interp.writeMidi([Note("A", 1)], self.name)
+
+    def use(self, p: player.Player | None):
+        player.setPlayer(p)
+        self.addCleanup(player.setPlayer, None)
+
+    def test_find(self):
+        self.assertIsNone(player.findPlayer("none"))
+        self.assertIsInstance(player.findPlayer("fake"), player.FakePlayer)
+        self.assertEqual(
+            player.findPlayer("timidity -q").argv, ["timidity", "-q"]
+        )
+        # a blank choice detects a player as if there were none
+        self.assertIs(type(player.findPlayer(" ")), type(player.findPlayer(None)))
+
+    def test_fake_player(self):
+        fake = player.FakePlayer()
+        self.use(fake)
+        interp.runMidi(self.name)
+        with open(self.name, "rb") as file:
+            self.assertEqual(fake.played, [file.read()])
+        with self.assertRaises(interp.RuntimeError):
+            interp.runMidi(self.path("missing.mid"))
+
+    def test_no_player(self):
+        self.use(None)
+        with self.assertRaises(interp.RuntimeError):
+            interp.runMidi(self.name)
+
+    def test_command_player(self):
+        self.use(player.CommandPlayer([sys.executable, "-c", "import sys; open(sys.argv[1])"]))
+        interp.runMidi(self.name)
+        self.use(player.CommandPlayer([sys.executable, "-c", "raise SystemExit(3)"]))
+        with self.assertRaises(interp.RuntimeError):
+            interp.runMidi(self.name)
+
+    def test_memory_file(self):
+        with player.memoryFile(b"MThd") as path:
+            with open(path, "rb") as file:
+                self.assertEqual(file.read(), b"MThd")
+            if hasattr(os, "memfd_create"):
+                self.assertTrue(path.startswith("/proc/"))
+
+    def test_play_data(self):
+        data = smf.encodeMidi(interp.midiNotes([Note("A", 1)]))
+        check = "import sys; assert open(sys.argv[1], 'rb').read().startswith(b'MThd')"
+        self.use(player.CommandPlayer([sys.executable, "-c", check]))
+        interp.playMidi(data)
+        stdin = "import sys; assert sys.argv[1] == '-' and sys.stdin.buffer.read(4) == b'MThd'"
+        self.use(player.CommandPlayer([sys.executable, "-c", stdin], stdin_arg="-"))
+        interp.playMidi(data)
+        self.use(player.RcPlayer([sys.executable, player.__file__, "--fake-rc"]))
+        interp.playMidi(data)
+
+    def test_rc_player(self):
+        rc = player.RcPlayer([sys.executable, player.__file__, "--fake-rc"])
+        self.use(rc)
+        interp.runMidi(self.name)
+        process = rc.process
+        interp.runMidi(self.name)
+        self.assertIs(rc.process, process)  # one process for every file
+        process.kill()
+        process.wait()
+        interp.runMidi(self.name)
+        self.assertIsNot(rc.process, process)
+
+
+class TestStreamingShow(TestCase):
+    notes = [Note("A", 1), Note("R", 2), Note("B", 3), Note("C", 1), Note("H", 2)]
+
+    def test_sequence_events(self):
+        notes = list(interp.midiNotes(self.notes))
+        events = smf.sequenceEvents(iter(notes))
+        self.assertEqual(
+            smf.encodeFile(b"".join(smf.eventChunks(events))),
+            smf.encodeMidi(notes, running_status=False)
+        )
+
+    def test_stream_matches_eval(self):
+        tune = Join(Note("A", 1), Join(Note("B", 2), Note("C", 1)))
+        exprs = [
+            tune,
+            Repeat(Lit(3), tune),
+            Repeat(Lit(0), tune),
+            Slice(Repeat(Lit(4), tune), Lit(2), Lit(7)),
+            Slice(tune, Lit(-2), Lit(3)),
+            Join(Repeat(Lit(2), Name("t")), Slice(Name("t"), Lit(1), Lit(9))),
+        ]
+        for e in exprs:
+            env = interp.extendEnv("t", interp.newLoc(interp.eval(tune)), interp.emptyEnv)
+            self.assertEqual(
+                list(interp.streamInEnv(env, e)), interp.evalInEnv(env, e).notes
+            )
+        with self.assertRaises(interp.EvalError):
+            list(interp.streamInEnv(interp.emptyEnv, Join(tune, Lit(1))))
+
+    def test_buffer(self):
+        stream = playback.NoteStream(buffer=3)
+        received = []
+        started = threading.Event()
+        def consume():
+            for note in stream:
+                received.append(note)
+                started.set()
+        thread = threading.Thread(target=consume)
+        thread.start()
+        stream.put(1)
+        stream.put(2)
+        self.assertFalse(started.wait(0.05))
+        stream.put(3)
+        self.assertTrue(started.wait(5))
+        stream.put(4)
+        stream.close()
+        thread.join()
+        self.assertEqual(received, [1, 2, 3, 4])
+        self.assertGreater(stream.time_to_first_note, 0)
+
+    def test_realtime(self):
+        now = [10.0]
+        sent = []
+        def sleep(seconds):
+            now[0] += seconds
+        player.playRealtime(
+            [(0, 1, 60), (1, 0, 60), (4, 1, 62)],
+            lambda message: sent.append((now[0], message)),
+            tempo=60, clock=lambda: now[0], sleep=sleep
+        )
+        self.assertEqual(sent, [
+            (10.0, bytes((0x90, 60, smf.VOLUME))),
+            (11.0, bytes((0x80, 60, smf.VOLUME))),
+            (14.0, bytes((0x90, 62, smf.VOLUME))),
+        ])
+
+    def test_streaming_show(self):
+        fake = player.FakePlayer()
+        player.setPlayer(fake)
+        self.addCleanup(player.setPlayer, None)
+        interp.setStreamingShow(True)
+        self.addCleanup(interp.setStreamingShow, False)
+        tune = Repeat(Lit(50), Join(Note("A", 1), Note("R", 1)))
+        with redirect_stdout(None):
+            interp.eval(Show(tune))
+            interp.waitForShows()
+        self.assertEqual(fake.played, [])
+        self.assertEqual(
+            fake.streamed,
+            [list(smf.sequenceEvents(interp.midiNotes(interp.eval(tune).notes)))]
+        )
+        self.assertIsNotNone(interp.lastStream.time_to_first_note)
+
+
+class TestPreview(TestCase):
+    tune = Join(Note("A", 3), Join(Note("R", 1), Note("B", 2)))
+
+    def beats(self, notes: list[Note], limit: int) -> list[Note]:
+        prefix = []
+        for note in notes:
+            start = sum(n.duration for n in prefix)
+            if start >= limit:
+                break
+            prefix.append(Note(note.pitch, min(note.duration, limit - start)))
+        return prefix
+
+    def test_matches_eval(self):
+        exprs = [
+            self.tune,
+            Repeat(Lit(5), self.tune),
+            Reverse(Repeat(Lit(3), Join(self.tune, Note("C", 1)))),
+            Join(Reverse(self.tune), Slice(Repeat(Lit(4), self.tune), Lit(2), Lit(9))),
+            Reverse(Slice(Repeat(Lit(4), self.tune), Lit(1), Lit(8))),
+        ]
+        for e in exprs:
+            notes = interp.eval(e).notes
+            for limit in (0, 1, 4, 7, 100):
+                self.assertEqual(
+                    interp.eval(Preview(limit, "notes", e)).notes, notes[:limit]
+                )
+                self.assertEqual(
+                    interp.eval(Preview(limit, "beats", e)).notes, self.beats(notes, limit)
+                )
+
+    def test_only_prefix_is_evaluated(self):
+        # far too long to evaluate whole, or to reverse eagerly
+        huge = Repeat(Lit(10 ** 12), Join(self.tune, Note("C", 4)))
+        self.assertEqual(
+            interp.eval(Preview(5, "notes", Reverse(huge))).notes,
+            [Note("C", 4), Note("B", 2), Note("R", 1), Note("A", 3), Note("C", 4)]
+        )
+        self.assertEqual(
+            interp.eval(Preview(4, "beats", Join(huge, Lit(1)))).notes,
+            [Note("A", 3), Note("R", 1)]
+        )
+
+    def test_show_setting(self):
+        fake = player.FakePlayer()
+        player.setPlayer(fake)
+        self.addCleanup(player.setPlayer, None)
+        interp.setPreview(4, "beats")
+        self.addCleanup(interp.setPreview, None)
+        with redirect_stdout(None):
+            interp.eval(Show(Repeat(Lit(10 ** 12), self.tune)))
+            interp.waitForShows()
+        self.assertEqual(
+            fake.played, [smf.encodeMidi(interp.midiNotes([Note("A", 3), Note("R", 1)]))]
+        )
+
+    def test_show_setting_caps_every_show(self):
+        fake = player.FakePlayer()
+        player.setPlayer(fake)
+        self.addCleanup(player.setPlayer, None)
+        interp.setPreview(2, "notes")
+        self.addCleanup(interp.setPreview, None)
+        sources = [
+            "let t = (A, 3) | (R, 1) | (B, 2) in show t end",  # a bound tune
+            "show (A, 3) | (R, 1) | (B, 2)",  # a tune literal when parsed flat
+            "let x = show (A, 3) | (R, 1) | (B, 2) in x end",  # the value is cut too
+        ]
+        with redirect_stdout(None):
+            for source in sources:
+                self.assertEqual(
+                    interp.eval(parseAST(source, flat=True)).notes, [Note("A", 3), Note("R", 1)]
+                )
+            self.assertEqual(interp.eval(parseAST("show 7")), 7)
+            interp.setPreview(2, "beats")
+            timeline = interp.eval(parseAST("show (A, 3) & (C, 1) | (D, 1) | (E, 1)"))
+            interp.waitForShows()
+        self.assertEqual(timeline.parts, [[(0, Note("A", 2))], [(0, Note("C", 1)), (1, Note("D", 1))]])
+        self.assertEqual(
+            fake.played[:3], [smf.encodeMidi(interp.midiNotes([Note("A", 3), Note("R", 1)]))] * 3
+        )
+
+    def test_preview_timeline_notes(self):
+        timeline = interp.eval(parseAST("(A, 3) | (B, 1) & (C, 1) | (D, 1) | (E, 1)"))
+        self.assertEqual(
+            interp.previewValue(timeline, 3, "notes").parts,
+            [[(0, Note("A", 3))], [(0, Note("C", 1)), (1, Note("D", 1))]]
+        )
+
+    def test_parse_preview(self):
+        self.assertEqual(
+            just_parse("show preview 8 beats a | b; preview 2 notes notes"),
+            Seq(
+                Show(Preview(8, "beats", Join(Name("a"), Name("b")))),
+                Preview(2, "notes", Name("notes"))
+            )
+        )
+
+
+class TestNaryNodes(TestCase):
+    tune = Join(Note("A", 3), Join(Let("t", Note("R", 1), Join(Name("t"), Name("t"))), Note("B", 2)))
+
+    def test_flatten(self):
+        self.assertEqual(
+            interp.flatten(Seq(self.tune, Seq(Join(Note("A", 1), Note("B", 2)), Lit(1)))),
+            SeqN([
+                JoinN([Note("A", 3), Let("t", Note("R", 1), JoinN([Name("t"), Name("t")])), Note("B", 2)]),
+                TuneLit([Note("A", 1), Note("B", 2)]),
+                Lit(1),
+            ])
+        )
+        self.assertEqual(
+            interp.flatten(Join(Join(Note("A", 1), TuneLit([Note("B", 2)])), Note("C", 3))),
+            TuneLit([Note("A", 1), Note("B", 2), Note("C", 3)])
+        )
+
+    def test_matches_binary(self):
+        exprs = [
+            self.tune,
+            Repeat(Lit(2), Join(self.tune, Reverse(self.tune))),
+            Seq(Lit(1), Seq(self.tune, Join(Note("C", 1), Note("D", 1)))),
+        ]
+        for e in exprs:
+            flat = interp.flatten(e)
+            self.assertNotEqual(flat, e)
+            self.assertEqual(interp.eval(flat), interp.eval(e))
+            if not isinstance(flat, SeqN):
+                self.assertEqual(
+                    list(interp.streamInEnv(interp.emptyEnv, flat)), interp.eval(e).notes
+                )
+        with self.assertRaises(interp.EvalError):
+            interp.eval(JoinN([Note("A", 1), Lit(1), Note("B", 1)]))
+
+    def test_preview(self):
+        flat = interp.flatten(Repeat(Lit(10 ** 12), Join(self.tune, Note("C", 4))))
+        self.assertEqual(
+            interp.eval(Preview(3, "notes", Reverse(flat))).notes,
+            [Note("C", 4), Note("B", 2), Note("R", 1)]
+        )
+
+    def test_literal(self):
+        literal = TuneLit([Note("A", 1), Note("B", 2)])
+        first = interp.eval(literal)
+        first.notes.append(Note("C", 1))
+        self.assertEqual(interp.eval(literal), Tune([Note("A", 1), Note("B", 2)]))
+        self.assertEqual(just_parse("[(A, 1), (B, 2)][1:2]"), Slice(literal, Lit(1), Lit(2)))
+
+
+@unittest.skipIf(audio.np is None, "numpy is not installed")
+class TestAudio(TempDirTestCase):
+    notes = [(0, 69, 1), (1, 72, 2), (5, 76, 1), (5, 60, 3)]
+
+    def test_frequency(self):
+        self.assertEqual(audio.frequency(69), 440.0)
+        self.assertAlmostEqual(audio.frequency(60), 261.63, places=2)
+
+    def test_render(self):
+        np = audio.np
+        samples = np.frombuffer(audio.renderAudio(self.notes), "<i2")
+        self.assertEqual(len(samples), round(8 * audio.SAMPLES_PER_BEAT))
+        beat = round(audio.SAMPLES_PER_BEAT)
+        # silence between the notes, sound during them, no clipping
+        self.assertFalse(samples[3 * beat:5 * beat].any())
+        self.assertTrue(samples[:beat].any())
+        self.assertLess(np.abs(samples).max(), 32767 * audio.AMPLITUDE)
+        self.assertEqual(audio.polyphony(audio.noteSamples(self.notes)), 2)
+        self.assertEqual(audio.renderAudio([]), b"")
+
+    def test_chunks_match(self):
+        self.assertEqual(
+            audio.renderAudio(self.notes, workers=2, chunk_seconds=0.17),
+            audio.renderAudio(self.notes)
+        )
+
+    def test_write_wav(self):
+        name = self.path("tune.wav")
+        audio.writeWav(self.notes, name)
+        with wave.open(name, "rb") as file:
+            self.assertEqual(file.getframerate(), audio.SAMPLE_RATE)
+            self.assertEqual(file.getnframes(), round(8 * audio.SAMPLES_PER_BEAT))
+
+    def test_tune_to_wav(self):
+        name = self.path("tune.wav")
+        tune = Tune([Note("A", 1), Note("R", 1), Note("C", 2)])
+        timeline = interp.eval(Par(Join(Note("A", 1), Note("C", 2)), Note("E", 3)))
+        self.assertEqual(list(interp.audioNotes(tune)), [(0, 69, 1), (2, 60, 2)])
+        self.assertEqual(
+            sorted(interp.audioNotes(timeline)), [(0, 64, 3), (0, 69, 1), (1, 60, 2)]
+        )
+        interp.writeWav(timeline, name)
+        with wave.open(name, "rb") as file:
+            samples = file.readframes(file.getnframes())
+        self.assertEqual(samples, audio.renderAudio([(0, 69, 1), (1, 60, 2), (0, 64, 3)]))
+
+    def test_wav_player(self):
+        player.setPlayer(player.findPlayer("wav:" + self.path("previews")))
+        self.addCleanup(player.setPlayer, None)
+        interp.playMidi(interp.encodeShow(Tune([Note("A", 1), Note("B", 1)])))
+        with wave.open(self.path("previews/show-1.wav"), "rb") as file:
+            self.assertEqual(file.getnframes(), round(2 * audio.SAMPLES_PER_BEAT))
+
+
+class TestReader(TempDirTestCase):
+    notes = [
+        Note("R", 2), Note("A", 1), Note("A", 1), Note("R", 3), Note("C", 200),
+        Note("G#", 4), Note("B", 1), Note("C#", 2),
+    ]
+
+    def test_round_trip(self):
+        name = self.path("tune.mid")
+        interp.writeMidi(self.notes, name)
+        self.assertEqual(interp.readMidi(name), Tune(self.notes))
+
+    def test_round_trip_without_running_status(self):
+        name = self.path("tune.mid")
+        with open(name, "wb") as file:
+            file.write(
+                smf.encodeMidi(interp.midiNotes(self.notes), running_status=False)
+            )
+        self.assertEqual(interp.readMidi(name), Tune(self.notes))
+
+    def test_rests_merge(self):
+        # unknown pitches are rests and adjacent rests read back as one
+        name = self.path("tune.mid")
+        interp.writeMidi([Note("A", 1), Note("R", 1), Note("H", 2), Note("B", 1)], name)
+        self.assertEqual(
+            interp.readMidi(name),
+            Tune([Note("A", 1), Note("R", 3), Note("B", 1)])
+        )
+
+    def test_timeline_round_trip(self):
+        name = self.path("par.mid")
+        timeline = interp.eval(Par(Note("A", 2), Join(Note("R", 1), Note("C", 2))))
+        interp.writeTimelineMidi(timeline, name)
+        self.assertEqual(interp.readMidi(name), timeline)
+
+    def test_load(self):
+        name = self.path("tune.mid")
+        expr = Seq(Write(Join(Note("A", 1), Note("B", 2)), name), Load(name))
+        self.assertEqual(interp.eval(expr), Tune([Note("A", 1), Note("B", 2)]))
+
+    def test_load_error(self):
+        name = self.path("empty.mid")
+        open(name, "wb").close()
+        with self.assertRaises(interp.RuntimeError):
+            interp.eval(Load(name))
+        with self.assertRaises(interp.RuntimeError):
+            interp.eval(Load(self.path("missing.mid")))
+
+    def test_truncated(self):
+        name = self.path("tune.mid")
+        interp.writeMidi(self.notes, name)
+        with open(name, "r+b") as file:
+            file.truncate(os.path.getsize(name) - 5)
+        with self.assertRaisesRegex(smf.MidiFormatError, "truncated track"):
+            smf.readNotes(name)
+        with self.assertRaisesRegex(interp.RuntimeError, "truncated track"):
+            interp.eval(Load(name))
+
+    def test_zero_division(self):
+        name = self.path("tune.mid")
+        interp.writeMidi(self.notes, name)
+        with open(name, "r+b") as file:
+            file.seek(12)
+            file.write(bytes(2))
+        with self.assertRaisesRegex(smf.MidiFormatError, "zero ticks per beat"):
+            smf.readNotes(name)
+
+    def test_parse_load(self):
+        self.assertEqual(just_parse("load tune.mid"), Load("tune.mid"))
+        self.assertEqual(just_parse("loaded"), interp.Name("loaded"))
+
+
+class TestArchive(TempDirTestCase):
+    tunes = [
+        Tune([Note("A", 1), Note("R", 2), Note("H", 3)]),
+        Tune([]),
+        Tune([Note(interp.CHROMATIC[i % 12], i + 1) for i in range(1000)]),
+    ]
+
+    def test_round_trip(self):
+        name = self.path("tunes.tuna")
+        archive.writeArchive(self.tunes, name)
+        loaded = archive.openArchive(name)
+        self.assertEqual(len(loaded), 3)
+        self.assertEqual(list(loaded), self.tunes)
+        self.assertEqual(loaded[-1], self.tunes[-1])
+
+    def test_corrupt(self):
+        import random
+        rng = random.Random(0)
+        data = archive.encodeArchive(self.tunes + [Tune([Note("Ö", 1)])])
+        for _ in range(2000):
+            corrupt = bytearray(data)
+            for _ in range(rng.randint(1, 4)):
+                corrupt[rng.randrange(len(corrupt))] = rng.randrange(256)
+            try:
+                tunes = list(archive.Archive(corrupt))
+            except archive.ArchiveError:
+                continue
+            for tune in tunes:
+                self.assertEqual(len(list(tune.notes)), len(tune.notes))
+        for bad, error in (
+            (data[:archive.HEADER.size + 3], "truncated names"),
+            (data.replace("Ö".encode(), b"\xff\xff"), "not utf-8"),
+        ):
+            with self.assertRaisesRegex(archive.ArchiveError, error):
+                archive.Archive(bad)
+
+    def test_zero_copy(self):
+        name = self.path("tunes.tuna")
+        archive.writeArchive(self.tunes, name)
+        tune = archive.openArchive(name)[2]
+        self.assertIsInstance(tune.notes.durations.obj, archive.mmap.mmap)
+        self.assertIs(tune.notes[10:20].durations.obj, tune.notes.durations.obj)
+        self.assertEqual(tune.notes[10:20], self.tunes[2].notes[10:20])
+
+    def test_eval_packed(self):
+        tune = archive.Archive(archive.encodeArchive(self.tunes))[0]
+        env = interp.extendEnv("t", interp.newLoc(tune), interp.emptyEnv)
+        def run(expr):
+            return interp.evalInEnv(env, expr)
+        name = interp.Name("t")
+        self.assertEqual(run(name), self.tunes[0])
+        self.assertEqual(
+            run(Join(name, Note("B", 1))),
+            Tune(self.tunes[0].notes + [Note("B", 1)])
+        )
+        self.assertEqual(
+            run(Join(Note("B", 1), name)),
+            Tune([Note("B", 1)] + self.tunes[0].notes)
+        )
+        self.assertEqual(run(interp.Reverse(name)), Tune(self.tunes[0].notes[::-1]))
+        self.assertEqual(run(interp.Repeat(Lit(2), name)), Tune(self.tunes[0].notes * 2))
+        self.assertEqual(run(interp.Slice(name, Lit(1), Lit(5))), Tune(self.tunes[0].notes[1:]))
+        self.assertEqual(run(interp.Eq(name, name)), True)
+
+    def test_errors(self):
+        with self.assertRaises(archive.ArchiveError):
+            archive.Archive(b"MThd" + bytes(20))
+        with self.assertRaises(archive.ArchiveError):
+            archive.Archive(archive.encodeArchive(self.tunes)[:-1])
+        with self.assertRaises(IndexError):
+            archive.Archive(archive.encodeArchive(self.tunes))[3]
+
+
+class TestRenderCache(TempDirTestCase):
+    tune = Tune([Note("A", 1), Note("R", 2), Note("B", 3)])
+
+    def setUp(self):
+        super().setUp()
+        self.cache = rendercache.RenderCache(self.path("cache"))
+        self.encoded = 0
+
+    def write(self, tune: Tune, name: str):
+        def encode():
+            self.encoded += 1
+            return bytes(smf.encodeMidi(interp.midiNotes(tune.notes)))
+        self.cache.writeFile(interp.renderKey(tune), encode, self.path(name))
+
+    def read(self, name: str) -> bytes:
+        with open(self.path(name), "rb") as file:
+            return file.read()
+
+    def test_keys(self):
+        other = Tune([Note("A", 1), Note("R", 2), Note("B", 4)])
+        self.assertEqual(interp.renderKey(self.tune), interp.renderKey(Tune(list(self.tune.notes))))
+        self.assertNotEqual(interp.renderKey(self.tune), interp.renderKey(other))
+        self.assertNotEqual(
+            interp.renderKey(self.tune),
+            interp.renderKey(Timeline(interp.timelineParts(self.tune)))
+        )
+
+    def test_memory_hit(self):
+        self.write(self.tune, "a.mid")
+        self.write(self.tune, "b.mid")
+        self.assertEqual(self.encoded, 1)
+        self.assertEqual(self.read("a.mid"), self.read("b.mid"))
+        self.assertEqual(self.cache.stats()["memory_hits"], 1)
+        self.assertEqual(self.cache.stats()["hit_rate"], 0.5)
+
+    def test_disk_hit(self):
+        self.write(self.tune, "a.mid")
+        self.cache.clear()
+        self.write(self.tune, "b.mid")
+        self.assertEqual(self.encoded, 1)
+        self.assertEqual(self.cache.stats()["disk_hits"], 1)
+        self.assertEqual(self.read("b.mid"), self.read("a.mid"))
+        # writing over the output must leave the cache entry alone
+        interp.writeMidi([Note("C", 1)], self.path("b.mid"))
+        self.cache.clear()
+        self.write(self.tune, "c.mid")
+        self.assertEqual(self.read("c.mid"), self.read("a.mid"))
+
+    def test_file_mode(self):
+        mode = lambda name: stat.S_IMODE(os.stat(self.path(name)).st_mode)
+        interp.eval(Write(Join(Note("A", 1), Note("B", 2)), self.path("a.mid")))
+        self.assertEqual(mode("a.mid"), 0o666 & ~rendercache.UMASK)
+        os.chmod(self.path("a.mid"), 0o640)
+        self.write(self.tune, "a.mid")
+        self.assertEqual(mode("a.mid"), 0o640)
+
+    def test_links_written_through(self):
+        self.write(Tune([Note("C", 1)]), "a.mid")
+        os.symlink(self.path("a.mid"), self.path("sym.mid"))
+        os.link(self.path("a.mid"), self.path("hard.mid"))
+        self.write(self.tune, "sym.mid")
+        self.assertTrue(os.path.islink(self.path("sym.mid")))
+        self.assertEqual(self.read("a.mid"), self.read("hard.mid"))
+        self.assertEqual(self.read("a.mid"), bytes(smf.encodeMidi(interp.midiNotes(self.tune.notes))))
+
+    def test_fifo_written_through(self):
+        os.mkfifo(self.path("pipe.mid"))
+        received = []
+        reader = threading.Thread(target=lambda: received.append(self.read("pipe.mid")))
+        reader.start()
+        self.write(self.tune, "pipe.mid")
+        reader.join()
+        self.assertTrue(stat.S_ISFIFO(os.stat(self.path("pipe.mid")).st_mode))
+        self.assertEqual(received, [bytes(smf.encodeMidi(interp.midiNotes(self.tune.notes)))])
+
+    def test_threads(self):
+        # the show queue and the writer render through the same cache: here
+        # another thread evicts everything between a lookup and its hit
+        cache = rendercache.RenderCache(memory_limit=400)
+        cache.render("a", lambda: b"a" * 100)
+
+        def evict():
+            for i in range(10):
+                cache.render(str(i), lambda: b"x" * 100)
+
+        other = threading.Thread(target=evict)
+
+        class Interleaved(OrderedDict):
+            def get(self, key, default=None):
+                value = super().get(key, default)
+                if key == "a" and value is not None:
+                    other.start()
+                    other.join(0.2)  # blocked on the cache while this lookup finishes
+                return value
+
+        cache.memory = Interleaved(cache.memory)
+        self.assertEqual(cache.render("a", lambda: b"b" * 100), b"a" * 100)
+        other.join()
+        self.assertEqual(cache.stats()["memory_hits"], 1)
+        self.assertEqual(cache.memory_size, sum(map(len, cache.memory.values())))
+
+    def test_memory_eviction(self):
+        self.cache = rendercache.RenderCache(memory_limit=400)
+        tunes = [Tune([Note("A", i + 1)]) for i in range(10)]
+        for tune in tunes:
+            self.write(tune, "out.mid")
+        self.assertLessEqual(self.cache.memory_size, 400)
+        self.write(tunes[-1], "out.mid")
+        self.write(tunes[0], "out.mid")
+        self.assertEqual(self.encoded, 11)
+
+    def test_disk_eviction(self):
+        self.cache = rendercache.RenderCache(self.path("cache"), disk_limit=200)
+        for i in range(10):
+            self.write(Tune([Note("A", i + 1)]), "out.mid")
+        self.assertLessEqual(self.cache.disk_size, 200)
+        self.assertLessEqual(len(self.cache._entries()), 5)
+
+    def test_write_uses_cache(self):
+        interp.renderCache.clear()
+        for name in ("a.mid", "b.mid"):
+            interp.eval(Write(Par(Note("A", 1), Note("C", 1)), self.path(name)))
+        self.assertEqual(interp.renderCache.stats()["memory_hits"], 1)
+        self.assertEqual(self.read("a.mid"), self.read("b.mid"))
+
+
+class TestBatch(TempDirTestCase):
+    def test_render_batch(self):
+        tunes = [Tune([Note(interp.CHROMATIC[i % 12], i + 1), Note("R", 1)]) for i in range(20)]
+        timeline = interp.eval(Par(Note("A", 2), Join(Note("R", 1), Note("C", 2))))
+        jobs = [(tune, self.path(f"{i}.mid")) for i, tune in enumerate(tunes)]
+        jobs.insert(3, (timeline, self.path("timeline.mid")))
+        jobs.insert(5, (Tune([Note("A", -1)]), self.path("bad.mid")))
+        jobs.insert(7, (Tune([Note("A", 1)]), self.path("missing/dir.mid")))
+
+        results = batch.renderBatch(jobs, workers=2, chunk_size=4)
+        self.assertEqual([r.path for r in results], [path for _, path in jobs])
+        self.assertEqual(
+            [i for i, r in enumerate(results) if r.error is not None], [5, 7]
+        )
+        for tune, path in jobs[:3]:
+            interp.writeMidi(tune.notes, self.path("expected.mid"))
+            with open(path, "rb") as got, open(self.path("expected.mid"), "rb") as expected:
+                self.assertEqual(got.read(), expected.read())
+        self.assertEqual(interp.readMidi(self.path("timeline.mid")), timeline)
+
+    def test_empty_timeline(self):
+        tune = Tune([Note("A", 1), Note("B", 2)])
+        jobs = [(Timeline([]), self.path("empty.mid")), (tune, self.path("tune.mid"))]
+        payload, shape = batch.packChunk(jobs)
+        self.assertEqual(batch.renderChunk(payload, shape, [p for _, p in jobs]), [None, None])
+        self.assertEqual(interp.readMidi(self.path("tune.mid")), tune)
+        self.assertEqual(interp.readMidi(self.path("empty.mid")), Tune([]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+
+# tests for building and running the parser
+
+import io
+import os
+import subprocess
+import sys
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from unittest import TestCase, mock
+
+from contextlib import redirect_stdout
+with redirect_stdout(None):
+    import parse_run
+    from parse_run import parse, genAST, parseAST, ParseError, AmbiguousParse
+    import pratt
+    import astcode
+    import incremental
+    import test3
+    from test_midi import TempDirTestCase
+    import interp
+    from interp import Name, Seq, Join, Show, SeqN, TuneLit, Let
+
+
+class TestParserTables(TempDirTestCase):
+    source = "let t = (A, 1) | (B, 2) in show t & t[0:1]; write t * 2 : out.mid end"
+
+    def parseWith(self, parser) -> object:
+        return genAST(parser.parse(self.source))
+
+    def test_strict_grammar(self):
+        # the dev build fails on any shift/reduce conflict in the grammar
+        dev = parse_run.buildParser(dev=True)
+        self.assertEqual(self.parseWith(dev), genAST(parse(self.source)))
+
+    def test_saved_tables(self):
+        tables = self.path("expr.lark.tables")
+        built = parse_run.buildParser(tables=tables)
+        with open(tables, "rb") as file:
+            key = file.readline().rstrip(b"\n")
+        self.assertEqual(key, parse_run.grammarKey(parse_run.GRAMMAR.read_text()))
+        loaded = parse_run.buildParser(tables=tables)
+        self.assertEqual(self.parseWith(loaded), self.parseWith(built))
+
+    def test_stale_tables(self):
+        tables = self.path("expr.lark.tables")
+        for stale in (b"0" * 64 + b"\ngarbage", b"", b"\x80\x04garbage"):
+            with open(tables, "wb") as file:
+                file.write(stale)
+            parser = parse_run.buildParser(tables=tables)
+            self.assertEqual(self.parseWith(parser), genAST(parse(self.source)))
+            with open(tables, "rb") as file:
+                self.assertNotEqual(file.read(), stale)
+
+
+def parseInCache(directory: str, source: str) -> object:
+    parse_run.parseCache = parse_run.RenderCache(directory, suffix=".ast")
+    return [parse_run.parseCached(source) for _ in range(20)][-1]
+
+
+class TestParseCache(TempDirTestCase):
+    source = "let t = [(A, 1), (B, 2)] in show t & t[0:1]; write t * 2 : out.mid end"
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir(self.path("ast"))
+        self.cache = parse_run.RenderCache(self.path("ast"), suffix=".ast")
+        self.addCleanup(setattr, parse_run, "parseCache", parse_run.parseCache)
+        parse_run.parseCache = self.cache
+
+    def files(self) -> list[str]:
+        return [e.path for e in self.cache._entries()]
+
+    def test_hit(self):
+        first = parse_run.parseCached(self.source)
+        self.assertEqual(first, parseAST(self.source, flat=True))
+        self.cache.clear()  # only the disk tier is left
+        self.assertEqual(parse_run.parseCached(self.source), first)
+        self.assertEqual(parse_run.parseCached(self.source), first)
+        self.assertEqual(self.cache.stats()["disk_hits"], 1)
+        self.assertEqual(self.cache.stats()["memory_hits"], 1)
+        parse_run.parseCached(self.source, flat=False)
+        parse_run.parseCached(self.source + " ")
+        self.assertEqual(len(self.files()), 3)
+
+    def test_key_covers_front_end(self):
+        check = "import parse_run; print(parse_run.astKey.hexdigest())"
+        keys = {
+            subprocess.run(
+                [sys.executable, "-c", check], capture_output=True, text=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=os.environ | {"INTERP_PARSER": front_end}, check=True
+            ).stdout.split()[-1]
+            for front_end in ("lark", "pratt")
+        }
+        self.assertEqual(len(keys), 2)
+
+    def test_errors_not_cached(self):
+        for _ in range(2):
+            with self.assertRaises(ParseError):
+                parse_run.parseCached("show")
+        self.assertEqual(self.files(), [])
+
+    def test_unreadable_entry(self):
+        parse_run.parseCached(self.source)
+        [path] = self.files()
+        with open(path, "wb") as file:
+            file.write(b"garbage")
+        self.cache.clear()
+        self.assertEqual(parse_run.parseCached(self.source), parseAST(self.source, flat=True))
+        self.assertEqual(self.files(), [])
+        parse_run.parseCached(self.source)
+        self.assertEqual(self.files(), [path])
+
+    def test_unwritable_directory(self):
+        with open(self.path("file"), "w"):
+            pass
+        parse_run.parseCache = parse_run.RenderCache(self.path("file"), suffix=".ast")
+        parsed = []
+        def parseOnce(s, flat):
+            parsed.append(s)
+            return parseAST(s, flat)
+        with mock.patch.object(parse_run, "parseAST", parseOnce):
+            self.assertEqual(parse_run.parseCached(self.source), parseAST(self.source, flat=True))
+        self.assertEqual(parsed, [self.source])
+
+    def test_compiled_entries(self):
+        e = parse_run.parseCached(self.source)
+        [path] = self.files()
+        with open(path, "rb") as file:
+            self.assertEqual(astcode.decodeAST(file.read()), e)
+
+    def test_eviction(self):
+        self.cache.disk_limit = 2000
+        for i in range(40):
+            parse_run.parseCached(f"{self.source}; {i}")
+        self.assertLessEqual(sum(os.path.getsize(p) for p in self.files()), 2000)
+
+    def test_shared_directory(self):
+        sources = [f"{self.source}; {i % 3}" for i in range(6)]
+        with ProcessPoolExecutor(3, mp_context=get_context("spawn")) as pool:
+            results = list(pool.map(parseInCache, [self.path("ast")] * len(sources), sources))
+        self.assertEqual(results, [parseAST(s, flat=True) for s in sources])
+        self.assertEqual(len(self.files()), 3)
+
+
+class TestCompiled(TempDirTestCase):
+    sources = [
+        "let t = [(A, 1), (B, 2)] in show t & t[0:1]; write t * 2 : out.mid end",
+        "letfun f(x) = if x <= 0 then (C, 1) else f(x - 1) | (D, 3) in f(4) end",
+        "x := true && !false || read == 1 / 2; preview 2 notes reverse (repeat 3 : x)",
+        "run a.mid; load b.mid; (A, 1) | x; -7 * 99999999999 - 1 > 2; (0 < 1) != (1 >= 2)",
+    ]
+
+    def test_round_trip(self):
+        for source in self.sources:
+            for flat in (False, True):
+                e = parseAST(source, flat)
+                data = astcode.encodeAST(e)
+                self.assertEqual(astcode.decodeAST(data), e, source)
+                self.assertLess(len(data), len(source))
+        e = SeqN([interp.Lit(-2 ** 70), interp.Note("D", -3), TuneLit([interp.Note("É", -1)])])
+        self.assertEqual(astcode.decodeAST(astcode.encodeAST(e)), e)
+
+    def test_deep(self):
+        e = parseAST(";".join(["(A, 1) | x"] * 100_000))
+        data = astcode.encodeAST(e)
+        self.assertEqual(len(astcode.decodeAST(data).expr1.right.name), 1)
+
+    def test_malformed(self):
+        data = astcode.encodeAST(parseAST(self.sources[0]))
+        for bad in (b"", b"TUNA" + data[4:], data[:-3], data + data[-1:], data[:-1] + b"\xff"):
+            with self.assertRaises(astcode.AstFormatError):
+                astcode.decodeAST(bad)
+        with self.assertRaises(astcode.AstFormatError):
+            astcode.encodeAST(Seq(Name("x"), interp.Closure("y", Name("y"), ())))
+
+    def test_compile_and_run(self):
+        script = self.path("tune.example")
+        with open(script, "w") as file:
+            file.write("let t = (A, 1) | (B, 2) in t | (reverse t) end")
+        self.assertEqual(astcode.main([script]), 0)
+        # the compiled script runs where lark is never imported
+        check = (
+            "import sys, batch; "
+            f"print(batch.runScript({self.path('tune.tast')!r}), 'lark' in sys.modules)"
+        )
+        out = subprocess.run(
+            [sys.executable, "-c", check], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout
+        self.assertEqual(out, "[(A, 1),(B, 2),(B, 2),(A, 1)] False\n")
+
+
+class TestFusedParsing(test3.TestParsing):
+    """test3's cases through the parser that builds the AST directly"""
+    def parse(self, concrete: str, expected):
+        try:
+            got = parseAST(concrete)
+        except (ParseError, AmbiguousParse):
+            got = None
+        if expected == "anything":
+            self.assertNotEqual(got, None)
+        else:
+            self.assertEqual(got, expected, f'parser error: "{concrete}"')
+
+    def test_matches_tree(self):
+        source = "let t = (A, 1) | (B, 2) in show t & t[0:1]; write t * 2 : out.mid end"
+        self.assertEqual(parseAST(source), genAST(parse(source)))
+        with self.assertRaises(ParseError):
+            parseAST("show")
+
+
+class TestPrattParsing(test3.TestParsing):
+    """test3's cases through the hand-written parser"""
+    def parse(self, concrete: str, expected):
+        try:
+            got = pratt.parse(concrete)
+        except ParseError:
+            got = None
+        if expected == "anything":
+            self.assertNotEqual(got, None)
+        else:
+            self.assertEqual(got, expected, f'parser error: "{concrete}"')
+
+    def test_matches_lark(self):
+        sources = [
+            "let t = (A, 1) | (B, 2) in show t & t[0:1]; write t * 2 : out.mid end",
+            "runner; then := (end, 2); x + if; !in",  # keywords where lark lexes names
+            "letfun if(end) = 1 in f(2) end(3)[0:1]",
+            "write x & y : a|b;c # comment\n; run ~/x.mid",
+            "preview 3 beats x | y; -a - b - c * d / e",
+            "[(A, 1), (if, 2)] | ((B, 1) | [] | (C, 2)); (x; y); z",
+            "x - load; - load; reverse load | [(load, 1)]",  # load where it is a name
+            "load #c\nx; run \n#c;x",  # a "#" after load or run starts the path
+            "write true := || 2; write x :=y",  # ":" then a path starting with "="
+        ]
+        for source in sources:
+            self.assertEqual(pratt.parse(source), parseAST(source), source)
+            self.assertEqual(pratt.parse(source, flat=True), parseAST(source, flat=True), source)
+        for source in ("show", "a == b == c", "x & show y", "load a.mid | x", "if := 1", "1 ~ 2",
+                       "load #c\n y", "run #c\n -", "load \n", "write x:= y"):
+            with self.assertRaises(ParseError):
+                parseAST(source)
+            with self.assertRaises(ParseError):
+                pratt.parse(source)
+
+    def test_reserved_binders(self):
+        for source in ("let load = 1 in 2 end", "letfun preview(x) = 1 in 2 end",
+                       "letfun f(load) = 1 in 2 end"):
+            with self.assertRaisesRegex(ParseError, "is a reserved word"):
+                parseAST(source)
+            with self.assertRaisesRegex(ParseError, "is a reserved word at line 1"):
+                pratt.parse(source)
+
+    def test_long_chains(self):
+        for op, node in ((";", "Seq"), ("|", "Join"), ("&", "Par"), ("+", "Add")):
+            e = pratt.parse(op.join(["x"] * 100_000))
+            self.assertEqual(type(e).__name__, node)
+
+    def test_error_position(self):
+        with self.assertRaisesRegex(ParseError, "line 2, column 3"):
+            pratt.parse("x;\ny )")
+
+
+class TestIncremental(TestCase):
+    """reparsing after an edit gives what parsing the new text gives"""
+    source = (
+        "let a = (A, 1) | (B, 2) in\n"
+        "    let b = repeat 2:a in show b; write b:b.mid end;\n"
+        "    a := a * 2; # a; comment\n"
+        "    show a\n"
+        "end;\n"
+        "run x.mid; t := [(C, 1), (D, 2)]; show t\n"
+    )
+
+    def assertReparses(self, script, start: int, end: int, new: str):
+        text = script.text[:start] + new + script.text[end:]
+        try:
+            expected = pratt.parse(text, script.block.flat)
+        except ParseError:
+            with self.assertRaises(ParseError, msg=repr(text)):
+                incremental.reparse(script, start, end, new)
+            return script
+        script = incremental.reparse(script, start, end, new)
+        self.assertEqual((script.text, script.ast), (text, expected))
+        return script
+
+    def test_random_edits(self):
+        import random
+        rng = random.Random(0)
+        pieces = [";", " ", "x", "1", "(", ")", "| (A, 1)", "#", "\n", "end", " in ",
+                  "let y = 2 in ", "if ", " then ", " else ", "run ", ":", "show"]
+        for flat in (False, True):
+            script = incremental.parseScript(self.source, flat)
+            for _ in range(500):
+                start = rng.randrange(len(script.text) + 1)
+                end = min(start + rng.choice((0, 0, 1, 3)), len(script.text))
+                script = self.assertReparses(script, start, end, rng.choice(pieces + [""]))
+
+    def test_boundaries(self):
+        script = incremental.parseScript(self.source)
+        for edit in (
+            ("show b;", "show b # "),  # a comment over the end of a body
+            ("write b:b.mid ", "write b:b.mid"),  # a path up to it
+            ("a := a * 2;", "a := a * 2 end; let c = 1 in"),
+            ("# a; comment", "a; comment"),
+            ("show t", "show t;"),
+            ("write b:b.mid", "write b :=b.mid"),  # a path after ":="
+            ("run x.mid", "run #x.mid"),  # a path, not a comment
+        ):
+            with self.subTest(edit):
+                start = self.source.index(edit[0])
+                self.assertReparses(script, start, start + len(edit[0]), edit[1])
+
+    def test_reuse(self):
+        script = incremental.parseScript(self.source)
+        old = script.block.statements
+        start = script.text.index("x.mid")
+        script = incremental.reparse(script, start, start + 1, "y")
+        new = script.block.statements
+        self.assertEqual(script.changed, [pratt.parse("run y.mid")])
+        self.assertIs(new[0], old[0])
+        self.assertEqual([s is t for s, t in zip(new[2:], old[2:])], [True, True])
+
+    def test_nested(self):
+        script = incremental.parseScript(self.source, flat=True)
+        body = script.block.statements[0].body.statements
+        start = script.text.index("a * 2")
+        script = incremental.reparse(script, start + 4, start + 5, "3")
+        [let] = script.changed
+        self.assertIsInstance(let, Let)
+        self.assertEqual(let.bodyexpr.exprs[1], pratt.parse("a := a * 3"))
+        new = script.block.statements[0].body.statements
+        self.assertIs(new[0], body[0])
+        self.assertIs(new[2], body[2])
+        self.assertIs(script.block.statements[1], incremental.reparse(script, 0, 0, "").block.statements[1])
+
+    def test_paths_split(self):
+        source = "write x :=(a;run #(b;c"
+        script = incremental.parseScript(source)
+        self.assertEqual(script.ast, pratt.parse(source))
+        self.assertEqual(len(script.block.statements), 3)
+
+    def test_unsplittable(self):
+        # "end" as a name upsets the nesting, so this is parsed whole
+        source = "x := end; y := (x, 1) | end; show y"
+        script = incremental.parseScript(source)
+        self.assertEqual(script.ast, pratt.parse(source))
+        self.assertReparses(script, 0, 1, "z")
+
+    def test_read_statements(self):
+        sources = [
+            self.source,
+            "x := end; y := (x, 1) | end; show y",
+            "(end; x); y",  # split where it should not be, then rejoined
+            "run a.mid;write x:b;c # ; c\n;d",
+        ]
+        for source in sources:
+            for chunk_size in (1, 5, 1 << 20):
+                with self.subTest(source=source, chunk_size=chunk_size):
+                    file = io.StringIO(source)
+                    statements = list(incremental.readStatements(file, chunk_size=chunk_size))
+                    self.assertEqual(
+                        interp.flatten(incremental.sequence(statements, False)),
+                        interp.flatten(pratt.parse(source))
+                    )
+
+    def test_read_lazily(self):
+        file = io.StringIO("show (A, 1);\n" * 1000 + "(B, 1)")
+        statements = incremental.readStatements(file, chunk_size=100)
+        self.assertEqual(next(statements), pratt.parse("show (A, 1)"))
+        self.assertEqual(file.tell(), 100)
+        self.assertEqual(len(list(statements)), 1000)
+
+    def test_read_errors(self):
+        source = "x;\ny;\nlet a = 1 in\n  a )\nend; z"
+        with self.assertRaises(ParseError) as error:
+            pratt.parse(source)
+        statements = incremental.readStatements(io.StringIO(source), chunk_size=4)
+        self.assertEqual([next(statements), next(statements)], [Name("x"), Name("y")])
+        with self.assertRaisesRegex(ParseError, "line 4, column 5"):
+            next(statements)
+        with self.assertRaisesRegex(ParseError, "line 1, column 6"):
+            list(incremental.readStatements(io.StringIO("x; y )")))
+        self.assertIn("line 4, column 5", str(error.exception))
+
+    def test_run_statements(self):
+        source = "show (A, 1); let t = (B, 2) in t | t end"
+        out = io.StringIO()
+        with redirect_stdout(out):
+            interp.runStatements(incremental.readStatements(io.StringIO(source)), pretty=False)
+        shown, result = out.getvalue().splitlines()
+        self.assertEqual(shown, str([interp.Note("A", 1)]))
+        self.assertEqual(result, f"result: {interp.eval(pratt.parse('(B, 2) | (B, 2)'))}")
+
+
+class TestDeepChains(TestCase):
+    """chains of right-recursive operators, far deeper than the stack"""
+    length = 100_000
+
+    def assertChain(self, e, node: type, field: str):
+        # walked in a loop, as == and repr on the AST would recurse
+        count = 1
+        while isinstance(e, node):
+            self.assertEqual(getattr(e, "expr1" if node is Seq else "left"), Name(field))
+            e = getattr(e, "expr2" if node is Seq else "right")
+            count += 1
+        self.assertEqual((e, count), (Name(field), self.length))
+
+    def parsers(self):
+        yield "genAST", lambda s: genAST(parse(s))
+        yield "parseAST", parseAST
+        yield "pratt", pratt.parse
+
+    def test_seq(self):
+        source = ";\n".join(["x"] * self.length)
+        for name, parser in self.parsers():
+            with self.subTest(name):
+                self.assertChain(parser(source), Seq, "x")
+
+    def test_join(self):
+        source = "show " + " | ".join(["n"] * self.length)
+        for name, parser in self.parsers():
+            with self.subTest(name):
+                e = parser(source)
+                self.assertIsInstance(e, Show)
+                self.assertChain(e.expr, Join, "n")
+
+    def test_flat(self):
+        source = "let x = 0 in " + "; ".join(["x := x + 1"] * self.length) + " end"
+        notes = " | ".join(["(A, 1)"] * self.length)
+        for name, parser in (("parseAST", parseAST), ("pratt", pratt.parse)):
+            with self.subTest(name):
+                e = parser(source, flat=True)
+                self.assertEqual(len(e.bodyexpr.exprs), self.length)
+                self.assertEqual(interp.eval(e), self.length)
+                e = parser(notes, flat=True)
+                self.assertIsInstance(e, TuneLit)
+                self.assertEqual(len(interp.eval(e).notes), self.length)
+
+
+if __name__ == "__main__":
+    unittest.main()
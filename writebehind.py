@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# ==============================================================================
+# Write-behind queue for midi output. Writes are handed to a background thread
+# through a bounded queue, so evaluation carries on while files are encoded
+# and written. Failures are kept until the next barrier, where whoever waits
+# on the barrier gets them back. Paths are told apart by their real path, so
+# a barrier on one spelling of a file waits for writes through any other.
+# ==============================================================================
+
+import atexit
+import os
+import queue
+import sys
+import threading
+from collections import Counter
+from typing import Any, Callable
+
+QUEUE_SIZE = 16  # writes waiting before submit blocks
+
+
+class WriteBehind:
+    """Single background writer, so writes to a path land in order"""
+
+    def __init__(self, write: Callable[[Any, str], None], maxsize: int = QUEUE_SIZE):
+        self.write = write
+        self.queue: queue.Queue[tuple[Any, str, str]] = queue.Queue(maxsize)
+        self.pending: Counter[str] = Counter()  # by real path
+        self.errors: list[tuple[str, str, Exception]] = []  # name, real path, error
+        self.done = threading.Condition()
+        self.thread = threading.Thread(target=self._work, name="write-behind", daemon=True)
+        self.thread.start()
+        atexit.register(self._exit)
+
+    def _work(self) -> None:
+        while True:
+            value, name, path = self.queue.get()
+            try:
+                self.write(value, name)
+            except Exception as e:
+                with self.done:
+                    self.errors.append((name, path, e))
+            with self.done:
+                self.pending[path] -= 1
+                if not self.pending[path]:
+                    del self.pending[path]
+                self.done.notify_all()
+
+    def submit(self, value: Any, name: str) -> None:
+        """Queues a write. The value must not change afterwards, so callers
+        pass a snapshot. Blocks while the queue is full."""
+        path = os.path.realpath(name)
+        with self.done:
+            self.pending[path] += 1
+        self.queue.put((value, name, path))
+
+    def _exit(self) -> None:
+        """Finishes the queued writes before the program exits, reporting
+        the failures that no barrier is left to report"""
+        for name, e in self.flush():
+            print(f"Failed to write Midi {name}: {e}", file=sys.stderr)
+
+    def flush(self, name: str | None = None) -> list[tuple[str, Exception]]:
+        """Waits until every queued write (or every write to name) is on
+        disk, then hands back and clears the failures seen so far (or those
+        of name, keeping the rest for their own barriers)"""
+        path = None if name is None else os.path.realpath(name)
+        with self.done:
+            self.done.wait_for(
+                lambda: not self.pending if path is None else path not in self.pending
+            )
+            errors = [e for e in self.errors if path in (None, e[1])]
+            self.errors = [e for e in self.errors if path not in (None, e[1])]
+        return [(name, e) for name, _, e in errors]